@@ -0,0 +1,127 @@
+""" A signed distance field of polygons, sampled on a grid, for flipper.Game.ballBounce.
+
+    The distance is to the nearest edge of any polygon, negative inside one of them, and the
+    normal is the direction it grows fastest in, pointing out of the polygons. Both are looked up
+    between grid points by bilinear interpolation. Fields are cached on disk by their polygons,
+    size and resolution, so a table is only baked once. """
+
+import hashlib, json, math, os
+import numpy
+
+class DistanceField:
+
+    def __init__(self, distance, nx, ny, resolution, key=None):
+        self.resolution = resolution
+        self.key = key
+        (self.rows, self.columns) = distance.shape
+        # Flat lists are much quicker to index one value at a time than arrays
+        self.distance = distance.ravel().tolist()
+        self.nx = nx.ravel().tolist()
+        self.ny = ny.ravel().tolist()
+
+    def sample(self, x, y):
+        """ Returns the distance and the normal (nx, ny) at x, y, clamped to the edges of the grid """
+
+        gx = min(max(x / self.resolution, 0.0), self.columns - 1.000001)
+        gy = min(max(y / self.resolution, 0.0), self.rows - 1.000001)
+        i = int(gx)
+        j = int(gy)
+        fx = gx - i
+        fy = gy - j
+        k = j * self.columns + i
+        below = k + self.columns
+        w00 = (1 - fx) * (1 - fy)
+        w10 = fx * (1 - fy)
+        w01 = (1 - fx) * fy
+        w11 = fx * fy
+        values = []
+        for field in (self.distance, self.nx, self.ny):
+            values.append(field[k]*w00 + field[k + 1]*w10 + field[below]*w01 + field[below + 1]*w11)
+        (distance, nx, ny) = values
+        length = math.hypot(nx, ny) or 1.0
+        return distance, nx / length, ny / length
+
+    def march(self, start, end, radius):
+        """ Returns the first t in [0, 1] at which a circle of radius moving from start to end
+            touches the polygons, stepping by the distance it can safely move, or None if it
+            does not or already does """
+
+        (sx, sy) = start
+        dx = end[0] - sx
+        dy = end[1] - sy
+        length = math.hypot(dx, dy)
+        if length == 0:
+            return None
+        t = 0.0
+        for step in range(64):
+            gap = self.sample(sx + t*dx, sy + t*dy)[0] - radius
+            if gap <= 0.01:
+                return t if t > 0 else None
+            t += gap / length
+            if t > 1:
+                return None
+        return t
+
+    def save(self, path):
+        shape = (self.rows, self.columns)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, distance=numpy.reshape(self.distance, shape), nx=numpy.reshape(self.nx, shape),
+                        ny=numpy.reshape(self.ny, shape), resolution=self.resolution)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path, key=None):
+        with numpy.load(path) as data:
+            return cls(data['distance'], data['nx'], data['ny'], float(data['resolution']), key)
+
+def polygonKey(polygons, width, height, resolution):
+    """ Returns a name for the field of the polygons that changes whenever any corner does """
+
+    description = json.dumps([[[float(c) for c in corner] for corner in polygon] for polygon in polygons])
+    digest = hashlib.sha1(('%s %r %r %r' % (description, width, height, resolution)).encode()).hexdigest()
+    return 'table-%s-%g' % (digest[:16], resolution)
+
+def bake(polygons, width, height, resolution):
+    """ Returns the signed distance and the normals of the polygons on a grid of points resolution
+        apart covering width by height. Inside is decided as Polygon.isPointInside does. """
+
+    xs = numpy.arange(0, width + resolution, resolution, dtype=numpy.float64)
+    ys = numpy.arange(0, height + resolution, resolution, dtype=numpy.float64)
+    (x, y) = numpy.meshgrid(xs, ys)
+    field = numpy.full(x.shape, numpy.inf)
+    for polygon in polygons:
+        corners = numpy.asarray(polygon, dtype=numpy.float64)
+        nearest = numpy.full(x.shape, numpy.inf)
+        inside = numpy.zeros(x.shape, dtype=bool)
+        for (p1x, p1y), (p2x, p2y) in zip(corners, numpy.roll(corners, -1, axis=0)):
+            (dx, dy) = (p2x - p1x, p2y - p1y)
+            length2 = dx*dx + dy*dy
+            t = 0.0 if length2 == 0 else numpy.clip(((x - p1x)*dx + (y - p1y)*dy) / length2, 0.0, 1.0)
+            nearest = numpy.minimum(nearest, numpy.hypot(x - (p1x + t*dx), y - (p1y + t*dy)))
+            if p1y != p2y:
+                crosses = (y > min(p1y, p2y)) & (y <= max(p1y, p2y)) & (x <= max(p1x, p2x))
+                if p1x != p2x:
+                    crosses &= x <= (y - p1y)*dx/dy + p1x
+                inside ^= crosses
+        field = numpy.minimum(field, numpy.where(inside, -nearest, nearest))
+
+    (gy, gx) = numpy.gradient(field, resolution)
+    return field, gx, gy
+
+def forPolygons(polygons, width, height, resolution=4, cache_dir='cache'):
+    """ Returns the DistanceField of the polygons, from cache_dir if it was baked before """
+
+    key = polygonKey(polygons, width, height, resolution)
+    path = os.path.join(cache_dir, key + '.npz') if cache_dir else None
+    if path and os.path.exists(path):
+        try:
+            return DistanceField.load(path, key)
+        except (OSError, ValueError, KeyError):
+            # A damaged cache file is baked again
+            pass
+    field = DistanceField(*bake(polygons, width, height, resolution), resolution=resolution, key=key)
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        field.save(path)
+    return field
@@ -0,0 +1,57 @@
+""" Integrators that advance a body's position (x, y) and velocity (vx, vy) by a time step dt.
+
+    acceleration(x, y, vx, vy) returns the acceleration (ax, ay) of the body. The arguments may be
+    numbers or NumPy arrays, so the same integrators move a particle, a ball or a whole ArrayEnvironment.
+    Used by the 'integrate' function of PyParticles.Environment and by flipper.Game. """
+
+import math
+
+def explicitEuler(x, y, vx, vy, acceleration, dt):
+    """ Moves with the old velocity. First order, and gains energy under gravity """
+    (ax, ay) = acceleration(x, y, vx, vy)
+    return x + vx*dt, y + vy*dt, vx + ax*dt, vy + ay*dt
+
+def semiImplicitEuler(x, y, vx, vy, acceleration, dt):
+    """ Updates the velocity first and moves with the new one. First order, but keeps the energy
+        of an orbit or a bouncing ball bounded, as the unit steps of Particle.move do """
+    (ax, ay) = acceleration(x, y, vx, vy)
+    vx = vx + ax*dt
+    vy = vy + ay*dt
+    return x + vx*dt, y + vy*dt, vx, vy
+
+def velocityVerlet(x, y, vx, vy, acceleration, dt):
+    """ Second order. The acceleration at the end of the step sees the velocity of an Euler step,
+        which only matters for velocity dependent forces such as drag. """
+    (ax, ay) = acceleration(x, y, vx, vy)
+    x = x + vx*dt + 0.5*ax*dt*dt
+    y = y + vy*dt + 0.5*ay*dt*dt
+    (bx, by) = acceleration(x, y, vx + ax*dt, vy + ay*dt)
+    return x, y, vx + 0.5*(ax + bx)*dt, vy + 0.5*(ay + by)*dt
+
+def rk2(x, y, vx, vy, acceleration, dt):
+    """ The second order Runge-Kutta midpoint method """
+    (ax, ay) = acceleration(x, y, vx, vy)
+    h = 0.5*dt
+    mvx = vx + ax*h
+    mvy = vy + ay*h
+    (bx, by) = acceleration(x + vx*h, y + vy*h, mvx, mvy)
+    return x + mvx*dt, y + mvy*dt, vx + bx*dt, vy + by*dt
+
+INTEGRATORS = {
+    'euler': explicitEuler,
+    'semi_implicit': semiImplicitEuler,
+    'verlet': velocityVerlet,
+    'rk2': rk2}
+
+def getIntegrator(name):
+    integrator = INTEGRATORS.get(name)
+    if integrator is None:
+        raise ValueError("No such integrator: %s, expected one of %s" % (name, ', '.join(INTEGRATORS)))
+    return integrator
+
+def dragRate(drag):
+    """ Returns the rate k of the drag force k*v that multiplies the speed by drag per unit of time,
+        or None if drag is not positive, when the drag stops the body at once """
+    if drag <= 0:
+        return None
+    return math.log(drag)
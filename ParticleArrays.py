@@ -0,0 +1,739 @@
+import math, mmap
+import numpy
+import Integrators, PyParticles
+
+# Per-particle arrays of an ArrayEnvironment. Particle elasticity gets its own name,
+# since Environment.elasticity is the elasticity of the walls.
+FIELDS = ('x', 'y', 'vx', 'vy', 'size', 'mass', 'drag', 'particle_elasticity')
+
+def candidatePairs(x, y, reach):
+    """ Returns index arrays (i, j), i < j, of points that may lie within reach of each other.
+        Points are hashed into square cells of width reach and only neighbouring cells are paired. """
+
+    n = len(x)
+    if n < 2:
+        empty = numpy.empty(0, dtype=numpy.intp)
+        return empty, empty
+
+    cx = numpy.floor((x - x.min()) / reach).astype(numpy.int64)
+    cy = numpy.floor((y - y.min()) / reach).astype(numpy.int64)
+    rows = int(cy.max()) + 2
+    keys = cx * rows + cy
+    order = numpy.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    firsts = []
+    seconds = []
+    for ox, oy in ((0, 0),) + PyParticles.GRID_NEIGHBOURS:
+        target = sorted_keys + (ox * rows + oy)
+        start = numpy.searchsorted(sorted_keys, target, 'left')
+        end = numpy.searchsorted(sorted_keys, target, 'right')
+        if ox == 0 and oy == 0:
+            # Within a cell, only pair each point with the ones sorted after it
+            start = numpy.arange(n) + 1
+        counts = numpy.maximum(end - start, 0)
+        total = int(counts.sum())
+        if not total:
+            continue
+        a = numpy.repeat(numpy.arange(n), counts)
+        offsets = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        b = numpy.repeat(start, counts) + offsets
+        firsts.append(order[a])
+        seconds.append(order[b])
+
+    if not firsts:
+        empty = numpy.empty(0, dtype=numpy.intp)
+        return empty, empty
+
+    i = numpy.concatenate(firsts)
+    j = numpy.concatenate(seconds)
+    i, j = numpy.minimum(i, j), numpy.maximum(i, j)
+    pairs = numpy.lexsort((j, i))
+    return i[pairs], j[pairs]
+
+def _field(name):
+    def get(self):
+        return float(getattr(self._env, name)[self._index])
+
+    def set(self, value):
+        getattr(self._env, name)[self._index] = value
+
+    return property(get, set)
+
+class ParticleView:
+    """ A Particle-like handle onto one row of an ArrayEnvironment """
+
+    __slots__ = ('_env', '_index', '__dict__')
+
+    def __init__(self, env, index):
+        self._env = env
+        self._index = index
+
+    x = _field('x')
+    y = _field('y')
+    vx = _field('vx')
+    vy = _field('vy')
+    size = _field('size')
+    mass = _field('mass')
+    drag = _field('drag')
+    elasticity = _field('particle_elasticity')
+
+    @property
+    def speed(self):
+        return math.hypot(self.vx, self.vy)
+
+    @speed.setter
+    def speed(self, speed):
+        angle = self.angle
+        self._setVelocity(angle, speed)
+
+    @property
+    def angle(self):
+        return math.atan2(self.vx, -self.vy)
+
+    @angle.setter
+    def angle(self, angle):
+        self._setVelocity(angle, self.speed)
+
+    def _setVelocity(self, angle, speed):
+        self.vx = math.sin(angle) * speed
+        self.vy = -math.cos(angle) * speed
+
+    @property
+    def colour(self):
+        return tuple(int(c) for c in self._env.colour_array[self._index])
+
+    @colour.setter
+    def colour(self, colour):
+        self._env.colour_array[self._index] = colour
+
+    @property
+    def thickness(self):
+        return int(self._env.thickness[self._index])
+
+    @thickness.setter
+    def thickness(self, thickness):
+        self._env.thickness[self._index] = thickness
+
+    def move(self):
+        """ Update position based on speed, angle """
+        self.x += self.vx
+        self.y += self.vy
+
+    def experienceDrag(self):
+        self.vx *= self.drag
+        self.vy *= self.drag
+
+    def mouseMove(self, pos):
+        """ Change angle and speed to move towards a given point """
+        x, y = pos
+        self.vx = (x - self.x) * 0.1
+        self.vy = (y - self.y) * 0.1
+
+    def accelerate(self, vector):
+        """ Change angle and speed by a given vector """
+        (angle, length) = vector
+        self.vx += math.sin(angle) * length
+        self.vy -= math.cos(angle) * length
+
+class ParticleViews:
+    """ The list-like particles of an ArrayEnvironment, creating views as they are needed """
+
+    def __init__(self, env):
+        self._env = env
+        self._views = []
+
+    def __len__(self):
+        return len(self._env.x)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('particle index out of range')
+        if len(self._views) < n:
+            self._views.extend([None] * (n - len(self._views)))
+        view = self._views[index]
+        if view is None:
+            view = self._views[index] = ParticleView(self._env, index)
+        return view
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __contains__(self, view):
+        return (isinstance(view, ParticleView) and view._env is self._env and
+                view._index < len(self._views) and self._views[view._index] is view)
+
+    def remove(self, view):
+        if view not in self:
+            raise ValueError('particle not in environment')
+        self._env.deleteRows(numpy.array([view._index]))
+
+    def _deleteViews(self, indices):
+        """ Drops the views of deleted rows and renumbers the ones after them """
+
+        views = self._views
+        self._views = []
+        dead = set(int(i) for i in indices)
+        for i, view in enumerate(views):
+            if i in dead:
+                continue
+            if view is not None:
+                view._index = len(self._views)
+            self._views.append(view)
+
+class ArrayEnvironment(PyParticles.Environment):
+    """ An Environment that keeps particle state in NumPy arrays, one entry per particle,
+        and runs each registered function as a single vectorized kernel """
+
+    CHECKPOINT_LAYOUT = 'columns'
+
+    def __init__(self, bounds, seed=None, dtype=numpy.float64):
+        PyParticles.Environment.__init__(self, bounds)
+        self.rng = numpy.random.default_rng(seed)
+        self.removals = set()
+        # float32 halves the memory and bandwidth of the particle columns at some cost
+        # in precision, which driftReport measures
+        self.dtype = numpy.dtype(dtype).type
+        for name in FIELDS:
+            setattr(self, name, numpy.empty(0, dtype=self.dtype))
+        self.colour_array = numpy.empty((0, 3), dtype=numpy.uint8)
+        self.thickness = numpy.empty(0, dtype=numpy.int32)
+        # Handles of the particles, in increasing order since rows are only ever appended or deleted
+        self.ids = numpy.empty(0, dtype=numpy.int64)
+        self.particles = ParticleViews(self)
+
+        # Contacts are found with a grid, or with 'pairs' by testing every pair a tile at a time,
+        # which needs no more memory when particle sizes vary widely. attract always goes by tiles.
+        self.broadphase = 'grid'
+        self.tile_size = 256
+
+        self.function_dict = {
+        'move': (1, self.moveKernel),
+        'drag': (1, self.dragKernel),
+        'bounce': (1, self.bounceKernel),
+        'accelerate': (1, self.accelerateKernel),
+        'collide': (2, self.collideKernel),
+        'combine': (2, self.combineKernel),
+        'attract': (2, self.attractKernel),
+        'integrate': (1, self.integrateKernel)}
+
+    def addParticles(self, n=1, **kargs):
+        """ Add n particles with properties given by keyword arguments """
+
+        rng = self.rng
+        def column(name, default):
+            value = kargs.get(name)
+            if value is None:
+                return default()
+            return numpy.broadcast_to(numpy.asarray(value, dtype=self.dtype), (n,))
+
+        size = column('size', lambda: rng.integers(10, 20, n, endpoint=True).astype(self.dtype))
+        mass = column('mass', lambda: rng.integers(100, 10000, n, endpoint=True).astype(self.dtype))
+        x = column('x', lambda: rng.uniform(size, self.width - size))
+        y = column('y', lambda: rng.uniform(size, self.height - size))
+        speed = column('speed', lambda: rng.random(n))
+        angle = column('angle', lambda: rng.uniform(0, math.pi*2, n))
+        drag = (mass/(mass + self.mass_of_air)) ** size
+
+        new = {
+            'x': x, 'y': y,
+            'vx': numpy.sin(angle) * speed, 'vy': -numpy.cos(angle) * speed,
+            'size': size, 'mass': mass, 'drag': drag,
+            'particle_elasticity': numpy.full(n, 0.9)}
+        for name in FIELDS:
+            setattr(self, name, numpy.concatenate((getattr(self, name), new[name])).astype(self.dtype, copy=False))
+
+        colour = numpy.broadcast_to(numpy.asarray(kargs.get('colour', (0, 0, 255)), dtype=numpy.uint8), (n, 3))
+        self.colour_array = numpy.concatenate((self.colour_array, colour))
+        self.thickness = numpy.concatenate((self.thickness, numpy.zeros(n, dtype=numpy.int32)))
+        self.ids = numpy.concatenate((self.ids, numpy.arange(self.next_handle, self.next_handle + n)))
+        self.next_handle += n
+
+    def deleteRows(self, indices):
+        """ Removes the particles at the given indices """
+
+        for name in FIELDS:
+            setattr(self, name, numpy.delete(getattr(self, name), indices))
+        self.colour_array = numpy.delete(self.colour_array, indices, axis=0)
+        self.thickness = numpy.delete(self.thickness, indices)
+        self.ids = numpy.delete(self.ids, indices)
+        self.particles._deleteViews(indices)
+
+    def addParticle(self, particle):
+        """ Adds a copy of a Particle-like object and returns its handle """
+
+        self.addParticles(1, x=particle.x, y=particle.y, size=particle.size, mass=particle.mass,
+                          speed=particle.speed, angle=particle.angle, colour=particle.colour)
+        self.drag[-1] = particle.drag
+        self.particle_elasticity[-1] = particle.elasticity
+        return int(self.ids[-1])
+
+    def getParticle(self, handle):
+        """ Returns the view of the particle with the given handle, or None if it has been removed """
+
+        i = int(numpy.searchsorted(self.ids, handle))
+        if i < len(self.ids) and self.ids[i] == handle and handle not in self.removals:
+            return self.particles[i]
+        return None
+
+    def handleOf(self, view):
+        return int(self.ids[view._index])
+
+    def removeParticle(self, view):
+        """ Marks a particle for removal. Rows are deleted together at the next step boundary,
+            so a merge-heavy step costs one pass over the arrays rather than one per particle. """
+
+        if view not in self.particles:
+            return False
+        handle = self.handleOf(view)
+        if handle in self.removals:
+            return False
+        self.removals.add(handle)
+        return True
+
+    def compact(self):
+        """ Deletes the rows of all particles marked for removal """
+
+        if self.removals:
+            dead = numpy.flatnonzero(numpy.isin(self.ids, numpy.fromiter(self.removals, dtype=numpy.int64)))
+            self.removals = set()
+            self.deleteRows(dead)
+
+    def update(self):
+        """ Runs every registered function once over all particles """
+
+        self.compact()
+        PyParticles.Environment.update(self)
+
+    def updateStep(self):
+        for f in self.particle_functions1:
+            f()
+        for f in self.particle_functions2:
+            f()
+
+    def moveKernel(self):
+        self.x += self.vx
+        self.y += self.vy
+
+    def dragKernel(self):
+        self.vx *= self.drag
+        self.vy *= self.drag
+
+    def accelerateKernel(self):
+        (angle, length) = self.acceleration
+        self.vx += math.sin(angle) * length
+        self.vy -= math.cos(angle) * length
+
+    def integrateKernel(self):
+        """ Advances all particles by dt, as Environment.integrate does """
+
+        (angle, length) = self.acceleration
+        ax = math.sin(angle) * length
+        ay = -math.cos(angle) * length
+        # Particles without drag left stop where they are, see Integrators.dragRate
+        stopped = self.drag <= 0
+        k = numpy.log(numpy.where(stopped, 1, self.drag))
+        (x, y, vx, vy) = Integrators.getIntegrator(self.integrator)(
+            self.x, self.y, self.vx, self.vy, lambda x, y, vx, vy: (ax + k*vx, ay + k*vy), self.dt)
+        moving = ~stopped
+        self.x[moving] = x[moving]
+        self.y[moving] = y[moving]
+        self.vx[:] = numpy.where(stopped, 0, vx)
+        self.vy[:] = numpy.where(stopped, 0, vy)
+
+    def bounceKernel(self):
+        """ Reflects particles that have crossed the boundary of the environment """
+
+        x, y, size = self.x, self.y, self.size
+        right = x > self.width - size
+        left = ~right & (x < size)
+        x[right] = 2*(self.width - size[right]) - x[right]
+        x[left] = 2*size[left] - x[left]
+        hit = right | left
+        self.vx[hit] *= -self.elasticity
+        self.vy[hit] *= self.elasticity
+        if self.telemetry is not None:
+            self.telemetry.count(bounces=int(numpy.count_nonzero(hit)))
+
+        bottom = y > self.height - size
+        top = ~bottom & (y < size)
+        y[bottom] = 2*(self.height - size[bottom]) - y[bottom]
+        y[top] = 2*size[top] - y[top]
+        hit = bottom | top
+        self.vx[hit] *= self.elasticity
+        self.vy[hit] *= -self.elasticity
+        if self.telemetry is not None:
+            self.telemetry.count(bounces=int(numpy.count_nonzero(hit)))
+
+    def overlappingPairs(self):
+        """ Returns index arrays (i, j), i < j, of overlapping particles, sorted by i then j """
+
+        if len(self.x) < 2:
+            empty = numpy.empty(0, dtype=numpy.intp)
+            return empty, empty
+        if self.broadphase == 'pairs':
+            i, j = self.tiledOverlappingPairs()
+            if self.telemetry is not None:
+                n = len(self.x)
+                self.telemetry.count(n*(n - 1)//2, n*(n - 1)//2, len(i))
+            return i, j
+        reach = 2 * float(self.size.max()) or 1
+        i, j = candidatePairs(self.x, self.y, reach)
+        hit = numpy.hypot(self.x[i] - self.x[j], self.y[i] - self.y[j]) < self.size[i] + self.size[j]
+        if self.telemetry is not None:
+            self.telemetry.count(len(i), len(i), int(numpy.count_nonzero(hit)))
+        return i[hit], j[hit]
+
+    def tiledOverlappingPairs(self):
+        """ Returns the overlapping pairs found by testing every pair, a tile of tile_size by
+            tile_size particles at a time, so memory stays proportional to the number of particles """
+
+        n = len(self.x)
+        tile = self.tile_size
+        firsts = []
+        seconds = []
+        for start in range(0, n, tile):
+            rows = slice(start, min(start + tile, n))
+            for other in range(start, n, tile):
+                columns = slice(other, min(other + tile, n))
+                dist = numpy.hypot(self.x[rows, None] - self.x[None, columns], self.y[rows, None] - self.y[None, columns])
+                hit = dist < self.size[rows, None] + self.size[None, columns]
+                if other == start:
+                    hit = numpy.triu(hit, 1)
+                (a, b) = numpy.nonzero(hit)
+                firsts.append(a + start)
+                seconds.append(b + other)
+        i = numpy.concatenate(firsts)
+        j = numpy.concatenate(seconds)
+        pairs = numpy.lexsort((j, i))
+        return i[pairs], j[pairs]
+
+    def collideKernel(self):
+        """ Makes overlapping particles bounce, as PyParticles.collide does.
+            Pairs that share no particle are resolved together, the rest one at a time in index order. """
+
+        i, j = self.overlappingPairs()
+        self.resolveCollisions(i, j)
+
+    def resolveCollisions(self, i, j):
+        """ Applies the collide response to overlapping pairs (i, j) in index order """
+
+        if not len(i):
+            return
+        counts = numpy.bincount(numpy.concatenate((i, j)), minlength=len(self.x))
+        alone = (counts[i] == 1) & (counts[j] == 1)
+        self.collidePairs(i[alone], j[alone])
+        for a, b in zip(i[~alone], j[~alone]):
+            self.collidePairs(numpy.array([a]), numpy.array([b]))
+
+    def collidePairs(self, i, j):
+        """ Applies the collide response to pairs that share no particle """
+
+        x, y, vx, vy = self.x, self.y, self.vx, self.vy
+        dx = x[i] - x[j]
+        dy = y[i] - y[j]
+        dist = numpy.hypot(dx, dy)
+        safe = numpy.where(dist > 0, dist, 1)
+        nx = numpy.where(dist > 0, dx / safe, 1)
+        ny = numpy.where(dist > 0, dy / safe, 0)
+
+        m1 = self.mass[i]
+        m2 = self.mass[j]
+        total_mass = m1 + m2
+        speed2 = numpy.hypot(vx[j], vy[j])
+        vx1 = vx[i]*(m1 - m2)/total_mass + nx*2*speed2*m2/total_mass
+        vy1 = vy[i]*(m1 - m2)/total_mass + ny*2*speed2*m2/total_mass
+        speed1 = numpy.hypot(vx1, vy1)
+        vx2 = vx[j]*(m2 - m1)/total_mass - nx*2*speed1*m1/total_mass
+        vy2 = vy[j]*(m2 - m1)/total_mass - ny*2*speed1*m1/total_mass
+
+        elasticity = self.particle_elasticity[i] * self.particle_elasticity[j]
+        vx[i] = vx1 * elasticity
+        vy[i] = vy1 * elasticity
+        vx[j] = vx2 * elasticity
+        vy[j] = vy2 * elasticity
+
+        overlap = 0.5*(self.size[i] + self.size[j] - dist + 1)
+        x[i] += nx*overlap
+        y[i] += ny*overlap
+        x[j] -= nx*overlap
+        y[j] -= ny*overlap
+
+    def combineKernel(self):
+        """ Merges overlapping particles into the first of each pair, as PyParticles.combine does.
+            The absorbed particle is recorded as collide_with on the view of the first,
+            and removed at the end of the step if remove_merged is set. """
+
+        i, j = self.overlappingPairs()
+        removed = None
+        if self.remove_merged:
+            removed = set()
+            if self.removals:
+                dead = numpy.isin(self.ids, numpy.fromiter(self.removals, dtype=numpy.int64))
+                removed = set(numpy.flatnonzero(dead).tolist())
+        merged = self.combinePairs(i, j, removed)
+        for a, b in merged:
+            self.particles[a].collide_with = self.particles[b]
+            if self.remove_merged:
+                self.removals.add(int(self.ids[b]))
+        if self.telemetry is not None:
+            self.telemetry.count(merges=len(merged))
+
+    def combinePairs(self, i, j, removed=None):
+        """ Merges overlapping pairs (i, j) in index order and returns the merged pairs.
+            If removed is a set of indices, absorbed particles are added to it and
+            take no further part. """
+
+        x, y, vx, vy, mass = self.x, self.y, self.vx, self.vy, self.mass
+        merged = []
+        for a, b in zip(i.tolist(), j.tolist()):
+            # Earlier merges in this step may have moved the particles apart
+            if math.hypot(x[a] - x[b], y[a] - y[b]) >= self.size[a] + self.size[b]:
+                continue
+            if removed is not None and (a in removed or b in removed):
+                continue
+            total_mass = mass[a] + mass[b]
+            x[a] = (x[a]*mass[a] + x[b]*mass[b])/total_mass
+            y[a] = (y[a]*mass[a] + y[b]*mass[b])/total_mass
+            elasticity = self.particle_elasticity[a] * self.particle_elasticity[b]
+            vx[a] = (vx[a]*mass[a] + vx[b]*mass[b])/total_mass * elasticity
+            vy[a] = (vy[a]*mass[a] + vy[b]*mass[b])/total_mass * elasticity
+            mass[a] = total_mass
+            merged.append((a, b))
+            if removed is not None:
+                removed.add(b)
+        return merged
+
+    def attractKernel(self):
+        """ Accelerates every particle towards every other, as Particle.attract does.
+            Pairs are taken a tile of tile_size by tile_size particles at a time, each once for
+            both particles, so memory stays proportional to the number of particles. """
+
+        n = len(self.x)
+        tile = self.tile_size
+        mass = self.mass
+        ax = numpy.zeros_like(self.x)
+        ay = numpy.zeros_like(self.y)
+        for start in range(0, n, tile):
+            rows = slice(start, min(start + tile, n))
+            for other in range(start, n, tile):
+                columns = slice(other, min(other + tile, n))
+                (strength, dx, dy) = self.attractionTile(self.x[rows], self.y[rows], self.size[rows],
+                                                         numpy.arange(rows.start, rows.stop), columns)
+                towards = strength * mass[None, columns]
+                ax[rows] += (towards * dx).sum(axis=1)
+                ay[rows] += (towards * dy).sum(axis=1)
+                if other != start:
+                    # The columns are pulled back the other way. Sums run along contiguous rows,
+                    # so each particle's sum is the one attraction would compute for it.
+                    back = strength * mass[rows, None]
+                    ax[columns] += numpy.ascontiguousarray((back * -dx).T).sum(axis=1)
+                    ay[columns] += numpy.ascontiguousarray((back * -dy).T).sum(axis=1)
+        self.vx += ax
+        self.vy += ay
+
+    def attraction(self, x, y, size, rows):
+        """ Returns the accelerations towards every particle of particles at x, y, where rows are
+            their own indices, which they are not attracted to. The sums are the ones attractKernel
+            makes, taking the particles tile by tile. """
+
+        ax = numpy.zeros_like(x)
+        ay = numpy.zeros_like(y)
+        n = len(self.x)
+        for other in range(0, n, self.tile_size):
+            columns = slice(other, min(other + self.tile_size, n))
+            (strength, dx, dy) = self.attractionTile(x, y, size, rows, columns)
+            towards = strength * self.mass[None, columns]
+            ax += (towards * dx).sum(axis=1)
+            ay += (towards * dy).sum(axis=1)
+        return ax, ay
+
+    def attractionTile(self, x, y, size, rows, columns):
+        """ Returns G/d**3 and the offsets dx, dy from particles at x, y, whose own indices are rows,
+            to the particles of the slice columns. Touching pairs and particles themselves get 0. """
+
+        dx = self.x[None, columns] - x[:, None]
+        dy = self.y[None, columns] - y[:, None]
+        dist = numpy.hypot(dx, dy)
+        apart = dist >= self.size[None, columns] + size[:, None]
+        own = rows - columns.start
+        inside = numpy.flatnonzero((own >= 0) & (own < dist.shape[1]))
+        apart[inside, own[inside]] = False
+        strength = numpy.zeros_like(dist)
+        strength[apart] = PyParticles.GRAVITATIONAL_CONSTANT / dist[apart]**3
+        return strength, dx, dy
+
+    def kineticEnergy(self):
+        """ Returns the total kinetic energy of the particles, summed in float64 """
+
+        vx = self.vx.astype(numpy.float64)
+        vy = self.vy.astype(numpy.float64)
+        return float(0.5 * (self.mass.astype(numpy.float64) * (vx*vx + vy*vy)).sum())
+
+    def momentum(self):
+        """ Returns the total momentum (px, py) of the particles, summed in float64 """
+
+        mass = self.mass.astype(numpy.float64)
+        return float((mass * self.vx).sum()), float((mass * self.vy).sum())
+
+    def copy(self, dtype=None):
+        """ Returns an ArrayEnvironment with the same particles, settings, functions and random state,
+            storing its columns as dtype, by default the dtype of this one """
+
+        env = ArrayEnvironment((self.width, self.height), dtype=dtype or self.dtype)
+        env.rng.bit_generator.state = self.rng.bit_generator.state
+        for name in ('colour', 'mass_of_air', 'elasticity', 'acceleration', 'remove_merged', 'next_handle'):
+            setattr(env, name, getattr(self, name))
+        env.addFunctions(self.function_names)
+        for name in FIELDS:
+            setattr(env, name, getattr(self, name).astype(env.dtype))
+        env.colour_array = self.colour_array.copy()
+        env.thickness = self.thickness.copy()
+        env.ids = self.ids.copy()
+        env.removals = set(self.removals)
+        return env
+
+    def driftReport(self, steps=100):
+        """ Runs a copy of the environment and a float64 copy for a number of steps, and returns how far
+            the first drifts from the second. The energy error is relative to the reference energy,
+            the momentum error relative to the sum of the particles' momentum magnitudes, and the
+            position error is the largest distance between the two copies of a particle. """
+
+        trial = self.copy()
+        reference = self.copy(numpy.float64)
+        for step in range(steps):
+            trial.update()
+            reference.update()
+
+        energy = trial.kineticEnergy()
+        reference_energy = reference.kineticEnergy()
+        (px, py) = trial.momentum()
+        (rx, ry) = reference.momentum()
+        scale = float((reference.mass * numpy.hypot(reference.vx, reference.vy)).sum())
+        common, i, j = numpy.intersect1d(trial.ids, reference.ids, assume_unique=True, return_indices=True)
+        positions = numpy.hypot(trial.x[i] - reference.x[j], trial.y[i] - reference.y[j])
+
+        return {
+            'dtype': numpy.dtype(self.dtype).name,
+            'steps': steps,
+            'energy': energy,
+            'reference_energy': reference_energy,
+            'energy_error': abs(energy - reference_energy) / reference_energy if reference_energy else 0.0,
+            'momentum': (px, py),
+            'reference_momentum': (rx, ry),
+            'momentum_error': math.hypot(px - rx, py - ry) / scale if scale else 0.0,
+            'position_error': float(positions.max()) if len(positions) else 0.0,
+            'particles': len(trial.x),
+            'reference_particles': len(reference.x)}
+
+    def save(self, path):
+        """ Writes the particle columns, settings, registered functions and random state to a checkpoint file """
+
+        self.compact()
+        header = self.checkpointHeader()
+        header['settings']['dtype'] = numpy.dtype(self.dtype).name
+        header['random'] = self.rng.bit_generator.state
+        columns = [(name, getattr(self, name)) for name in FIELDS]
+        columns += [('colour', self.colour_array), ('thickness', self.thickness), ('ids', self.ids)]
+        PyParticles.writeCheckpoint(path, header, [(name, column.dtype.str, column.shape, numpy.ascontiguousarray(column))
+                                                   for (name, column) in columns])
+
+    @classmethod
+    def load(cls, path, **kargs):
+        """ Returns an environment restored from a checkpoint file written by save, created with
+            any further keyword arguments. The columns are mapped copy-on-write from the file,
+            so only the pages of the file that are used get read, and changes stay in memory. """
+
+        with open(path, 'rb') as f:
+            (header, start) = PyParticles.readCheckpointHeader(f)
+            if header['layout'] != cls.CHECKPOINT_LAYOUT:
+                raise ValueError("Checkpoint of %s, not %s" % (header['layout'], cls.CHECKPOINT_LAYOUT))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        columns = {}
+        for entry in header['columns']:
+            shape = tuple(entry['shape'])
+            columns[entry['name']] = numpy.frombuffer(data, dtype=entry['type'], count=math.prod(shape),
+                                                      offset=start + entry['offset']).reshape(shape)
+
+        settings = header['settings']
+        env = cls((settings['width'], settings['height']), dtype=settings.pop('dtype'), **kargs)
+        env.applyCheckpointHeader(header)
+        for name in FIELDS:
+            setattr(env, name, columns[name])
+        env.colour_array = columns['colour']
+        env.thickness = columns['thickness']
+        env.ids = columns['ids']
+        env.rng.bit_generator.state = header['random']
+        return env
+
+    def recordColumns(self, fields):
+        """ Returns copies of the fields of the particles for a TrajectoryRecorder, each as (type, array) """
+
+        keep = slice(None)
+        if self.removals:
+            keep = ~numpy.isin(self.ids, numpy.fromiter(self.removals, dtype=numpy.int64))
+        columns = {}
+        for name in fields:
+            if name == 'id':
+                column = self.ids[keep]
+            elif name == 'speed':
+                column = numpy.hypot(self.vx[keep], self.vy[keep])
+            elif name == 'angle':
+                column = numpy.arctan2(self.vx[keep], -self.vy[keep])
+            else:
+                column = getattr(self, name)[keep]
+            column = numpy.array(column, copy=True)
+            columns[name] = (column.dtype.str, column)
+        return columns
+
+    def bytesPerParticle(self):
+        """ Returns the bytes of array storage used by each particle """
+        columns = [getattr(self, name) for name in FIELDS]
+        columns += [self.colour_array, self.thickness, self.ids]
+        return sum(column.itemsize * (column.shape[1] if column.ndim > 1 else 1) for column in columns)
+
+    # The queries scan the arrays rather than keep a SpatialIndex, which a vectorized scan outruns
+
+    def moveParticle(self, view, x, y):
+        """ Moves a particle to x, y, as Environment.moveParticle does """
+        view.x = x
+        view.y = y
+
+    def findParticle(self, x, y):
+        """ Returns the particle that occupies position x, y with the nearest centre, or None """
+
+        dist = numpy.hypot(self.x - x, self.y - y)
+        hits = numpy.flatnonzero(dist <= self.size)
+        if len(hits):
+            return self.particles[int(hits[numpy.argmin(dist[hits])])]
+        return None
+
+    def findParticlesInRadius(self, x, y, radius):
+        """ Returns the particles whose centre is within radius of x, y """
+        hits = numpy.flatnonzero((self.x - x)**2 + (self.y - y)**2 <= radius * radius)
+        return [self.particles[int(i)] for i in hits]
+
+    def findParticlesInRect(self, x0, y0, x1, y1):
+        """ Returns the particles whose centre lies in the rectangle from x0, y0 to x1, y1 """
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+        hits = numpy.flatnonzero((self.x >= x0) & (self.x <= x1) & (self.y >= y0) & (self.y <= y1))
+        return [self.particles[int(i)] for i in hits]
+
+    def findNearestParticles(self, x, y, k=1):
+        """ Returns the k particles with centres nearest to x, y, nearest first """
+
+        k = min(k, len(self.x))
+        if k <= 0:
+            return []
+        dist = (self.x - x)**2 + (self.y - y)**2
+        nearest = numpy.argpartition(dist, k - 1)[:k]
+        nearest = nearest[numpy.argsort(dist[nearest], kind='stable')]
+        return [self.particles[int(i)] for i in nearest]
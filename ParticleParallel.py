@@ -0,0 +1,359 @@
+import os, traceback
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import numpy
+import ParticleArrays
+from ParticleArrays import FIELDS
+
+# The functions a ParallelEnvironment can split between its workers
+PARALLEL_FUNCTIONS = ('move', 'drag', 'bounce', 'accelerate', 'integrate', 'collide', 'combine', 'attract')
+
+# Attributes of the environment that workers copy before each task
+WORKER_SETTINGS = ('width', 'height', 'elasticity', 'acceleration', 'remove_merged',
+                   'integrator', 'dt', 'broadphase', 'tile_size')
+
+# Rows of the attraction matrix a worker computes at a time
+ATTRACT_ROWS = 256
+
+# Bytes per particle in a shared block besides the fields: its row in the
+# ArrayEnvironment and a flag that is cleared when combine absorbs it
+EXTRA_BYTES = 9
+
+def sharedColumns(block, capacity, dtype):
+    """ Returns the particle columns laid out one after another in a shared memory block """
+
+    itemsize = numpy.dtype(dtype).itemsize
+    columns = {}
+    for k, name in enumerate(FIELDS):
+        columns[name] = numpy.ndarray((capacity,), dtype=dtype, buffer=block.buf, offset=k*capacity*itemsize)
+    offset = len(FIELDS)*capacity*itemsize
+    columns['rank'] = numpy.ndarray((capacity,), dtype=numpy.int64, buffer=block.buf, offset=offset)
+    columns['alive'] = numpy.ndarray((capacity,), dtype=numpy.uint8, buffer=block.buf, offset=offset + 8*capacity)
+    return columns
+
+def contactPairs(env, columns, lo, hi, own=None, mid=None):
+    """ Returns the overlapping pairs among rows lo to hi that a task takes, relative to lo and in
+        the orientation and order the serial kernels give them. Pairs that share a particle are
+        resolved one after another, so each group of such pairs is taken whole: by the task for
+        the strip own = (first, last row) if the group lies inside it, otherwise by the task for
+        the border before row mid that it crosses. """
+
+    i, j = env.overlappingPairs()
+    if own is not None:
+        keep = (i >= own[0] - lo) & (j < own[1] - lo)
+    else:
+        keep = (i < mid - lo) & (j >= mid - lo)
+
+    counts = numpy.bincount(numpy.concatenate((i, j)), minlength=hi - lo)
+    alone = (counts[i] == 1) & (counts[j] == 1)
+    shared = numpy.flatnonzero(~alone)
+    parent = {}
+    def find(a):
+        while parent.get(a, a) != a:
+            a = parent[a]
+        return a
+    for a, b in zip(i[shared].tolist(), j[shared].tolist()):
+        (a, b) = (find(a), find(b))
+        if a != b:
+            parent[a] = b
+    groups = numpy.array([find(a) for a in i[shared].tolist()], dtype=numpy.int64)
+    if own is not None:
+        whole = ~numpy.isin(groups, groups[~keep[shared]])
+    else:
+        whole = numpy.isin(groups, groups[keep[shared]])
+    selected = keep & alone
+    selected[shared] = whole
+    i, j = i[selected], j[selected]
+
+    rank = columns['rank'][lo:hi]
+    swap = rank[i] > rank[j]
+    i, j = numpy.where(swap, j, i), numpy.where(swap, i, j)
+    sequence = numpy.lexsort((rank[j], rank[i]))
+    return i[sequence], j[sequence]
+
+def runTask(env, columns, task, settings):
+    """ Runs one task of a step on the rows lo to hi of the shared columns.
+
+        'singles' runs the particle functions, 'attract' accelerates the rows towards all n particles.
+        'detect' finds, before any particle is changed, the contacts inside the strip own and those
+        across the border = (first row, mid, last row) after it. A contact function's task then
+        resolves the contacts inside the strip, or with a border those across it. """
+
+    (phase, lo, hi, own, border, n) = task
+    (values, names) = settings
+    for (name, value) in zip(WORKER_SETTINGS, values):
+        setattr(env, name, value)
+
+    if phase == 'attract':
+        # Attract towards the particles in the order of the ArrayEnvironment, so that the
+        # accelerations are summed exactly as the serial kernel sums them
+        rank = columns['rank']
+        serial = numpy.argsort(rank[:n])
+        for name in ('x', 'y', 'size', 'mass'):
+            setattr(env, name, columns[name][:n][serial])
+        for start in range(lo, hi, ATTRACT_ROWS):
+            end = min(start + ATTRACT_ROWS, hi)
+            ax, ay = env.attraction(columns['x'][start:end], columns['y'][start:end],
+                                    columns['size'][start:end], rank[start:end])
+            columns['vx'][start:end] += ax
+            columns['vy'][start:end] += ay
+        return None
+
+    for name in FIELDS:
+        setattr(env, name, columns[name][lo:hi])
+
+    if phase == 'singles':
+        for name in names:
+            env.function_dict[name][1]()
+        return None
+
+    if phase == 'detect':
+        env.pending = {'inside': (lo, hi) + contactPairs(env, columns, lo, hi, own=own)}
+        if border is not None:
+            (lo, mid, hi) = border
+            for name in FIELDS:
+                setattr(env, name, columns[name][lo:hi])
+            env.pending['border'] = (lo, hi) + contactPairs(env, columns, lo, hi, mid=mid)
+        return None
+
+    (lo, hi, i, j) = env.pending['inside' if border is None else 'border']
+    for name in FIELDS:
+        setattr(env, name, columns[name][lo:hi])
+    if phase == 'collide':
+        env.resolveCollisions(i, j)
+        return None
+
+    alive = columns['alive'][lo:hi]
+    removed = set(numpy.flatnonzero(alive == 0).tolist()) if env.remove_merged else None
+    merged = env.combinePairs(i, j, removed)
+    if env.remove_merged and merged:
+        alive[[b for a, b in merged]] = 0
+    return [(a + lo, b + lo) for a, b in merged]
+
+def work(connection):
+    """ The loop of a worker process, which runs tasks on the columns of the block it is attached to """
+
+    block = None
+    columns = None
+    env = ParticleArrays.ArrayEnvironment((1, 1))
+    while True:
+        message = connection.recv()
+        if message[0] == 'stop':
+            break
+        try:
+            if message[0] == 'attach':
+                (name, capacity, dtype) = message[1:]
+                # Views into the old block have to go before it can be closed
+                for field in FIELDS:
+                    setattr(env, field, numpy.empty(0, dtype=dtype))
+                columns = None
+                if block is not None:
+                    block.close()
+                block = shared_memory.SharedMemory(name=name)
+                columns = sharedColumns(block, capacity, dtype)
+                connection.send(('ok', None))
+            else:
+                connection.send(('ok', runTask(env, columns, message[1], message[2])))
+        except Exception:
+            connection.send(('error', traceback.format_exc()))
+
+    for field in FIELDS:
+        setattr(env, field, numpy.empty(0))
+    columns = None
+    if block is not None:
+        block.close()
+    connection.close()
+
+class ParallelEnvironment(ParticleArrays.ArrayEnvironment):
+    """ An ArrayEnvironment whose steps are split between worker processes.
+
+        Each step the particle columns are copied into shared memory. The workers run the particle
+        functions on equal slices, then the particles are sorted by x and cut into vertical strips,
+        one per worker, at least a contact distance wide. Each worker finds the contacts inside its
+        strip and across the border after it before any particle moves, then resolves them in three
+        phases: inside the strips, across the borders after even strips, then after odd strips, so
+        no two workers touch the same particle at once.
+        attract gives each worker the rows of its strip against all particles.
+
+        Contacts are resolved in the same order as by the serial kernels, so results match an
+        ArrayEnvironment, unless a chain of touching particles spans a whole strip. """
+
+    def __init__(self, bounds, workers=None, seed=None, dtype=numpy.float64):
+        ParticleArrays.ArrayEnvironment.__init__(self, bounds, seed, dtype)
+        self.workers = workers or os.cpu_count() or 1
+        self.processes = []
+        self.connections = []
+        self.block = None
+        self.columns = None
+        self.capacity = 0
+        # Rows of the shared columns in the order of the particle arrays, after the last sort
+        self.order = None
+        self.strips = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """ Starts the worker processes """
+
+        if self.processes:
+            return
+        # Workers share the tracker of this process, so that a worker exiting does not
+        # unlink the blocks it was attached to
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context()
+        for k in range(self.workers):
+            (parent, child) = context.Pipe()
+            process = context.Process(target=work, args=(child,), daemon=True)
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self.connections.append(parent)
+
+    def close(self):
+        """ Stops the worker processes and frees the shared memory """
+
+        for connection in self.connections:
+            connection.send(('stop',))
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+        self.freeBlock()
+
+    def freeBlock(self):
+        self.columns = None
+        if self.block is not None:
+            self.block.close()
+            self.block.unlink()
+            self.block = None
+        self.capacity = 0
+
+    def reserve(self, n):
+        """ Makes the shared block large enough for n particles and attaches the workers to it """
+
+        if n <= self.capacity and self.columns['x'].dtype == self.dtype:
+            return
+        capacity = max(n, 2 * self.capacity, 1024)
+        size = capacity * (len(FIELDS) * numpy.dtype(self.dtype).itemsize + EXTRA_BYTES)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        for connection in self.connections:
+            connection.send(('attach', block.name, capacity, self.dtype))
+        self.collect(self.connections)
+        self.freeBlock()
+        self.block = block
+        self.columns = sharedColumns(block, capacity, self.dtype)
+        self.capacity = capacity
+
+    def collect(self, connections):
+        """ Receives the reply of every connection, then raises if any worker failed, so that
+            no reply is left unread for the next task """
+
+        replies = [connection.recv() for connection in connections]
+        errors = [result for (status, result) in replies if status == 'error']
+        if errors:
+            raise RuntimeError("Worker failed:\n" + '\n'.join(errors))
+        return [result for (status, result) in replies]
+
+    def runTasks(self, tasks):
+        """ Hands the k-th task to the k-th worker, skipping None, and waits for all of them """
+
+        settings = ([getattr(self, name) for name in WORKER_SETTINGS],
+                    [name for name in self.function_names if self.function_dict[name][0] == 1])
+        busy = []
+        for connection, task in zip(self.connections, tasks):
+            if task is not None:
+                connection.send(('run', task, settings))
+                busy.append(connection)
+        return self.collect(busy)
+
+    def stripStarts(self, x):
+        """ Returns the first row of each strip of the x-sorted particles, and n at the end.
+            Strips hold equal numbers of particles, but are merged where one would be narrower
+            than the contact distance, so that contacts only ever cross into the next strip. """
+
+        n = len(x)
+        reach = 2 * float(self.size.max()) + 1
+        starts = [0]
+        for k in range(1, self.workers):
+            row = k * n // self.workers
+            if x[row] - x[starts[-1]] >= reach and x[-1] - x[row] >= reach:
+                starts.append(row)
+        starts.append(n)
+        return starts
+
+    def updateStep(self):
+        unsupported = [name for name in self.function_names if name not in PARALLEL_FUNCTIONS]
+        if unsupported:
+            raise ValueError("Parallel updates cannot simulate: %s" % ', '.join(unsupported))
+        n = len(self.x)
+        if not n or not self.function_names:
+            return
+
+        self.start()
+        self.reserve(n)
+        columns = self.columns
+        # Gather the particles in the order of the last sort, which they have mostly kept
+        order = self.order
+        if order is None or len(order) != n:
+            order = numpy.arange(n)
+        for name in FIELDS:
+            columns[name][:n] = getattr(self, name)[order]
+        columns['rank'][:n] = order
+        columns['alive'][:n] = 1
+
+        workers = min(self.workers, n)
+        if self.particle_functions1:
+            bounds = [k * n // workers for k in range(workers + 1)]
+            self.runTasks([('singles', bounds[k], bounds[k+1], None, None, n) for k in range(workers)])
+
+        merged = []
+        pair_names = [name for name in self.function_names if self.function_dict[name][0] == 2]
+        if pair_names:
+            # The stable sort is quick on the nearly sorted columns
+            local = numpy.argsort(columns['x'][:n], kind='stable')
+            for name in FIELDS:
+                columns[name][:n] = columns[name][:n][local]
+            order = order[local]
+            columns['rank'][:n] = order
+            x = columns['x'][:n]
+            starts = self.stripStarts(x)
+            strips = len(starts) - 1
+            self.strips = strips
+            # Each strip's contacts are found among its rows and those of the neighbouring
+            # particles they can reach, so that groups crossing a border are seen to do so
+            reach = 2 * float(self.size.max())
+            halos = [(int(numpy.searchsorted(x, x[starts[k]] - reach)),
+                      int(numpy.searchsorted(x, x[starts[k+1] - 1] + reach, 'right'))) for k in range(strips)]
+            for name in pair_names:
+                if name == 'attract':
+                    self.runTasks([('attract', starts[k], starts[k+1], None, None, n) for k in range(strips)])
+                    continue
+                # Worker k takes strip k and the border after it
+                own = [(starts[k], starts[k+1]) for k in range(strips)]
+                borders = [(starts[k], starts[k+1], starts[k+2]) if k + 1 < strips else None
+                           for k in range(strips)]
+                self.runTasks([('detect', halos[k][0], halos[k][1], own[k], borders[k], n) for k in range(strips)])
+                phases = [[(name, 0, 0, None, None, n) for k in range(strips)],
+                          [(name, 0, 0, None, borders[k], n) if k % 2 == 0 and borders[k] else None
+                           for k in range(strips)],
+                          [(name, 0, 0, None, borders[k], n) if k % 2 == 1 and borders[k] else None
+                           for k in range(strips)]]
+                for tasks in phases:
+                    for result in self.runTasks(tasks):
+                        merged.extend(result or ())
+
+        for name in FIELDS:
+            getattr(self, name)[order] = columns[name][:n]
+        self.order = order
+
+        for a, b in merged:
+            (a, b) = (int(order[a]), int(order[b]))
+            self.particles[a].collide_with = self.particles[b]
+            if self.remove_merged:
+                self.removals.add(int(self.ids[b]))
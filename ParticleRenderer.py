@@ -0,0 +1,167 @@
+""" Draws the particles of a PyParticles environment with pygame """
+
+import collections, operator
+import numpy
+import pygame
+import pygame.surfarray
+
+# Colours the background of a stamp is keyed out with; the second is used for particles of the first colour
+STAMP_KEYS = ((255, 0, 255), (0, 255, 0))
+
+class ParticleRenderer:
+    """ Draws particles from stamps: each (radius, colour, thickness) is drawn once into a small surface,
+        the max_stamps most recently used of which are kept, and a frame is put on screen with a single
+        Surface.blits call. Particles less than 2 pixels across are written straight into the pixels
+        as 2 by 2 squares, before the stamps. Stamps cover the same pixels pygame.draw.circle would.
+
+        Particles off the surface are left out, and particles under density_radius pixels in radius,
+        such as stars when zoomed out, are summed into the pixel they fall in, their colour times
+        density_gain each, so a frame costs about as much as the pixels it fills. """
+
+    def __init__(self, max_stamps=256):
+        self.stamps = collections.OrderedDict()
+        self.max_stamps = max_stamps
+        self.density_radius = 0.5
+        self.density_gain = 1.0
+        self.stats = {'hits': 0, 'misses': 0, 'blits': 0, 'points': 0, 'splats': 0, 'culled': 0}
+
+    def getStamp(self, radius, colour, thickness):
+        """ Returns the stamp of a circle, centred at (radius, radius) """
+
+        key = (radius, colour, thickness)
+        stamp = self.stamps.get(key)
+        if stamp is not None:
+            self.stamps.move_to_end(key)
+            self.stats['hits'] += 1
+            return stamp
+
+        self.stats['misses'] += 1
+        background = STAMP_KEYS[1] if tuple(colour[:3]) == STAMP_KEYS[0] else STAMP_KEYS[0]
+        stamp = pygame.Surface((2*radius + 1, 2*radius + 1))
+        stamp.fill(background)
+        pygame.draw.circle(stamp, colour, (radius, radius), radius, thickness)
+        if pygame.display.get_surface() is not None:
+            stamp = stamp.convert()
+        stamp.set_colorkey(background, pygame.RLEACCEL)
+        self.stamps[key] = stamp
+        if len(self.stamps) > self.max_stamps:
+            self.stamps.popitem(last=False)
+        return stamp
+
+    def draw(self, surface, env, scale=1.0, offset=(0, 0), origin=(0, 0)):
+        """ Draws the particles of env onto surface, a particle at x, y at origin + (offset + (x, y)) * scale """
+
+        if hasattr(env, 'colour_array'):
+            # The columns of an ArrayEnvironment
+            self.drawColumns(surface, env.x, env.y, env.size, env.colour_array, env.thickness, scale, offset, origin)
+        elif env.particles:
+            (x, y, size, colours, thickness) = zip(*map(operator.attrgetter('x', 'y', 'size', 'colour', 'thickness'),
+                                                        env.particles))
+            self.drawColumns(surface, x, y, size, colours, thickness, scale, offset, origin)
+
+    def drawColumns(self, surface, x, y, size, colours, thickness, scale=1.0, offset=(0, 0), origin=(0, 0)):
+        """ Draws particles given as sequences of positions, sizes, colours and thicknesses.
+            colours may also be an array with a row per particle, converted only for those on the surface. """
+
+        (ox, oy) = offset
+        (cx, cy) = origin
+        # The pixel positions and radii int() would give
+        x = (cx + (ox + numpy.asarray(x, dtype=numpy.float64)) * scale).astype(numpy.int64)
+        y = (cy + (oy + numpy.asarray(y, dtype=numpy.float64)) * scale).astype(numpy.int64)
+        exact = numpy.asarray(size, dtype=numpy.float64) * scale
+        radius = exact.astype(numpy.int64)
+        thickness = numpy.asarray(thickness, dtype=numpy.int64)
+
+        # Leave out particles that cannot touch the surface, 2 by 2 squares reaching one pixel right and down
+        (width, height) = surface.get_size()
+        reach = numpy.maximum(radius, 1)
+        visible = numpy.flatnonzero((x + reach >= 0) & (x - reach < width) & (y + reach >= 0) & (y - reach < height))
+        self.stats['culled'] = len(x) - len(visible)
+        if len(visible) < len(x):
+            (x, y, exact, radius, thickness) = (x[visible], y[visible], exact[visible], radius[visible], thickness[visible])
+            colours = colours[visible] if isinstance(colours, numpy.ndarray) else [colours[i] for i in visible.tolist()]
+
+        # Number the colours, then group the particles by what their stamp shows
+        if isinstance(colours, numpy.ndarray):
+            rgb = colours.astype(numpy.int64)
+            (codes, colour_ids) = numpy.unique((rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2], return_inverse=True)
+            colour_ids = colour_ids.reshape(-1)
+            palette = [(code >> 16, (code >> 8) & 255, code & 255) for code in codes.tolist()]
+        else:
+            numbers = dict.fromkeys(colours)
+            palette = list(numbers)
+            numbers = dict(zip(palette, range(len(palette))))
+            colour_ids = numpy.fromiter(map(numbers.__getitem__, colours), dtype=numpy.int64, count=len(x))
+
+        tiny = exact < self.density_radius
+        splats = numpy.flatnonzero(tiny & (x >= 0) & (x < width) & (y >= 0) & (y < height))
+        if len(splats):
+            self.drawDensity(surface, x[splats], y[splats], colour_ids[splats], palette)
+        self.stats['splats'] = len(splats)
+
+        small = (radius < 2) & ~tiny
+        points = numpy.flatnonzero(small)
+        if len(points):
+            self.drawPoints(surface, x[points], y[points], colour_ids[points], palette)
+
+        circles = numpy.flatnonzero(radius >= 2)
+        r = radius[circles]
+        if len(circles):
+            # One number per kind of stamp, from its radius, colour and thickness
+            widths = int(thickness.max()) + 1
+            kinds = (r * len(palette) + colour_ids[circles]) * widths + thickness[circles]
+            (kinds, kind_of) = numpy.unique(kinds, return_inverse=True)
+            shades = palette
+            if surface.get_bitsize() == 8:
+                # A blit onto a palette surface picks its own nearest entry, so draw the stamps in
+                # the entry pygame.draw would use
+                shades = [tuple(surface.unmap_rgb(surface.map_rgb(colour)))[:3] for colour in palette]
+            stamps = numpy.empty(len(kinds), dtype=object)
+            for k, kind in enumerate(kinds.tolist()):
+                (kind, width) = divmod(kind, widths)
+                (radius_of, colour) = divmod(kind, len(palette))
+                stamps[k] = self.getStamp(radius_of, shades[colour], width)
+            positions = zip((x[circles] - r).tolist(), (y[circles] - r).tolist())
+            surface.blits(list(zip(stamps[kind_of.reshape(-1)].tolist(), positions)), False)
+
+        self.stats['blits'] = len(circles)
+        self.stats['points'] = len(points)
+
+    def drawDensity(self, surface, x, y, colour_ids, palette):
+        """ Adds the colours of particles at pixels x, y to those pixels, saturating at white """
+
+        height = surface.get_height()
+        (cells, cell_of) = numpy.unique(x * height + y, return_inverse=True)
+        cell_of = cell_of.reshape(-1)
+        weights = numpy.array([colour[:3] for colour in palette], dtype=numpy.float64)[colour_ids] * self.density_gain
+        light = numpy.stack([numpy.bincount(cell_of, weights=weights[:, c], minlength=len(cells)) for c in range(3)], axis=1)
+        (cx, cy) = divmod(cells, height)
+        try:
+            pixels = pygame.surfarray.pixels3d(surface)
+        except ValueError:
+            # Surfaces of 8 bits per pixel have no array of colours
+            for (px, py, rgb) in zip(cx.tolist(), cy.tolist(), light.tolist()):
+                surface.set_at((px, py), [min(int(a + b), 255) for (a, b) in zip(surface.get_at((px, py)), rgb)])
+            return
+        pixels[cx, cy] = numpy.minimum(pixels[cx, cy] + light, 255).astype(numpy.uint8)
+        del pixels
+
+    def drawPoints(self, surface, x, y, colour_ids, palette):
+        """ Writes 2 by 2 squares of pixels with their top left corners at x, y """
+
+        mapped = numpy.array([surface.map_rgb(colour) for colour in palette], dtype=numpy.int64)[colour_ids]
+        try:
+            pixels = pygame.surfarray.pixels2d(surface)
+        except ValueError:
+            # Surfaces of 24 bits per pixel cannot be viewed as an array
+            for (px, py, colour) in zip(x.tolist(), y.tolist(), colour_ids.tolist()):
+                surface.fill(palette[colour], (px, py, 2, 2))
+            return
+        # The four pixels of each square in particle order, so later particles cover earlier ones
+        (width, height) = pixels.shape
+        x = (x[:, None] + numpy.array([0, 1, 0, 1])).reshape(-1)
+        y = (y[:, None] + numpy.array([0, 0, 1, 1])).reshape(-1)
+        mapped = numpy.repeat(mapped, 4)
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        pixels[x[inside], y[inside]] = mapped[inside].astype(pixels.dtype)
+        del pixels
@@ -1,4 +1,97 @@
-import math, random
+import array, gc, heapq, itertools, json, math, mmap, operator, queue, random, struct, sys, textwrap, threading
+import Integrators, Telemetry
+
+# Pair functions that only act on overlapping particles, so a broadphase may skip distant pairs
+CONTACT_FUNCTIONS = ('collide', 'combine')
+
+# Strength of the attraction between two particles, see Particle.attract
+GRAVITATIONAL_CONSTANT = 0.2
+
+# The functions an event-driven Environment can simulate exactly
+EVENT_FUNCTIONS = ('move', 'bounce', 'collide')
+
+# The functions a multi-rate Environment can advance by several steps at once
+MULTIRATE_FUNCTIONS = ('move', 'drag', 'accelerate', 'bounce', 'collide', 'combine', 'attract')
+
+# Half of the 8-neighbourhood, so that each pair of adjacent grid cells is visited once
+GRID_NEIGHBOURS = ((1, 0), (-1, 1), (0, 1), (1, 1))
+
+# A NeighbourGrid searches this fraction of the largest particle size beyond the reach of a
+# particle, so that contacts can push it that far before its cells are searched again. Its cells
+# are NEIGHBOUR_CELLS times the grid cell size, so that the search lies in 2 x 2 of them.
+NEIGHBOUR_SLACK = 0.5
+NEIGHBOUR_CELLS = 2.5
+
+# A checkpoint file starts with CHECKPOINT_MAGIC, the length of its JSON header as 8 bytes
+# and the header, followed by the columns the header lists. Each column starts at a multiple
+# of CHECKPOINT_ALIGN bytes after the header, so that it can be mapped straight into an array.
+CHECKPOINT_MAGIC = b'PYPCKPT1'
+CHECKPOINT_ALIGN = 64
+
+# Array typecodes of the column types of a checkpoint
+CHECKPOINT_TYPES = {'f8': 'd', 'f4': 'f', 'i8': 'q', 'i4': 'i', 'u1': 'B'}
+
+# A trajectory file starts with TRAJECTORY_MAGIC, the length of its JSON header as 8 bytes and
+# the header. Chunks follow, each the length of its JSON header, the header and its columns.
+TRAJECTORY_MAGIC = b'PYPTRAJ1'
+
+# The values a TrajectoryRecorder can record, with their array typecodes
+RECORD_FIELDS = {'id': 'q', 'x': 'd', 'y': 'd', 'speed': 'd', 'angle': 'd',
+                 'vx': 'd', 'vy': 'd', 'size': 'd', 'mass': 'd'}
+
+def objectSize(obj):
+    """ Returns the bytes used by an object, its attribute dictionary and the numbers it holds """
+    size = sys.getsizeof(obj)
+    for ref in gc.get_referents(obj):
+        if isinstance(ref, dict):
+            size += sys.getsizeof(ref)
+            size += sum(sys.getsizeof(value) for value in ref.values() if type(value) is float)
+        elif type(ref) is float:
+            size += sys.getsizeof(ref)
+    return size
+
+def checkpointType(typecode):
+    """ Returns the checkpoint column type of an array typecode, in the byte order of this machine """
+    kind = {code: kind for kind, code in CHECKPOINT_TYPES.items()}[typecode]
+    if kind == 'u1':
+        return '|u1'
+    return ('<' if sys.byteorder == 'little' else '>') + kind
+
+def writeCheckpoint(path, header, columns):
+    """ Writes a checkpoint of a header dictionary and columns, a list of (name, type, shape, data),
+        where data is any contiguous buffer """
+
+    entries = []
+    buffers = []
+    offset = 0
+    for (name, kind, shape, data) in columns:
+        data = memoryview(data)
+        if data.nbytes:
+            # Empty columns, such as the (0, 3) colours of no particles, cannot be cast
+            data = data.cast('B')
+        offset = -(-offset // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+        entries.append({'name': name, 'type': kind, 'shape': list(shape), 'offset': offset})
+        buffers.append((offset, data))
+        offset += data.nbytes
+
+    text = json.dumps(dict(header, columns=entries)).encode()
+    start = len(CHECKPOINT_MAGIC) + 8 + len(text)
+    start = -(-start // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
+    with open(path, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC + struct.pack('<Q', len(text)) + text)
+        for (offset, data) in buffers:
+            f.write(bytes(start + offset - f.tell()))
+            f.write(data)
+
+def readCheckpointHeader(f):
+    """ Reads the header of an open checkpoint file. Returns the header and the position its columns start at. """
+
+    if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+        raise ValueError("Not a particle checkpoint")
+    (length,) = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(length))
+    start = len(CHECKPOINT_MAGIC) + 8 + length
+    return header, -(-start // CHECKPOINT_ALIGN) * CHECKPOINT_ALIGN
 
 def addVectors(v1, v2):
     """ Returns the sum of two vectors """
@@ -14,13 +107,21 @@ def addVectors(v1, v2):
 
 def combine(p1, p2):
     if math.hypot(p1.x - p2.x, p1.y - p2.y) < p1.size + p2.size:
-        total_mass = p1.mass + p2.mass
-        p1.x = (p1.x*p1.mass + p2.x*p2.mass)/total_mass
-        p1.y = (p1.y*p1.mass + p2.y*p2.mass)/total_mass
-        (p1.angle, p1.speed) = addVectors((p1.angle, p1.speed*p1.mass/total_mass), (p2.angle, p2.speed*p2.mass/total_mass))
-        p1.speed *= (p1.elasticity*p2.elasticity)
-        p1.mass += p2.mass
-        p1.collide_with = p2
+        if p1.cartesian and p2.cartesian:
+            combineCartesian(p1, p2)
+        else:
+            combinePolar(p1, p2)
+
+def combinePolar(p1, p2):
+    """ Merges two overlapping particles into p1 """
+
+    total_mass = p1.mass + p2.mass
+    p1.x = (p1.x*p1.mass + p2.x*p2.mass)/total_mass
+    p1.y = (p1.y*p1.mass + p2.y*p2.mass)/total_mass
+    (p1.angle, p1.speed) = addVectors((p1.angle, p1.speed*p1.mass/total_mass), (p2.angle, p2.speed*p2.mass/total_mass))
+    p1.speed *= (p1.elasticity*p2.elasticity)
+    p1.mass += p2.mass
+    p1.collide_with = p2
 
 def collide(p1, p2):
     """ Tests whether two particles overlap
@@ -31,23 +132,83 @@ def collide(p1, p2):
     
     dist = math.hypot(dx, dy)
     if dist < p1.size + p2.size:
-        angle = math.atan2(dy, dx) + 0.5 * math.pi
-        total_mass = p1.mass + p2.mass
+        if p1.cartesian and p2.cartesian:
+            collideCartesian(p1, p2, dx, dy, dist)
+        else:
+            collidePolar(p1, p2, dx, dy, dist)
+
+def collidePolar(p1, p2, dx, dy, dist):
+    """ Makes two overlapping particles bounce,
+        given the vector (dx, dy) from p2 to p1 and its length """
+
+    angle = math.atan2(dy, dx) + 0.5 * math.pi
+    total_mass = p1.mass + p2.mass
+
+    (p1.angle, p1.speed) = addVectors((p1.angle, p1.speed*(p1.mass-p2.mass)/total_mass), (angle, 2*p2.speed*p2.mass/total_mass))
+    (p2.angle, p2.speed) = addVectors((p2.angle, p2.speed*(p2.mass-p1.mass)/total_mass), (angle+math.pi, 2*p1.speed*p1.mass/total_mass))
+    elasticity = p1.elasticity * p2.elasticity
+    p1.speed *= elasticity
+    p2.speed *= elasticity
+
+    overlap = 0.5*(p1.size + p2.size - dist+1)
+    p1.x += math.sin(angle)*overlap
+    p1.y -= math.cos(angle)*overlap
+    p2.x -= math.sin(angle)*overlap
+    p2.y += math.cos(angle)*overlap
+
+def combineCartesian(p1, p2):
+    """ Merges two overlapping particles with (vx, vy) velocities into p1 """
+
+    total_mass = p1.mass + p2.mass
+    p1.x = (p1.x*p1.mass + p2.x*p2.mass)/total_mass
+    p1.y = (p1.y*p1.mass + p2.y*p2.mass)/total_mass
+    elasticity = p1.elasticity*p2.elasticity
+    p1.vx = (p1.vx*p1.mass + p2.vx*p2.mass)/total_mass * elasticity
+    p1.vy = (p1.vy*p1.mass + p2.vy*p2.mass)/total_mass * elasticity
+    p1.mass += p2.mass
+    p1.collide_with = p2
+
+def collideCartesian(p1, p2, dx, dy, dist):
+    """ Makes two overlapping particles with (vx, vy) velocities bounce,
+        given the vector (dx, dy) from p2 to p1 and its length """
+
+    # Unit vector from p2 to p1, the direction of angle in collide
+    if dist > 0:
+        nx = dx / dist
+        ny = dy / dist
+    else:
+        nx, ny = 1, 0
+    total_mass = p1.mass + p2.mass
 
-        (p1.angle, p1.speed) = addVectors((p1.angle, p1.speed*(p1.mass-p2.mass)/total_mass), (angle, 2*p2.speed*p2.mass/total_mass))
-        (p2.angle, p2.speed) = addVectors((p2.angle, p2.speed*(p2.mass-p1.mass)/total_mass), (angle+math.pi, 2*p1.speed*p1.mass/total_mass))
-        elasticity = p1.elasticity * p2.elasticity
-        p1.speed *= elasticity
-        p2.speed *= elasticity
+    push = 2*math.hypot(p2.vx, p2.vy)*p2.mass/total_mass
+    p1.vx = p1.vx*(p1.mass-p2.mass)/total_mass + nx*push
+    p1.vy = p1.vy*(p1.mass-p2.mass)/total_mass + ny*push
+    push = 2*math.hypot(p1.vx, p1.vy)*p1.mass/total_mass
+    p2.vx = p2.vx*(p2.mass-p1.mass)/total_mass - nx*push
+    p2.vy = p2.vy*(p2.mass-p1.mass)/total_mass - ny*push
+    elasticity = p1.elasticity * p2.elasticity
+    p1.vx *= elasticity
+    p1.vy *= elasticity
+    p2.vx *= elasticity
+    p2.vy *= elasticity
 
-        overlap = 0.5*(p1.size + p2.size - dist+1)
-        p1.x += math.sin(angle)*overlap
-        p1.y -= math.cos(angle)*overlap
-        p2.x -= math.sin(angle)*overlap
-        p2.y += math.cos(angle)*overlap
+    overlap = 0.5*(p1.size + p2.size - dist+1)
+    p1.x += nx*overlap
+    p1.y += ny*overlap
+    p2.x -= nx*overlap
+    p2.y -= ny*overlap
 
 class Particle:
     """ A circular object with a velocity, size and mass """
+
+    # Whether velocity is stored as (vx, vy) rather than (angle, speed)
+    cartesian = False
+
+    # Fixed fields live in slots; the attribute dictionary is only allocated
+    # once something else, such as collide_with, is set on the particle
+    __slots__ = ('x', 'y', 'size', 'colour', 'thickness', 'speed', 'angle', 'mass',
+                 'drag', 'elasticity', 'handle', 'index', 'asleep', 'still_steps', 'still_sum', 'still_from',
+                 'settled', 'island', '__dict__')
     
     def __init__(self, pos, size, mass=1):
         x, y = pos
@@ -61,15 +222,22 @@ class Particle:
         self.mass = mass
         self.drag = 1
         self.elasticity = 0.9
+        # Sleep state, see Environment.updateSleeping
+        self.asleep = False
+        self.still_steps = 0
+        self.still_sum = (0.0, 0.0)
+        self.still_from = None
+        self.settled = False
+        self.island = None
 
-    def move(self):
+    def move(self, dt=1):
         """ Update position based on speed, angle """
 
-        self.x += math.sin(self.angle) * self.speed
-        self.y -= math.cos(self.angle) * self.speed
+        self.x += math.sin(self.angle) * self.speed * dt
+        self.y -= math.cos(self.angle) * self.speed * dt
 
-    def experienceDrag(self):
-        self.speed *= self.drag
+    def experienceDrag(self, dt=1):
+        self.speed *= self.drag ** dt
 
     def mouseMove(self, pos):
         """ Change angle and speed to move towards a given point """
@@ -79,9 +247,36 @@ class Particle:
         self.angle = 0.5*math.pi + math.atan2(dy, dx)
         self.speed = math.hypot(dx, dy) * 0.1
         
-    def accelerate(self, vector):
-        """ Change angle and speed by a given vector """
+    def accelerate(self, vector, dt=1):
+        """ Change angle and speed by a given vector, applied for dt steps """
+        if dt != 1:
+            vector = (vector[0], vector[1] * dt)
         (self.angle, self.speed) = addVectors((self.angle, self.speed), vector)
+
+    def accelerateXY(self, ax, ay):
+        """ Change velocity by a given (x, y) vector """
+        self.vx, self.vy = self.vx + ax, self.vy + ay
+
+    @property
+    def vx(self):
+        return math.sin(self.angle) * self.speed
+
+    @vx.setter
+    def vx(self, vx):
+        self.setVelocity(vx, self.vy)
+
+    @property
+    def vy(self):
+        return -math.cos(self.angle) * self.speed
+
+    @vy.setter
+    def vy(self, vy):
+        self.setVelocity(self.vx, vy)
+
+    def setVelocity(self, vx, vy):
+        """ Set velocity from its (x, y) components """
+        self.angle = math.atan2(vx, -vy)
+        self.speed = math.hypot(vx, vy)
         
     def attract(self, other):
         """" Change velocity based on gravatational attraction between two particle"""
@@ -94,44 +289,1590 @@ class Particle:
             return True
 
         theta = math.atan2(dy, dx)
-        force = 0.2 * self.mass * other.mass / dist**2
+        force = GRAVITATIONAL_CONSTANT * self.mass * other.mass / dist**2
         self.accelerate((theta- 0.5 * math.pi, force/self.mass))
         other.accelerate((theta+ 0.5 * math.pi, force/other.mass))
 
+class CartesianParticle(Particle):
+    """ A Particle that stores its velocity as (vx, vy), with angle and speed computed on demand """
+
+    cartesian = True
+
+    # Plain slots, hiding the computed vx and vy of Particle
+    __slots__ = ('vx', 'vy')
+
+    def __init__(self, pos, size, mass=1):
+        self.vx = 0
+        self.vy = 0
+        Particle.__init__(self, pos, size, mass)
+
+    @property
+    def speed(self):
+        return math.hypot(self.vx, self.vy)
+
+    @speed.setter
+    def speed(self, speed):
+        length = math.hypot(self.vx, self.vy)
+        if length:
+            scale = speed / length
+            self.vx *= scale
+            self.vy *= scale
+        else:
+            self.vx = 0
+            self.vy = -speed
+
+    @property
+    def angle(self):
+        return math.atan2(self.vx, -self.vy)
+
+    @angle.setter
+    def angle(self, angle):
+        speed = math.hypot(self.vx, self.vy)
+        self.vx = math.sin(angle) * speed
+        self.vy = -math.cos(angle) * speed
+
+    def setVelocity(self, vx, vy):
+        self.vx = vx
+        self.vy = vy
+
+    def move(self, dt=1):
+        """ Update position based on velocity """
+        self.x += self.vx * dt
+        self.y += self.vy * dt
+
+    def experienceDrag(self, dt=1):
+        drag = self.drag ** dt
+        self.vx *= drag
+        self.vy *= drag
+
+    def mouseMove(self, pos):
+        """ Change velocity to move towards a given point """
+        x, y = pos
+        self.vx = (x - self.x) * 0.1
+        self.vy = (y - self.y) * 0.1
+
+    # The last (angle, length) vector passed to accelerate and its (x, y) components.
+    # Environment passes the same acceleration tuple every step, so this saves the trig.
+    _vector_cache = (None, 0, 0)
+
+    def accelerate(self, vector, dt=1):
+        """ Change velocity by a given (angle, length) vector, applied for dt steps """
+        cached, ax, ay = CartesianParticle._vector_cache
+        if vector is not cached:
+            (angle, length) = vector
+            ax = math.sin(angle) * length
+            ay = -math.cos(angle) * length
+            CartesianParticle._vector_cache = (vector, ax, ay)
+        self.vx += ax * dt
+        self.vy += ay * dt
+
+    def accelerateXY(self, ax, ay):
+        self.vx += ax
+        self.vy += ay
+
+    def attract(self, other):
+        """ Change velocity based on gravitational attraction between two particles """
+
+        dx = other.x - self.x
+        dy = other.y - self.y
+        dist = math.hypot(dx, dy)
+
+        if dist < self.size + other.size:
+            return True
+
+        force = GRAVITATIONAL_CONSTANT * self.mass * other.mass / dist**3
+        self.accelerateXY(dx * force / self.mass, dy * force / self.mass)
+        other.accelerateXY(-dx * force / other.mass, -dy * force / other.mass)
+
+class QuadNode:
+    """ A square region of a QuadTree with the total mass and centre of mass of its particles """
+
+    __slots__ = ('x', 'y', 'half', 'mass', 'mx', 'my', 'children', 'particles')
+
+    def __init__(self, x, y, half):
+        self.x = x
+        self.y = y
+        self.half = half
+        self.mass = 0
+        self.mx = 0
+        self.my = 0
+        self.children = None
+        self.particles = []
+
+class QuadTree:
+    """ A Barnes-Hut quadtree over a list of particles """
+
+    # Below this size, a node keeps all its particles instead of splitting further
+    min_half = 1e-6
+
+    def __init__(self, particles):
+        self.nodes = 1
+        self.visits = 0
+
+        if particles:
+            min_x = min(p.x for p in particles)
+            max_x = max(p.x for p in particles)
+            min_y = min(p.y for p in particles)
+            max_y = max(p.y for p in particles)
+            half = 0.5 * max(max_x - min_x, max_y - min_y) or 1
+            self.root = QuadNode(0.5 * (min_x + max_x), 0.5 * (min_y + max_y), half * 1.0001)
+        else:
+            self.root = QuadNode(0, 0, 1)
+
+        for p in particles:
+            self.insert(p)
+        self.summarise(self.root)
+
+    def insert(self, particle):
+        node = self.root
+        while True:
+            if node.children is not None:
+                node = node.children[self.quadrant(node, particle)]
+            elif not node.particles or node.half < self.min_half:
+                node.particles.append(particle)
+                return
+            else:
+                self.split(node)
+
+    def quadrant(self, node, particle):
+        return (particle.x >= node.x) + 2 * (particle.y >= node.y)
+
+    def split(self, node):
+        h = 0.5 * node.half
+        node.children = [QuadNode(node.x - h, node.y - h, h), QuadNode(node.x + h, node.y - h, h),
+                         QuadNode(node.x - h, node.y + h, h), QuadNode(node.x + h, node.y + h, h)]
+        self.nodes += 4
+        for p in node.particles:
+            node.children[self.quadrant(node, p)].particles.append(p)
+        node.particles = []
+
+    def summarise(self, node):
+        """ Fills in the mass and centre of mass of node and its descendants """
+
+        if node.children is None:
+            bodies = [(p.mass, p.x, p.y) for p in node.particles]
+        else:
+            for child in node.children:
+                self.summarise(child)
+            bodies = [(c.mass, c.mx, c.my) for c in node.children if c.mass]
+
+        mass = sum(m for m, x, y in bodies)
+        node.mass = mass
+        if mass:
+            node.mx = sum(m * x for m, x, y in bodies) / mass
+            node.my = sum(m * y for m, x, y in bodies) / mass
+
+    def acceleration(self, particle, opening_angle=0.5):
+        """ Returns the (x, y) acceleration of particle due to all the other particles.
+            A node is treated as a single mass if its width seen from the particle is below opening_angle """
+
+        ax = ay = 0
+        stack = [self.root]
+        visits = 0
+        while stack:
+            node = stack.pop()
+            visits += 1
+            if node.children is None:
+                for other in node.particles:
+                    if other is particle:
+                        continue
+                    dx = other.x - particle.x
+                    dy = other.y - particle.y
+                    dist = math.hypot(dx, dy)
+                    if dist < particle.size + other.size:
+                        continue
+                    a = GRAVITATIONAL_CONSTANT * other.mass / dist**3
+                    ax += a * dx
+                    ay += a * dy
+                continue
+
+            dx = node.mx - particle.x
+            dy = node.my - particle.y
+            dist = math.hypot(dx, dy)
+            if dist > 0 and 2 * node.half < opening_angle * dist:
+                a = GRAVITATIONAL_CONSTANT * node.mass / dist**3
+                ax += a * dx
+                ay += a * dy
+            else:
+                stack.extend(c for c in node.children if c.mass)
+
+        self.visits += visits
+        return (ax, ay)
+
+class SweepAndPrune:
+    """ A sort-and-sweep broadphase that keeps the particles' bounding box endpoints sorted along
+        both axes between steps. Particles move little from one step to the next, so an insertion
+        sort only does a few swaps, and each swap of a lower past an upper endpoint is exactly
+        where a pair of boxes starts or stops overlapping. """
+
+    def __init__(self):
+        self.keys = {}
+        self.objects = {}
+        self.next_key = 0
+        self.ends = ([], [])
+        self.partners = {}
+        self.touching = set()
+        # Contacts of removed particles, reported as ended by the next contacts
+        self.dropped = []
+
+    def update(self, particles):
+        """ Brings the broadphase up to date with the particles and returns the overlapping pairs """
+
+        current = set(id(p) for p in particles)
+        for p in [self.objects[key] for pid, key in self.keys.items() if pid not in current]:
+            self.remove(p)
+        added = [p for p in particles if id(p) not in self.keys]
+        # Sorting many new endpoints in one at a time is quadratic, so start again instead
+        if len(added) > len(self.keys) // 8:
+            self.rebuild(particles)
+            return [(self.objects[a], self.objects[b]) for a, b in self.pairs()]
+        for p in added:
+            self.add(p)
+
+        for axis, ends in enumerate(self.ends):
+            for end in ends:
+                p = self.objects[end[2]]
+                centre = p.y if axis else p.x
+                end[0] = centre + p.size if end[1] else centre - p.size
+            self.sort(ends)
+
+        return [(self.objects[a], self.objects[b]) for a, b in self.pairs()]
+
+    def rebuild(self, particles):
+        """ Sorts all endpoints from scratch and finds the overlapping boxes with a single sweep along x """
+
+        touching = [(self.objects[a], self.objects[b]) for a, b in self.touching]
+        dropped = self.dropped
+        self.__init__()
+        self.dropped = dropped
+        for p in particles:
+            key = self.next_key
+            self.next_key += 1
+            self.keys[id(p)] = key
+            self.objects[key] = p
+            self.partners[key] = set()
+        for axis, ends in enumerate(self.ends):
+            for p in particles:
+                centre = p.y if axis else p.x
+                key = self.keys[id(p)]
+                ends.append([centre - p.size, False, key])
+                ends.append([centre + p.size, True, key])
+            # Lower ends sort before upper ends at the same value, so touching boxes count as overlapping
+            ends.sort(key=lambda end: (end[0], end[1]))
+
+        active = set()
+        for value, upper, key in self.ends[0]:
+            if upper:
+                active.discard(key)
+                continue
+            for other in active:
+                if self.overlaps(key, other):
+                    self.partners[key].add(other)
+                    self.partners[other].add(key)
+            active.add(key)
+
+        self.touching = set((min(self.keys[id(p1)], self.keys[id(p2)]), max(self.keys[id(p1)], self.keys[id(p2)]))
+                            for p1, p2 in touching if id(p1) in self.keys and id(p2) in self.keys)
+        self.dropped.extend((p1, p2) for p1, p2 in touching if id(p1) not in self.keys or id(p2) not in self.keys)
+
+    def add(self, particle):
+        key = self.next_key
+        self.next_key += 1
+        self.keys[id(particle)] = key
+        self.objects[key] = particle
+        self.partners[key] = set()
+        for axis, ends in enumerate(self.ends):
+            centre = particle.y if axis else particle.x
+            ends.append([centre - particle.size, False, key])
+            ends.append([centre + particle.size, True, key])
+            self.sort(ends)
+
+    def remove(self, particle):
+        key = self.keys.pop(id(particle))
+        del self.objects[key]
+        for other in self.partners.pop(key):
+            self.partners[other].discard(key)
+            pair = (min(key, other), max(key, other))
+            if pair in self.touching:
+                self.touching.discard(pair)
+                self.dropped.append((particle, self.objects[other]) if key < other else (self.objects[other], particle))
+        for axis in (0, 1):
+            self.ends[axis][:] = [end for end in self.ends[axis] if end[2] != key]
+
+    def sort(self, ends):
+        for k in range(1, len(ends)):
+            end = ends[k]
+            value = end[0]
+            j = k - 1
+            while j >= 0 and ends[j][0] > value:
+                other = ends[j]
+                if not end[1] and other[1]:
+                    # A lower end moved below an upper end, so the boxes may now overlap
+                    if self.overlaps(end[2], other[2]):
+                        self.partners[end[2]].add(other[2])
+                        self.partners[other[2]].add(end[2])
+                elif end[1] and not other[1]:
+                    # An upper end moved below a lower end, so the boxes no longer overlap
+                    self.partners[end[2]].discard(other[2])
+                    self.partners[other[2]].discard(end[2])
+                ends[j + 1] = other
+                j -= 1
+            ends[j + 1] = end
+
+    def overlaps(self, a, b):
+        p1 = self.objects[a]
+        p2 = self.objects[b]
+        reach = p1.size + p2.size
+        return abs(p1.x - p2.x) <= reach and abs(p1.y - p2.y) <= reach
+
+    def pairs(self):
+        return [(a, b) for a, others in self.partners.items() for b in others if a < b]
+
+    def contacts(self):
+        """ Returns the pairs of particles that started and stopped overlapping since the last call,
+            a removed particle having stopped overlapping those it touched """
+
+        touching = set()
+        for a, b in self.pairs():
+            p1 = self.objects[a]
+            p2 = self.objects[b]
+            if math.hypot(p1.x - p2.x, p1.y - p2.y) < p1.size + p2.size:
+                touching.add((a, b))
+        begun = [(self.objects[a], self.objects[b]) for a, b in touching - self.touching]
+        ended = self.dropped + [(self.objects[a], self.objects[b]) for a, b in self.touching - touching]
+        self.touching = touching
+        self.dropped = []
+        return (begun, ended)
+
+class SpatialIndex:
+    """ A hash grid of particle centres for point, radius, rectangle and nearest neighbour queries.
+        refresh only moves the particles whose cell has changed since the last refresh. """
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        # Whether every particle must be placed again, as after clear
+        self.stale = True
+        self.cells = {}
+        # The cell of each particle by id, holding the particle so that its id is not reused
+        self.keys = {}
+        self.max_size = 0
+        # The particle list at the last refresh and the cell columns it was placed by, which the
+        # next refresh compares with while no particle has been put in or taken out since
+        self.order = None
+        self.placed = None
+
+    def clear(self):
+        self.cells = {}
+        self.keys = {}
+        self.max_size = 0
+        self.stale = True
+        self.order = None
+
+    def cellOf(self, x, y):
+        # Floor division, as refresh uses, puts a particle on a cell border in the same cell
+        return (int(x // self.cell_size), int(y // self.cell_size))
+
+    def insert(self, particle):
+        key = self.cellOf(particle.x, particle.y)
+        self.keys[id(particle)] = (key, particle)
+        self.cells.setdefault(key, []).append(particle)
+        self.max_size = max(self.max_size, particle.size)
+        self.order = None
+
+    def remove(self, particle):
+        entry = self.keys.pop(id(particle), None)
+        if entry is None:
+            return
+        key = entry[0]
+        cell = self.cells[key]
+        cell.remove(particle)
+        if not cell:
+            del self.cells[key]
+        self.order = None
+
+    def move(self, particle):
+        """ Moves one particle to the cell of its current position """
+
+        key = self.cellOf(particle.x, particle.y)
+        entry = self.keys.get(id(particle))
+        if entry is not None and entry[0] == key:
+            return
+        self.remove(particle)
+        self.insert(particle)
+
+    def refresh(self, particles):
+        """ Moves the particles whose cell has changed since the last refresh. The cells of all
+            particles are compared with those they are kept in a whole column at a time, so only
+            the particles that changed cell are visited. """
+
+        size = self.cell_size
+        xs = list(map(operator.floordiv, map(operator.attrgetter('x'), particles), itertools.repeat(size)))
+        ys = list(map(operator.floordiv, map(operator.attrgetter('y'), particles), itertools.repeat(size)))
+        if self.stale:
+            self.cells = {}
+            self.keys = {}
+            moved = range(len(particles))
+        elif self.order == particles:
+            (placed_x, placed_y) = self.placed
+            moved = list(itertools.compress(itertools.count(), map(operator.or_,
+                map(operator.ne, xs, placed_x), map(operator.ne, ys, placed_y))))
+        else:
+            # Particles were put in or taken out since, so compare with the cells they are kept in
+            kept = map(operator.itemgetter(0), map(self.keys.get, map(id, particles), itertools.repeat((None,))))
+            moved = list(itertools.compress(itertools.count(), map(operator.ne, zip(xs, ys), kept)))
+        self.place(particles, xs, ys, moved)
+
+        if len(self.keys) != len(particles) and not self.stale:
+            # Particles were taken out of the list without going through remove
+            self.stale = True
+            self.refresh(particles)
+            return
+        self.max_size = max(map(operator.attrgetter('size'), particles), default=0)
+        self.stale = False
+        self.order = list(particles)
+        self.placed = (xs, ys)
+
+    def place(self, particles, xs, ys, indices):
+        """ Puts the particles at the given indices into the cells given by xs and ys """
+
+        keys = self.keys
+        cells = self.cells
+        for i in indices:
+            p = particles[i]
+            key = (int(xs[i]), int(ys[i]))
+            entry = keys.get(id(p))
+            if entry is not None:
+                cell = cells[entry[0]]
+                cell.remove(p)
+                if not cell:
+                    del cells[entry[0]]
+            keys[id(p)] = (key, p)
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [p]
+            else:
+                cell.append(p)
+
+    def inRect(self, x0, y0, x1, y1):
+        """ Returns the particles whose centre lies in the rectangle from (x0, y0) to (x1, y1) """
+
+        (cx0, cy0) = self.cellOf(min(x0, x1), min(y0, y1))
+        (cx1, cy1) = self.cellOf(max(x0, x1), max(y0, y1))
+        x0, x1 = min(x0, x1), max(x0, x1)
+        y0, y1 = min(y0, y1), max(y0, y1)
+
+        found = []
+        cells = self.cells
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(cells):
+            # Large rectangles visit the occupied cells rather than every cell they cover
+            keys = [key for key in cells if cx0 <= key[0] <= cx1 and cy0 <= key[1] <= cy1]
+        else:
+            keys = [(cx, cy) for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1)]
+        for key in keys:
+            for p in cells.get(key, ()):
+                if x0 <= p.x <= x1 and y0 <= p.y <= y1:
+                    found.append(p)
+        return found
+
+    def inRadius(self, x, y, radius):
+        """ Returns the particles whose centre is within radius of (x, y) """
+
+        r2 = radius * radius
+        return [p for p in self.inRect(x - radius, y - radius, x + radius, y + radius)
+                if (p.x - x)**2 + (p.y - y)**2 <= r2]
+
+    def at(self, x, y):
+        """ Returns the particle that covers (x, y) with the nearest centre, or None """
+
+        best = None
+        best_dist = None
+        for p in self.inRadius(x, y, self.max_size):
+            dist = math.hypot(p.x - x, p.y - y)
+            if dist <= p.size and (best is None or dist < best_dist):
+                best = p
+                best_dist = dist
+        return best
+
+    def nearest(self, x, y, k=1):
+        """ Returns the k particles with centres nearest to (x, y), nearest first """
+
+        if k <= 0 or not self.keys:
+            return []
+        size = self.cell_size
+        (cx, cy) = self.cellOf(x, y)
+        found = []
+        ring = 0
+        visited = 0
+        while visited < len(self.cells):
+            if (2 * ring + 1)**2 > 4 * len(self.cells):
+                # The particles are sparse around (x, y), so rank all of them instead
+                found = [((p.x - x)**2 + (p.y - y)**2, pid, p) for pid, (key, p) in self.keys.items()]
+                break
+            # Visit the cells on the border of the square of cells ring steps out from (cx, cy)
+            for ox in range(-ring, ring + 1):
+                for oy in ((-ring, ring) if abs(ox) != ring else range(-ring, ring + 1)):
+                    cell = self.cells.get((cx + ox, cy + oy))
+                    if cell is None:
+                        continue
+                    visited += 1
+                    for p in cell:
+                        found.append(((p.x - x)**2 + (p.y - y)**2, id(p), p))
+            # Anything outside the square is at least ring cells away from (x, y)
+            if len(found) >= k:
+                found.sort()
+                reach = ring * size
+                if found[k - 1][0] <= reach * reach:
+                    break
+            ring += 1
+        found.sort()
+        return [p for (dist, pid, p) in found[:k]]
+
+class NeighbourGrid:
+    """ A hash grid of the positions in a list of particles for Environment.updateGrid. It follows
+        the particles as they are moved, so that the pair loop of each particle meets every later
+        particle it may touch, in list order, wherever the earlier ones have pushed them. """
+
+    def __init__(self, particles, cell_size):
+        self.particles = particles
+        self.cell_size = float(cell_size)
+        self.max_size = max([p.size for p in particles] or [0])
+        # The cell each particle is kept in, by position in the list
+        size = itertools.repeat(self.cell_size)
+        self.keys = list(zip(map(int, map(operator.floordiv, map(operator.attrgetter('x'), particles), size)),
+                             map(int, map(operator.floordiv, map(operator.attrgetter('y'), particles), size))))
+        cells = self.cells = {}
+        for j, key in enumerate(self.keys):
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [j]
+            else:
+                cell.append(j)
+
+    def place(self, j):
+        """ Moves the j-th particle to the cell of its position """
+
+        p = self.particles[j]
+        key = (int(p.x // self.cell_size), int(p.y // self.cell_size))
+        old = self.keys[j]
+        if key == old:
+            return
+        if old is not None:
+            cell = self.cells[old]
+            cell.remove(j)
+            if not cell:
+                del self.cells[old]
+        self.keys[j] = key
+        cell = self.cells.get(key)
+        if cell is None:
+            self.cells[key] = [j]
+        else:
+            cell.append(j)
+
+    def neighbours(self, i, particle):
+        """ Yields the particles after the i-th, which is particle, that are close enough to touch it,
+            in list order. The cells are searched with some slack, and again once the contacts have
+            moved particle further than the slack or grown it. """
+
+        particles = self.particles
+        cells = self.cells
+        size = self.cell_size
+        last = i
+        while True:
+            x = particle.x
+            y = particle.y
+            radius = particle.size
+            if (int(x // size), int(y // size)) != self.keys[i]:
+                self.place(i)
+            if radius > self.max_size:
+                self.max_size = radius
+            slack = NEIGHBOUR_SLACK * self.max_size
+            reach = radius + self.max_size + slack
+            x0 = int((x - reach) // size)
+            x1 = int((x + reach) // size)
+            y0 = int((y - reach) // size)
+            y1 = int((y + reach) // size)
+            if x1 - x0 > 1 or y1 - y0 > 1:
+                # The particle has grown to reach across more than two cells
+                later = [j for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)
+                         for j in cells.get((cx, cy), ()) if j > last]
+            else:
+                later = [j for j in cells.get((x0, y0), ()) if j > last]
+                if x1 != x0:
+                    later += [j for j in cells.get((x1, y0), ()) if j > last]
+                if y1 != y0:
+                    later += [j for j in cells.get((x0, y1), ()) if j > last]
+                    if x1 != x0:
+                        later += [j for j in cells.get((x1, y1), ()) if j > last]
+            later.sort()
+
+            px = x
+            py = y
+            for j in later:
+                other = particles[j]
+                (ox, oy) = (other.x, other.y)
+                if abs(ox - px) >= radius + other.size or abs(oy - py) >= radius + other.size:
+                    # Too far apart on one axis for any contact function to act
+                    continue
+                yield other
+                if other.x != ox or other.y != oy:
+                    self.place(j)
+                px = particle.x
+                py = particle.y
+                if abs(px - x) > slack or abs(py - y) > slack or particle.size != radius:
+                    last = j
+                    break
+            else:
+                if (int(particle.x // size), int(particle.y // size)) != self.keys[i]:
+                    self.place(i)
+                return
+
+class MultirateScheduler:
+    """ Sorts the particles of an Environment into power-of-two timestep bins. Bin k advances
+        its particles 2**k steps at a time, on the steps that end its interval, so slow particles
+        cost a fraction of a full update. A particle that comes into contact with an active one is
+        first drifted up to the current step and then stays in bin 0 until it settles again. """
+
+    def __init__(self, env):
+        self.env = env
+        self.time = 0
+        self.bins = [{} for level in range(env.max_level + 1)]
+        # The [particle, level, time it has been advanced to] of each particle, by id
+        self.entries = {}
+        # Cells wide enough that contacts, allowing for drift, are with the 8 neighbouring cells
+        self.index = SpatialIndex(env.gridCellSize() * (1 + env.multirate_accuracy))
+        # The particle functions as (particle, dt) callables, set up by step
+        self.actions = []
+        self.attracting = False
+        for p in env.particles:
+            self.add(p)
+
+    def add(self, particle):
+        self.entries[id(particle)] = [particle, 0, self.time]
+        self.bins[0][id(particle)] = particle
+        self.index.insert(particle)
+
+    def remove(self, particle):
+        entry = self.entries.pop(id(particle), None)
+        if entry is None:
+            return
+        del self.bins[entry[1]][id(particle)]
+        self.index.remove(particle)
+
+    def reconcile(self, particles):
+        """ Picks up particles added to or taken from the list without going through the environment """
+
+        if len(particles) == len(self.entries):
+            return
+        current = set(id(p) for p in particles)
+        for p in [entry[0] for pid, entry in self.entries.items() if pid not in current]:
+            self.remove(p)
+        for p in particles:
+            if id(p) not in self.entries:
+                self.add(p)
+
+    def advance(self, particle, end):
+        """ Runs the particle functions over the steps from the particle's time to end """
+
+        entry = self.entries[id(particle)]
+        dt = end - entry[2]
+        for action in self.actions:
+            action(particle, dt)
+        if self.attracting:
+            self.attract(particle, end, dt)
+        entry[2] = end
+        self.index.move(particle)
+        return dt
+
+    def attract(self, particle, end, dt):
+        """ Accelerates a particle for dt steps towards every other particle where it is at end """
+
+        ax = ay = 0
+        x = particle.x
+        y = particle.y
+        for other, level, time in self.entries.values():
+            if other is particle:
+                continue
+            ox = other.x
+            oy = other.y
+            if time != end:
+                ox += other.vx * (end - time)
+                oy += other.vy * (end - time)
+            dx = ox - x
+            dy = oy - y
+            dist = math.hypot(dx, dy)
+            if dist < particle.size + other.size:
+                continue
+            strength = GRAVITATIONAL_CONSTANT * other.mass / dist**3
+            ax += dx * strength
+            ay += dy * strength
+        if ax or ay:
+            particle.accelerateXY(ax * dt, ay * dt)
+
+    def step(self):
+        """ Advances the particles whose interval ends on the next step, and those they touch """
+
+        env = self.env
+        self.reconcile(env.particles)
+        actions = {
+            'move': lambda p, dt: p.move(dt),
+            'drag': lambda p, dt: p.experienceDrag(dt),
+            'accelerate': lambda p, dt: p.accelerate(env.acceleration, dt),
+            'bounce': lambda p, dt: env.bounce(p)}
+        self.actions = [actions[name] for name in env.function_names if name in actions]
+        self.attracting = 'attract' in env.function_names
+        end = self.time + 1
+        active = [p for level, bin in enumerate(self.bins) if end % (1 << level) == 0 for p in bin.values()]
+        velocities = [(p.vx, p.vy) for p in active]
+        steps = [self.advance(p, end) for p in active]
+
+        group = list(active)
+        if env.contact_functions:
+            position = dict((id(p), i) for i, p in enumerate(group))
+            # Inactive particles have drifted at most this far since they were last advanced
+            reach = self.index.max_size * (1 + env.multirate_accuracy)
+            cells = self.index.cells
+            size = self.index.cell_size
+            pairs = []
+            for i in range(len(active)):
+                p = group[i]
+                if p.size + reach <= size:
+                    (cx, cy) = self.index.cellOf(p.x, p.y)
+                    near = [q for ox in (-1, 0, 1) for oy in (-1, 0, 1)
+                            for q in cells.get((cx + ox, cy + oy), ())]
+                else:
+                    # Particles have grown since the cell size was chosen
+                    near = self.index.inRadius(p.x, p.y, p.size + reach)
+                for q in near:
+                    if q is p:
+                        continue
+                    j = position.get(id(q))
+                    if j is None:
+                        (q, level, time) = self.entries[id(q)]
+                        qx = q.x + q.vx * (end - time)
+                        qy = q.y + q.vy * (end - time)
+                        if math.hypot(p.x - qx, p.y - qy) >= p.size + q.size:
+                            continue
+                        velocities.append((q.vx, q.vy))
+                        steps.append(self.advance(q, end))
+                        j = position[id(q)] = len(group)
+                        group.append(q)
+                        # Keep it at the full rate while it is in contact
+                        self.setLevel(q, 0)
+                    elif j < len(active) and j <= i:
+                        continue
+                    pairs.append((i, j) if i < j else (j, i))
+            pairs.sort()
+            if env.compiled:
+                env.getPlan().contactPairs(env, group, pairs)
+            else:
+                for (i, j) in pairs:
+                    for f in env.contact_functions:
+                        f(group[i], group[j])
+
+        for i, p in enumerate(active):
+            (vx, vy) = velocities[i]
+            self.setLevel(p, self.chooseLevel(p, math.hypot(p.vx - vx, p.vy - vy) / steps[i], end))
+        for p in group[len(active):]:
+            self.index.move(p)
+        self.time = end
+
+        env.multirate_stats = {'active': len(group), 'bins': [len(bin) for bin in self.bins]}
+
+    def chooseLevel(self, particle, acceleration, end):
+        """ Returns the largest bin, at most one above the current one, whose interval starting
+            at end moves the particle less than multirate_accuracy of its size """
+
+        env = self.env
+        limit = env.multirate_accuracy * particle.size
+        speed = particle.speed
+        current = self.entries[id(particle)][1]
+        level = 0
+        while level < env.max_level and level <= current:
+            dt = 2 << level
+            if end % dt or speed * dt > limit or acceleration * dt * dt > limit:
+                break
+            level += 1
+        return level
+
+    def setLevel(self, particle, level):
+        entry = self.entries[id(particle)]
+        if entry[1] != level:
+            del self.bins[entry[1]][id(particle)]
+            self.bins[level][id(particle)] = particle
+            entry[1] = level
+
+    def synchronize(self):
+        """ Advances every particle to the current step, for example before drawing or saving """
+
+        for p, level, time in list(self.entries.values()):
+            if time != self.time:
+                self.advance(p, self.time)
+
+class EventEngine:
+    """ Moves the particles of an Environment in straight lines from one predicted collision to the next.
+        Each particle keeps its own clock, so a collision only updates the two particles involved.
+        Predictions are kept in a priority queue and dropped lazily when either particle has
+        collided since the prediction was made. """
+
+    # Pseudo-particles standing for the walls in a predicted event
+    VERTICAL_WALL = -1
+    HORIZONTAL_WALL = -2
+
+    def __init__(self, env):
+        self.env = env
+        self.max_events = 100000
+        self.reset()
+
+    def reset(self):
+        """ Reads the particles from the environment and predicts all their collisions afresh """
+
+        env = self.env
+        self.particles = list(env.particles)
+        self.walls = 'bounce' in env.function_names
+        self.pairs = 'collide' in env.function_names
+        self.time = 0
+        self.events = 0
+        self.queue = []
+        self.sequence = 0
+
+        n = len(self.particles)
+        self.x = [p.x for p in self.particles]
+        self.y = [p.y for p in self.particles]
+        self.vx = [p.vx for p in self.particles]
+        self.vy = [p.vy for p in self.particles]
+        self.t0 = [0.0] * n
+        self.counts = [0] * n
+        self.written = [None] * n
+        self.predictAll()
+
+    def positionAt(self, i, t):
+        dt = t - self.t0[i]
+        return (self.x[i] + self.vx[i] * dt, self.y[i] + self.vy[i] * dt)
+
+    def moveTo(self, i, t):
+        self.x[i], self.y[i] = self.positionAt(i, t)
+        self.t0[i] = t
+
+    def push(self, t, i, j):
+        count_j = self.counts[j] if j >= 0 else 0
+        heapq.heappush(self.queue, (t, self.sequence, i, j, self.counts[i], count_j))
+        self.sequence += 1
+
+    def predict(self, i):
+        """ Queues the next wall collision of particle i and its collisions with every other particle """
+
+        self.predictWalls(i)
+        if self.pairs:
+            self.predictPairs(i, range(len(self.particles)))
+
+    def predictAll(self):
+        """ Queues the next collisions of every particle from the current time. A pair is only
+            looked at if the paths its particles take until their next wall collision come near each
+            other: a pair that only meets later is predicted when one of them hits the wall. """
+
+        n = len(self.particles)
+        ends = [self.predictWalls(i) for i in range(n)]
+        if not self.pairs:
+            return
+
+        # The bounding box of each particle's path, swept along x
+        t = self.time
+        (left, right, top, bottom) = ([], [], [], [])
+        for i in range(n):
+            x, y = self.positionAt(i, t)
+            size = self.particles[i].size
+            dx = self.vx[i] * (ends[i] - t) if self.vx[i] else 0
+            dy = self.vy[i] * (ends[i] - t) if self.vy[i] else 0
+            left.append(min(x, x + dx) - size)
+            right.append(max(x, x + dx) + size)
+            top.append(min(y, y + dy) - size)
+            bottom.append(max(y, y + dy) + size)
+
+        active = []
+        for i in sorted(range(n), key=left.__getitem__):
+            active = [j for j in active if right[j] >= left[i]]
+            others = [j for j in active if bottom[j] >= top[i] and top[j] <= bottom[i]]
+            if others:
+                self.predictPairs(i, others)
+            active.append(i)
+
+    def predictWalls(self, i):
+        """ Queues the next wall collision of particle i, returning its time, or infinity if there is none """
+
+        t = self.time
+        end = math.inf
+        if not self.walls:
+            return end
+        x, y = self.positionAt(i, t)
+        vx = self.vx[i]
+        vy = self.vy[i]
+        size = self.particles[i].size
+        env = self.env
+        if vx > 0:
+            end = t + max(0, (env.width - size - x) / vx)
+            self.push(end, i, self.VERTICAL_WALL)
+        elif vx < 0:
+            end = t + max(0, (size - x) / vx)
+            self.push(end, i, self.VERTICAL_WALL)
+        if vy > 0:
+            when = t + max(0, (env.height - size - y) / vy)
+            self.push(when, i, self.HORIZONTAL_WALL)
+            end = min(end, when)
+        elif vy < 0:
+            when = t + max(0, (size - y) / vy)
+            self.push(when, i, self.HORIZONTAL_WALL)
+            end = min(end, when)
+        return end
+
+    def predictPairs(self, i, others):
+        """ Queues the collisions of particle i with the particles others """
+
+        t = self.time
+        x, y = self.positionAt(i, t)
+        vx = self.vx[i]
+        vy = self.vy[i]
+        size = self.particles[i].size
+        for j in others:
+            if j == i:
+                continue
+            xj, yj = self.positionAt(j, t)
+            dx = xj - x
+            dy = yj - y
+            dvx = self.vx[j] - vx
+            dvy = self.vy[j] - vy
+            b = dx*dvx + dy*dvy
+            if b >= 0:
+                continue
+            a = dvx*dvx + dvy*dvy
+            sigma = size + self.particles[j].size
+            c = dx*dx + dy*dy - sigma*sigma
+            disc = b*b - a*c
+            if disc < 0:
+                continue
+            tau = max(0, -(b + math.sqrt(disc)) / a) if c > 0 else 0
+            self.push(t + tau, min(i, j), max(i, j))
+
+    def advanceTo(self, t):
+        """ Processes every collision up to time t, or the first max_events of them, then moves all particles to t """
+
+        events = 0
+        while self.queue and self.queue[0][0] <= t and events < self.max_events:
+            (when, _, i, j, count_i, count_j) = heapq.heappop(self.queue)
+            if count_i != self.counts[i] or (j >= 0 and count_j != self.counts[j]):
+                continue
+            self.time = when
+            events += 1
+            self.moveTo(i, when)
+            if j == self.VERTICAL_WALL:
+                self.vx[i] *= -self.env.elasticity
+                self.vy[i] *= self.env.elasticity
+            elif j == self.HORIZONTAL_WALL:
+                self.vx[i] *= self.env.elasticity
+                self.vy[i] *= -self.env.elasticity
+            else:
+                self.moveTo(j, when)
+                self.resolve(i, j)
+                self.counts[j] += 1
+            self.counts[i] += 1
+            self.predict(i)
+            if j >= 0:
+                self.predict(j)
+
+        self.events += events
+        overdue = bool(self.queue) and self.queue[0][0] < t
+        self.time = t
+        for i in range(len(self.particles)):
+            self.moveTo(i, t)
+        if overdue:
+            # Stopped by max_events: collisions left before t are predicted again from t rather
+            # than replayed later, which would move their particles back in time
+            self.queue = []
+            self.predictAll()
+
+    def resolve(self, i, j):
+        """ Exchanges momentum between touching particles i and j along the line between their centres """
+
+        p1 = self.particles[i]
+        p2 = self.particles[j]
+        dx = self.x[j] - self.x[i]
+        dy = self.y[j] - self.y[i]
+        dist = math.hypot(dx, dy) or 1
+        nx = dx / dist
+        ny = dy / dist
+        approach = (self.vx[i] - self.vx[j]) * nx + (self.vy[i] - self.vy[j]) * ny
+        if approach <= 0:
+            return
+        impulse = (1 + p1.elasticity * p2.elasticity) * approach / (p1.mass + p2.mass)
+        self.vx[i] -= impulse * p2.mass * nx
+        self.vy[i] -= impulse * p2.mass * ny
+        self.vx[j] += impulse * p1.mass * nx
+        self.vy[j] += impulse * p1.mass * ny
+
+    def stateAt(self, t):
+        """ Returns the (x, y) positions of all particles at time t, which may not be before the current
+            time, leaving the engine where it is """
+
+        if not self.queue or self.queue[0][0] > t:
+            # Nothing happens before t, so every particle carries on in a straight line
+            return [self.positionAt(i, t) for i in range(len(self.particles))]
+        engine = self.copy()
+        engine.advanceTo(t)
+        return list(zip(engine.x, engine.y))
+
+    def copy(self):
+        """ Returns an engine in the same state over the same particles, that moves independently of this one """
+
+        engine = EventEngine.__new__(EventEngine)
+        engine.__dict__.update(self.__dict__)
+        for name in ('x', 'y', 'vx', 'vy', 't0', 'counts', 'written', 'queue'):
+            setattr(engine, name, list(getattr(self, name)))
+        return engine
+
+    def write(self):
+        """ Copies the state of the engine onto the particles of the environment """
+
+        for i, p in enumerate(self.particles):
+            p.x = self.x[i]
+            p.y = self.y[i]
+            p.setVelocity(self.vx[i], self.vy[i])
+            self.written[i] = (p.x, p.y, p.vx, p.vy)
+
+    def read(self):
+        """ Picks up particles that were moved or pushed outside the engine since the last write """
+
+        if self.particles != list(self.env.particles):
+            self.reset()
+            return
+        for i, p in enumerate(self.particles):
+            if self.written[i] != (p.x, p.y, p.vx, p.vy):
+                self.x[i], self.y[i] = p.x, p.y
+                self.vx[i], self.vy[i] = p.vx, p.vy
+                self.t0[i] = self.time
+                self.counts[i] += 1
+                self.predict(i)
+
+# Source snippets for the fused loops of an UpdatePlan, by function name and velocity mode.
+# Particle functions act on p1. Pair functions act on p1 and p2, with dx, dy the vector
+# from p2 to p1 and dist its length already computed.
+PLAN_SNIPPETS = {
+    ('move', 'polar'): """
+        angle = p1.angle
+        speed = p1.speed
+        p1.x += sin(angle) * speed
+        p1.y -= cos(angle) * speed
+    """,
+    ('move', 'cartesian'): """
+        p1.x += p1.vx
+        p1.y += p1.vy
+    """,
+    ('drag', 'polar'): """
+        p1.speed *= p1.drag
+    """,
+    ('drag', 'cartesian'): """
+        p1.vx *= p1.drag
+        p1.vy *= p1.drag
+    """,
+    ('accelerate', 'polar'): """
+        angle = p1.angle
+        speed = p1.speed
+        x = sin(angle) * speed + acceleration_sin
+        y = cos(angle) * speed + acceleration_cos
+        p1.angle = half_pi - atan2(y, x)
+        p1.speed = hypot(x, y)
+    """,
+    ('accelerate', 'cartesian'): """
+        p1.vx += acceleration_sin
+        p1.vy -= acceleration_cos
+    """,
+    ('bounce', 'polar'): """
+        size = p1.size
+        if p1.x > width - size:
+            p1.x = 2*(width - size) - p1.x
+            p1.angle = - p1.angle
+            p1.speed *= elasticity
+        elif p1.x < size:
+            p1.x = 2*size - p1.x
+            p1.angle = - p1.angle
+            p1.speed *= elasticity
+        if p1.y > height - size:
+            p1.y = 2*(height - size) - p1.y
+            p1.angle = pi - p1.angle
+            p1.speed *= elasticity
+        elif p1.y < size:
+            p1.y = 2*size - p1.y
+            p1.angle = pi - p1.angle
+            p1.speed *= elasticity
+    """,
+    ('bounce', 'cartesian'): """
+        size = p1.size
+        if p1.x > width - size:
+            p1.x = 2*(width - size) - p1.x
+            p1.vx *= -elasticity
+            p1.vy *= elasticity
+        elif p1.x < size:
+            p1.x = 2*size - p1.x
+            p1.vx *= -elasticity
+            p1.vy *= elasticity
+        if p1.y > height - size:
+            p1.y = 2*(height - size) - p1.y
+            p1.vx *= elasticity
+            p1.vy *= -elasticity
+        elif p1.y < size:
+            p1.y = 2*size - p1.y
+            p1.vx *= elasticity
+            p1.vy *= -elasticity
+    """,
+    ('attract', 'polar'): """
+        if dist >= p1.size + p2.size:
+            theta = atan2(dy, dx)
+            force = G * p1.mass * p2.mass / dist**2
+            p1.accelerate((theta - half_pi, force/p1.mass))
+            p2.accelerate((theta + half_pi, force/p2.mass))
+    """,
+    ('attract', 'cartesian'): """
+        if dist >= p1.size + p2.size:
+            force = G / dist**3
+            p1.vx -= dx * force * p2.mass
+            p1.vy -= dy * force * p2.mass
+            p2.vx += dx * force * p1.mass
+            p2.vy += dy * force * p1.mass
+    """,
+    ('combine', 'polar'): """
+        if dist < p1.size + p2.size:
+            if remove_merged:
+                env.combineParticles(p1, p2)
+            else:
+                combinePolar(p1, p2)
+    """,
+    ('combine', 'cartesian'): """
+        if dist < p1.size + p2.size:
+            if remove_merged:
+                env.combineParticles(p1, p2)
+            else:
+                combineCartesian(p1, p2)
+    """,
+    ('collide', 'polar'): """
+        if dist < p1.size + p2.size:
+            collidePolar(p1, p2, dx, dy, dist)
+    """,
+    ('collide', 'cartesian'): """
+        if dist < p1.size + p2.size:
+            collideCartesian(p1, p2, dx, dy, dist)
+    """,
+}
+
+# Pair functions that may move particles, so the distance must be measured again after them
+MOVING_FUNCTIONS = ('combine', 'collide')
+
+PLAN_PRELUDE = """
+    width = env.width
+    height = env.height
+    elasticity = env.elasticity
+    remove_merged = env.remove_merged
+    (acceleration_angle, acceleration_length) = env.acceleration
+    acceleration_sin = sin(acceleration_angle) * acceleration_length
+    acceleration_cos = cos(acceleration_angle) * acceleration_length
+"""
+
+# Counting code for telemetry, compiled into a plan only when the environment has telemetry.
+# The counters are local to each loop and handed to the telemetry once it ends.
+PLAN_COUNTING_PRELUDE = """
+    pairs_seen = broadphase = hits = bounces = merges = 0
+"""
+
+PLAN_COUNTING_EPILOGUE = """
+    env.telemetry.count(pairs_seen, broadphase, hits, bounces, merges)
+"""
+
+# Run before the snippet of the same function, with the same tests
+COUNTING_SNIPPETS = {
+    'bounce': """
+        size = p1.size
+        if p1.x > width - size or p1.x < size:
+            bounces += 1
+        if p1.y > height - size or p1.y < size:
+            bounces += 1
+    """,
+    'combine': """
+        if dist < p1.size + p2.size and (not remove_merged or env.contains(p1) and env.contains(p2)):
+            merges += 1
+    """,
+}
+
+PLAN_COUNTING_HIT = """
+    if dist < p1.size + p2.size:
+        hits += 1
+"""
+
+PLAN_DISTANCE = """
+    dx = p1.x - p2.x
+    dy = p1.y - p2.y
+    dist = hypot(dx, dy)
+"""
+
+def _indent(source, depth):
+    lines = textwrap.dedent(source).strip('\n').split('\n')
+    return ''.join('    ' * depth + line + '\n' for line in lines)
+
+class UpdatePlan:
+    """ The registered functions of an Environment compiled into fused loops.
+        Particle functions run one after another in a single pass over the particles, and pair
+        functions share one distance computation per pair, without a call per function. """
+
+    def __init__(self, env, names, velocity_mode, gravity_mode, counting=False):
+        self.names = tuple(names)
+        self.velocity_mode = velocity_mode
+        self.gravity_mode = gravity_mode
+        # Whether the loops count what they do for env.telemetry
+        self.counting = counting
+        self.namespace = {
+            'sin': math.sin, 'cos': math.cos, 'atan2': math.atan2, 'hypot': math.hypot,
+            'pi': math.pi, 'half_pi': 0.5 * math.pi, 'G': GRAVITATIONAL_CONSTANT,
+            'combinePolar': combinePolar, 'combineCartesian': combineCartesian,
+            'collidePolar': collidePolar, 'collideCartesian': collideCartesian}
+
+        singles = [name for name in names if env.function_dict[name][0] == 1]
+        pairs = [name for name in names if env.function_dict[name][0] == 2]
+        contacts = [name for name in pairs if name in CONTACT_FUNCTIONS]
+        ranges = [name for name in pairs if name not in CONTACT_FUNCTIONS]
+        if gravity_mode != 'pairs':
+            ranges = [name for name in ranges if name != 'attract']
+        self.source = {}
+
+        # Every pair of the fused loops passes the broadphase when a contact function runs on it
+        row_pairs = ''
+        if counting:
+            row_pairs = _indent('pairs_seen += len(particles) - i - 1', 2)
+            if contacts:
+                row_pairs += _indent('broadphase += len(particles) - i - 1', 2)
+
+        single_body = self.body(env, singles, 2)
+        pair_body = self.pairBody(env, pairs, 3)
+        self.step = self.compile('step', 'env, particles', """
+    for i, p1 in enumerate(particles):
+%s%s        for p2 in particles[i+1:]:
+%s""" % (single_body, row_pairs, pair_body) if pairs else """
+    for p1 in particles:
+%s""" % single_body)
+
+        self.singles = self.compile('singles', 'env, particles', """
+    for p1 in particles:
+%s""" % single_body)
+
+        # None when there are no range functions, so the caller can skip the loop over all pairs
+        self.rangePairs = ranges and self.compile('rangePairs', 'env, particles', """
+    for i, p1 in enumerate(particles):
+%s        for p2 in particles[i+1:]:
+%s""" % (counting and _indent('pairs_seen += len(particles) - i - 1', 2) or '', self.pairBody(env, ranges, 3))) or None
+
+        # The grid broadphase: the pair loop of each particle only meets the particles that
+        # neighbours(i, p1) yields, which are counted as they are taken
+        self.gridStep = self.compile('gridStep', 'env, particles, neighbours', """
+    for i, p1 in enumerate(particles):
+%s        for p2 in neighbours(i, p1):
+%s%s""" % (single_body, counting and _indent('pairs_seen += 1\nbroadphase += 1', 3) or '', self.pairBody(env, contacts, 3)))
+
+        # pairs may be any iterable of index pairs, so they are counted as they are taken
+        self.contactPairs = self.compile('contactPairs', 'env, particles, pairs', """
+    for (i, j) in pairs:
+        p1 = particles[i]
+        p2 = particles[j]
+%s%s""" % (counting and _indent('pairs_seen += 1\nbroadphase += 1', 2) or '', self.pairBody(env, contacts, 2)))
+
+    def body(self, env, names, depth):
+        source = ''
+        for name in names:
+            snippet = PLAN_SNIPPETS.get((name, self.velocity_mode))
+            if snippet is None:
+                # Functions added to function_dict by hand are called as they are
+                self.namespace['function_' + name] = env.function_dict[name][1]
+                snippet = 'function_%s(p1)' % name
+            elif self.counting and name in COUNTING_SNIPPETS:
+                source += _indent(COUNTING_SNIPPETS[name], depth)
+            source += _indent(snippet, depth)
+        return source or _indent('pass', depth)
+
+    def pairBody(self, env, names, depth):
+        if not names:
+            return _indent('pass', depth)
+        source = _indent(PLAN_DISTANCE, depth)
+        if self.counting and any(name in CONTACT_FUNCTIONS for name in names):
+            source += _indent(PLAN_COUNTING_HIT, depth)
+        for k, name in enumerate(names):
+            snippet = PLAN_SNIPPETS.get((name, self.velocity_mode))
+            moves = name in MOVING_FUNCTIONS
+            if snippet is None:
+                self.namespace['function_' + name] = env.function_dict[name][1]
+                snippet = 'function_%s(p1, p2)' % name
+                moves = True
+            elif self.counting and name in COUNTING_SNIPPETS:
+                source += _indent(COUNTING_SNIPPETS[name], depth)
+            source += _indent(snippet, depth)
+            if moves and k < len(names) - 1:
+                source += _indent(PLAN_DISTANCE, depth)
+        return source
+
+    def compile(self, name, arguments, body):
+        prelude = _indent(PLAN_PRELUDE, 1)
+        epilogue = ''
+        if self.counting:
+            prelude += _indent(PLAN_COUNTING_PRELUDE, 1)
+            epilogue = _indent(PLAN_COUNTING_EPILOGUE, 1)
+        source = 'def %s(%s):\n%s%s%s' % (name, arguments, prelude, body, epilogue)
+        self.source[name] = source
+        exec(compile(source, '<UpdatePlan %s>' % name, 'exec'), self.namespace)
+        return self.namespace[name]
+
+class TrajectoryRecorder:
+    """ Records the particles of an environment after every every-th update and appends them to a file
+        in chunks of chunk_steps recorded steps. Chunks are written by a background thread, so a step
+        only pays for copying the recorded fields. The target is under 5% of a step, which the columns
+        of an ArrayEnvironment meet, while an Environment has to read every particle's attributes. """
+
+    def __init__(self, path, fields=('id', 'x', 'y', 'speed'), every=1, chunk_steps=64):
+        for name in fields:
+            if name not in RECORD_FIELDS:
+                raise ValueError("Cannot record %s" % name)
+        self.fields = tuple(fields)
+        self.every = every
+        self.chunk_steps = chunk_steps
+        # Updates seen, and the recorded steps waiting to be handed to the writer
+        self.step = 0
+        self.chunk = []
+        self.stats = {'steps': 0, 'chunks': 0, 'bytes': 0}
+        self.error = None
+
+        self.file = open(path, 'wb')
+        header = json.dumps({'fields': self.fields, 'every': every}).encode()
+        self.file.write(TRAJECTORY_MAGIC + struct.pack('<Q', len(header)) + header)
+        # A bounded queue makes the simulation wait rather than buffer without limit if the disk falls behind
+        self.queue = queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self.write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def capture(self, env):
+        """ Called by the environment after each update """
+
+        step = self.step
+        self.step += 1
+        if step % self.every:
+            return
+        self.chunk.append((step, env.recordColumns(self.fields)))
+        self.stats['steps'] += 1
+        if len(self.chunk) >= self.chunk_steps:
+            self.flush()
+
+    def flush(self):
+        """ Hands the recorded steps to the writer """
+
+        if self.error is not None:
+            raise IOError("Trajectory writer failed: %s" % self.error)
+        if self.chunk:
+            self.queue.put(self.chunk)
+            self.chunk = []
+
+    def close(self):
+        """ Writes the remaining steps, waits for the writer and closes the file """
+
+        if self.file is None:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.file = None
+        if self.error is not None:
+            raise IOError("Trajectory writer failed: %s" % self.error)
+
+    def write(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.writeChunk(chunk)
+                except Exception as error:
+                    self.error = error
+
+    def writeChunk(self, chunk):
+        """ Writes the steps of a chunk, each field's columns one after another """
+
+        entries = []
+        buffers = []
+        offset = 0
+        for name in self.fields:
+            data = b''.join(memoryview(columns[name][1]).cast('B') for (step, columns) in chunk)
+            entries.append({'name': name, 'type': chunk[0][1][name][0], 'offset': offset, 'bytes': len(data)})
+            buffers.append(data)
+            offset += len(data)
+
+        first = self.fields[0]
+        header = json.dumps({'steps': [step for (step, columns) in chunk],
+                             'counts': [len(columns[first][1]) for (step, columns) in chunk],
+                             'columns': entries, 'size': offset}).encode()
+        self.file.write(struct.pack('<Q', len(header)) + header)
+        for data in buffers:
+            self.file.write(data)
+        self.file.flush()
+        self.stats['chunks'] += 1
+        self.stats['bytes'] += 8 + len(header) + offset
+
+def readTrajectory(path):
+    """ Yields (step, columns) for each step in a file written by a TrajectoryRecorder,
+        where columns maps each recorded field to an array of its values """
+
+    with open(path, 'rb') as f:
+        if f.read(len(TRAJECTORY_MAGIC)) != TRAJECTORY_MAGIC:
+            raise ValueError("Not a particle trajectory")
+        (length,) = struct.unpack('<Q', f.read(8))
+        json.loads(f.read(length))
+        while True:
+            prefix = f.read(8)
+            if len(prefix) < 8:
+                break
+            (length,) = struct.unpack('<Q', prefix)
+            chunk = json.loads(f.read(length))
+            data = f.read(chunk['size'])
+            if len(data) < chunk['size']:
+                # The last chunk of a recording that was cut short
+                break
+
+            values = {}
+            for entry in chunk['columns']:
+                typecode = CHECKPOINT_TYPES[entry['type'][1:]]
+                column = array.array(typecode, data[entry['offset']:entry['offset'] + entry['bytes']])
+                if entry['type'] != checkpointType(typecode):
+                    column.byteswap()
+                values[entry['name']] = column
+            start = 0
+            for (step, count) in zip(chunk['steps'], chunk['counts']):
+                yield step, {name: column[start:start + count] for (name, column) in values.items()}
+                start += count
+
 class Environment:
     """ Defines the boundary of a simulation and its properties """
+
+    # Attributes saved in a checkpoint along with the particles
+    CHECKPOINT_SETTINGS = ('width', 'height', 'colour', 'mass_of_air', 'elasticity', 'acceleration',
+                           'remove_merged', 'broadphase', 'grid_cell_size', 'gravity_mode', 'opening_angle',
+                           'velocity_mode', 'sleeping', 'sleep_speed', 'sleep_steps', 'stepping',
+                           'max_level', 'multirate_accuracy', 'compiled', 'integrator', 'dt', 'next_handle')
+
+    # How a checkpoint of this environment stores its particles
+    CHECKPOINT_LAYOUT = 'particles'
     
     def __init__(self, bounds):
         width, height = bounds
         self.width = width
         self.height = height
         self.particles = []
+
+        # Particles by handle, and particles removed during the current step
+        self.handles = {}
+        self.next_handle = 0
+        self.removals = []
+        self.updating = False
+        # Whether combine removes the absorbed particle, which then takes no further part in the step
+        self.remove_merged = False
         
         self.colour = (255,255,255)
         self.mass_of_air = 0.2
         self.elasticity = 0.75
         self.acceleration = (0,0)
         
+        self.function_names = []
         self.particle_functions1 = []
         self.particle_functions2 = []
+        self.contact_functions = []
+        self.range_functions = []
+
+        # 'pairs' tests every pair of particles, 'grid' only tests neighbours in a spatial hash, with
+        # the same results. 'sweep' keeps overlapping bounding boxes between steps and reports contact
+        # changes, running the contacts after every particle has moved, as Barnes-Hut gravity does.
+        self.broadphase = 'pairs'
+        self.grid_cell_size = None
+        self.sweep = None
+        self.contact_begin_handlers = []
+        self.contact_end_handlers = []
+
+        # Spatial index for findParticle and the other queries, built by the first query and
+        # brought up to date at the end of each update. Particles moved outside update go
+        # through moveParticle, or are picked up after invalidateIndex.
+        self.index = None
+        self.index_cell_size = None
+
+        # 'pairs' attracts every pair exactly, 'barnes_hut' approximates distant groups with a quadtree
+        self.gravity_mode = 'pairs'
+        self.opening_angle = 0.5
+        self.tree_stats = {'nodes': 0, 'visits': 0}
+
+        # 'polar' particles store (angle, speed), 'cartesian' particles store (vx, vy)
+        self.velocity_mode = 'polar'
+
+        # Whether particles whose average speed stays below sleep_speed for sleep_steps steps are put
+        # to sleep. Touching particles sleep and wake together as an island.
+        self.sleeping = False
+        self.sleep_speed = 0.05
+        self.sleep_steps = 60
+        self.sleepers = None
+        self.sleep_stats = {'awake': 0, 'asleep': 0, 'islands': 0}
+
+        # 'fixed' runs every function once per update, 'events' jumps from collision to collision,
+        # 'multirate' updates slow particles every 2nd, 4th, ... 2**max_level-th step
+        self.stepping = 'fixed'
+        self.event_engine = None
+        self.scheduler = None
+        self.max_level = 3
+        self.multirate_accuracy = 0.1
+        self.multirate_stats = {'active': 0, 'bins': []}
+
+        # How the 'integrate' function advances particles, see Integrators, and the time it advances them by
+        self.integrator = 'semi_implicit'
+        self.dt = 1
+
+        # TrajectoryRecorder given the particles after every update, see startRecording
+        self.recorder = None
+
+        # Telemetry.TelemetryBuffer the steps are counted into, see enableTelemetry
+        self.telemetry = None
+
+        # Whether update runs the registered functions through a fused UpdatePlan
+        # rather than calling them one by one
+        self.compiled = True
+        self.plan = None
         self.function_dict = {
         'move': (1, lambda p: p.move()),
         'drag': (1, lambda p: p.experienceDrag()),
         'bounce': (1, lambda p: self.bounce(p)),
         'accelerate': (1, lambda p: p.accelerate(self.acceleration)),
         'collide': (2, lambda p1, p2: collide(p1, p2)),
-        'combine': (2, lambda p1, p2: combine(p1, p2)),
-        'attract': (2, lambda p1, p2: p1.attract(p2))}
+        'combine': (2, lambda p1, p2: self.combineParticles(p1, p2)),
+        'attract': (2, lambda p1, p2: p1.attract(p2)),
+        'integrate': (1, lambda p: self.integrate(p))}
         
     def addFunctions(self, function_list):
+        self.plan = None
         for func in function_list:
             (n, f) = self.function_dict.get(func, (-1, None))
+            if n > 0:
+                self.function_names.append(func)
             if n == 1:
                 self.particle_functions1.append(f)
             elif n == 2:
                 self.particle_functions2.append(f)
+                if func in CONTACT_FUNCTIONS:
+                    self.contact_functions.append(f)
+                else:
+                    self.range_functions.append(f)
             else:
-                print("No such function: %s" % f)
+                print("No such function: %s" % func)
 
     def addParticles(self, n=1, **kargs):
         """ Add n particles with properties given by keyword arguments """
@@ -142,27 +1883,555 @@ class Environment:
             x = kargs.get('x', random.uniform(size, self.width - size))
             y = kargs.get('y', random.uniform(size, self.height - size))
 
-            particle = Particle((x, y), size, mass)
+            if self.velocity_mode == 'cartesian':
+                particle = CartesianParticle((x, y), size, mass)
+            else:
+                particle = Particle((x, y), size, mass)
             particle.speed = kargs.get('speed', random.random())
             particle.angle = kargs.get('angle', random.uniform(0, math.pi*2))
             particle.colour = kargs.get('colour', (0, 0, 255))
             particle.drag = (particle.mass/(particle.mass + self.mass_of_air)) ** particle.size
 
-            self.particles.append(particle)
+            self.addParticle(particle)
+
+    def addParticle(self, particle):
+        """ Adds a particle and returns its handle, which stays valid until the particle is removed """
+
+        particle.handle = self.next_handle
+        self.next_handle += 1
+        self.insertParticle(particle)
+        return particle.handle
+
+    def insertParticle(self, particle):
+        """ Puts a particle that already has a handle into the environment """
+
+        self.handles[particle.handle] = particle
+        particle.index = len(self.particles)
+        self.particles.append(particle)
+        if self.index is not None:
+            self.index.insert(particle)
+        if self.scheduler is not None:
+            self.scheduler.add(particle)
+
+    def getParticle(self, handle):
+        """ Returns the particle with the given handle, or None if it has been removed """
+        return self.handles.get(handle)
+
+    def removeParticle(self, particle):
+        """ Removes a particle in constant time by moving the last particle into its place.
+            During update the particle stays in the list until the end of the step.
+            Returns False if the particle was not in the environment. """
+
+        if self.contains(particle):
+            del self.handles[particle.handle]
+        elif particle not in self.particles or particle in self.removals:
+            # Particles appended to the list by hand are looked up the slow way
+            return False
+
+        if self.updating:
+            self.removals.append(particle)
+        else:
+            self.swapRemove(particle)
+        return True
+
+    def assignHandles(self):
+        """ Gives a handle to each particle appended to the list by hand, as addParticle would """
+
+        handles = self.handles
+        known = map(handles.get, map(getattr, self.particles, itertools.repeat('handle'), itertools.repeat(None)))
+        if all(map(operator.is_, known, self.particles)):
+            return
+        for particle in self.particles:
+            if not self.contains(particle):
+                particle.handle = self.next_handle
+                self.next_handle += 1
+                handles[particle.handle] = particle
+
+    def contains(self, particle):
+        """ Tests whether a particle is in the environment and not waiting to be removed """
+        return self.handles.get(getattr(particle, 'handle', None)) is particle
+
+    def combineParticles(self, p1, p2):
+        """ Runs combine, removing p2 from the environment if it merged and remove_merged is set """
+
+        if not self.remove_merged:
+            combine(p1, p2)
+        elif self.contains(p1) and self.contains(p2) and math.hypot(p1.x - p2.x, p1.y - p2.y) < p1.size + p2.size:
+            combine(p1, p2)
+            self.removeParticle(p2)
+
+    def swapRemove(self, particle):
+        particles = self.particles
+        i = getattr(particle, 'index', -1)
+        if not (0 <= i < len(particles) and particles[i] is particle):
+            # The list was changed without going through the environment
+            i = particles.index(particle)
+        last = particles.pop()
+        if last is not particle:
+            particles[i] = last
+            last.index = i
+        if self.index is not None:
+            self.index.remove(particle)
+        if self.scheduler is not None:
+            self.scheduler.remove(particle)
+        island = getattr(particle, 'island', None)
+        if island is not None:
+            island.remove(particle)
+            self.sleepers.remove(particle)
+            if not island:
+                self.sleep_stats['islands'] -= 1
+
+    def compact(self):
+        """ Takes out the particles removed during the last step """
+
+        for particle in self.removals:
+            self.swapRemove(particle)
+        self.removals = []
 
     def update(self):
         """  Moves particles and tests for collisions with the walls and each other """
-        
-        for i, particle in enumerate(self.particles):
+
+        self.updating = True
+        try:
+            self.updateStep()
+        finally:
+            self.updating = False
+            self.compact()
+            if self.index is not None:
+                self.index.refresh(self.particles)
+        if self.recorder is not None:
+            self.recorder.capture(self)
+        if self.telemetry is not None:
+            self.telemetry.endStep(self.kineticEnergy(), self.momentum())
+
+    def enableTelemetry(self, capacity=256):
+        """ Counts what each update does, keeping the last capacity updates. The counts come from
+            the compiled UpdatePlan, which is compiled again with counting code in it, or from the
+            kernels of an ArrayEnvironment. Returns the Telemetry.TelemetryBuffer. """
+
+        self.telemetry = Telemetry.TelemetryBuffer(capacity)
+        return self.telemetry
+
+    def disableTelemetry(self):
+        self.telemetry = None
+
+    def kineticEnergy(self):
+        """ Returns the total kinetic energy of the particles """
+        return sum([0.5 * p.mass * p.speed**2 for p in self.particles])
+
+    def momentum(self):
+        """ Returns the total momentum (px, py) of the particles """
+
+        particles = self.particles
+        return sum([p.mass * p.vx for p in particles]), sum([p.mass * p.vy for p in particles])
+
+    def startRecording(self, path, fields=('id', 'x', 'y', 'speed'), every=1, chunk_steps=64):
+        """ Records the given fields of the particles to a file after every every-th update,
+            until stopRecording. Returns the TrajectoryRecorder. """
+
+        self.stopRecording()
+        self.recorder = TrajectoryRecorder(path, fields, every, chunk_steps)
+        return self.recorder
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            recorder = self.recorder
+            self.recorder = None
+            recorder.close()
+
+    def recordColumns(self, fields):
+        """ Returns the fields of the particles for a TrajectoryRecorder, each as (type, array) """
+
+        if 'id' in fields:
+            self.assignHandles()
+        columns = {}
+        for name in fields:
+            typecode = RECORD_FIELDS[name]
+            # Arrays fill far faster from a list than from an iterator of unknown length
+            values = list(map(operator.attrgetter('handle' if name == 'id' else name), self.particles))
+            columns[name] = (checkpointType(typecode), array.array(typecode, values))
+        return columns
+
+    def updateStep(self):
+        if self.stepping == 'events':
+            self.updateEvents()
+            return
+
+        if self.stepping == 'multirate':
+            self.updateMultirate()
+            return
+
+        if self.sleeping:
+            self.updateSleeping()
+            return
+
+        if self.broadphase == 'sweep' or self.gravity_mode != 'pairs':
+            self.updatePhased()
+            return
+
+        self.updateInOrder(self.particles)
+
+    def updateInOrder(self, particles):
+        """ Runs the particle functions of each particle in turn, then its pair functions with each
+            later particle. The 'grid' broadphase only pairs it with the later particles it may touch,
+            which gives the same results as 'pairs'. With attract in 'pairs' gravity mode every pair
+            is visited anyway, so both run the same loop. """
+
+        if self.broadphase == 'grid' and self.contact_functions and not self.range_functions:
+            self.updateGrid(particles)
+            return
+
+        if self.compiled:
+            self.getPlan().step(self, particles)
+            return
+
+        for i, particle in enumerate(particles):
             for f in self.particle_functions1:
                 f(particle)
-            for particle2 in self.particles[i+1:]:
+            for particle2 in particles[i+1:]:
                 for f in self.particle_functions2:
                     f(particle, particle2)
 
+    def updateGrid(self, particles):
+        """ The loop of updateInOrder with the contact functions only run on the pairs the grid finds """
+
+        grid = NeighbourGrid(particles, self.gridCellSize(particles) * NEIGHBOUR_CELLS)
+        if self.compiled:
+            self.getPlan().gridStep(self, particles, grid.neighbours)
+            return
+
+        for i, particle in enumerate(particles):
+            for f in self.particle_functions1:
+                f(particle)
+            for particle2 in grid.neighbours(i, particle):
+                for f in self.contact_functions:
+                    f(particle, particle2)
+
+    def getPlan(self):
+        """ Returns the UpdatePlan for the registered functions, compiling it when they or the modes changed """
+
+        plan = self.plan
+        counting = self.telemetry is not None
+        if (plan is None or plan.velocity_mode != self.velocity_mode or plan.gravity_mode != self.gravity_mode
+                or plan.counting != counting):
+            plan = self.plan = UpdatePlan(self, self.function_names, self.velocity_mode, self.gravity_mode, counting)
+        return plan
+
+    def updateEvents(self):
+        """ Advances the event-driven engine by one time unit """
+
+        unsupported = [name for name in self.function_names if name not in EVENT_FUNCTIONS]
+        if unsupported:
+            raise ValueError("Event-driven updates cannot simulate: %s" % ', '.join(unsupported))
+
+        if self.event_engine is None:
+            self.event_engine = EventEngine(self)
+        else:
+            self.event_engine.read()
+        self.event_engine.advanceTo(self.event_engine.time + 1)
+        self.event_engine.write()
+
+    def updateMultirate(self):
+        """ Advances the particles whose timestep bin ends on this step, see MultirateScheduler """
+
+        unsupported = [name for name in self.function_names if name not in MULTIRATE_FUNCTIONS]
+        if unsupported:
+            raise ValueError("Multi-rate updates cannot simulate: %s" % ', '.join(unsupported))
+
+        if self.scheduler is None or len(self.scheduler.bins) != self.max_level + 1:
+            self.scheduler = MultirateScheduler(self)
+        self.scheduler.step()
+
+    def updatePhased(self, particles=None):
+        """ Like update, but runs particle functions, attraction and contacts as separate passes, for
+            the 'sweep' broadphase and Barnes-Hut gravity. Contacts are found on the grid with the
+            latter. Only the given particles take part, by default all of them. """
+
+        if particles is None:
+            particles = self.particles
+        plan = self.getPlan() if self.compiled else None
+        if plan:
+            plan.singles(self, particles)
+        else:
+            for particle in particles:
+                for f in self.particle_functions1:
+                    f(particle)
+
+        range_functions = self.range_functions
+        attract = self.function_dict['attract'][1]
+        if self.gravity_mode == 'barnes_hut' and attract in range_functions:
+            range_functions = [f for f in range_functions if f is not attract]
+            self.attractBarnesHut(particles)
+
+        if plan:
+            if plan.rangePairs:
+                plan.rangePairs(self, particles)
+        elif range_functions:
+            for i, particle in enumerate(particles):
+                for particle2 in particles[i+1:]:
+                    for f in range_functions:
+                        f(particle, particle2)
+
+        if self.broadphase == 'sweep':
+            self.updateSweep()
+        elif self.contact_functions:
+            if self.broadphase == 'grid' or self.gravity_mode == 'barnes_hut':
+                # Barnes-Hut is for more particles than every pair of them can be tested for contact
+                pairs = self.gridPairs(particles)
+            else:
+                pairs = itertools.combinations(range(len(particles)), 2)
+            self.runContacts(pairs, particles)
+
+    def updateSleeping(self):
+        """ Like updatePhased, but only for the awake particles. A sleeping particle is neither moved
+            nor accelerated; it wakes with its island when an awake particle touches it. Contacts use
+            the grid broadphase and attraction only acts between awake particles. """
+
+        if self.sleepers is None:
+            self.sleepers = SpatialIndex(self.gridCellSize())
+        awake = [p for p in self.particles if not p.asleep]
+
+        # Wake the islands that awake particles have run into
+        sleepers = self.sleepers
+        if sleepers.keys:
+            for p in awake[:]:
+                for q in sleepers.inRadius(p.x, p.y, p.size + sleepers.max_size):
+                    if q.asleep and math.hypot(p.x - q.x, p.y - q.y) < p.size + q.size:
+                        awake.extend(self.wakeIsland(q))
+
+        plan = self.getPlan() if self.compiled else None
+        if plan:
+            plan.singles(self, awake)
+        else:
+            for particle in awake:
+                for f in self.particle_functions1:
+                    f(particle)
+
+        range_functions = self.range_functions
+        attract = self.function_dict['attract'][1]
+        if self.gravity_mode == 'barnes_hut' and attract in range_functions:
+            range_functions = [f for f in range_functions if f is not attract]
+            self.attractBarnesHut(awake)
+        if plan:
+            if plan.rangePairs:
+                plan.rangePairs(self, awake)
+        elif range_functions:
+            for i, particle in enumerate(awake):
+                for particle2 in awake[i+1:]:
+                    for f in range_functions:
+                        f(particle, particle2)
+
+        # collide leaves particles a unit apart, so those within two units count as touching
+        pairs = self.gridPairs(awake)
+        touching = [(i, j) for (i, j) in pairs
+                    if math.hypot(awake[i].x - awake[j].x, awake[i].y - awake[j].y) < awake[i].size + awake[j].size + 2]
+        if self.contact_functions:
+            if plan:
+                plan.contactPairs(self, awake, pairs)
+            else:
+                for (i, j) in pairs:
+                    for f in self.contact_functions:
+                        f(awake[i], awake[j])
+
+        self.sleepIslands(awake, touching)
+
+    def sleepIslands(self, awake, touching):
+        """ Groups the awake particles into islands of touching particles, and puts to sleep
+            the islands whose particles have all settled """
+
+        parent = list(range(len(awake)))
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+        for (i, j) in touching:
+            (i, j) = (find(i), find(j))
+            if i != j:
+                parent[i] = j
+
+        # A particle has settled when its mean position over the last sleep_steps steps is within the
+        # distance it would cover at sleep_speed of its mean over the sleep_steps before. Particles
+        # resting in a pile keep jostling each other, pulled down by gravity and pushed back up,
+        # which the means average out. One found further than its size from the last mean moves.
+        window = self.sleep_steps
+        drift = self.sleep_speed * window
+        islands = {}
+        for i, p in enumerate(awake):
+            mean = p.still_from
+            if mean is not None and math.hypot(p.x - mean[0], p.y - mean[1]) > p.size + drift:
+                p.still_steps = 0
+                p.still_sum = (0.0, 0.0)
+                p.still_from = mean = None
+                p.settled = False
+            (sx, sy) = p.still_sum
+            p.still_sum = (sx + p.x, sy + p.y)
+            p.still_steps += 1
+            if p.still_steps == window:
+                (sx, sy) = p.still_sum
+                p.still_from = (sx / window, sy / window)
+                p.settled = mean is not None and math.hypot(p.still_from[0] - mean[0], p.still_from[1] - mean[1]) <= drift
+                p.still_steps = 0
+                p.still_sum = (0.0, 0.0)
+            islands.setdefault(find(i), []).append(p)
+
+        # Removed particles are still in the list until the end of the step
+        removed = set(id(p) for p in self.removals)
+        stats = self.sleep_stats
+        for island in islands.values():
+            if not all(p.settled for p in island):
+                continue
+            island = [p for p in island if id(p) not in removed]
+            for p in island:
+                p.asleep = True
+                p.island = island
+                p.speed = 0
+                self.sleepers.insert(p)
+            stats['islands'] += 1
+
+        stats['asleep'] = len(self.sleepers.keys)
+        stats['awake'] = len(self.particles) - len(removed) - stats['asleep']
+
+    def wakeIsland(self, particle):
+        """ Wakes a sleeping particle and the rest of its island, and returns them """
+
+        island = particle.island
+        for p in island:
+            p.asleep = False
+            p.still_steps = 0
+            p.still_sum = (0.0, 0.0)
+            p.still_from = None
+            p.settled = False
+            p.island = None
+            self.sleepers.remove(p)
+        self.sleep_stats['islands'] -= 1
+        return island
+
+    def wakeParticle(self, particle):
+        """ Wakes a particle, for example one moved by the mouse """
+        if particle.asleep:
+            self.wakeIsland(particle)
+
+    def runContacts(self, pairs, particles=None):
+        """ Runs the contact functions over an iterable of index pairs (i, j) of particles,
+            by default of all of them """
+
+        if particles is None:
+            particles = self.particles
+        if self.compiled:
+            self.getPlan().contactPairs(self, particles, pairs)
+            return
+        for (i, j) in pairs:
+            for f in self.contact_functions:
+                f(particles[i], particles[j])
+
+    def updateSweep(self):
+        """ Runs the contact functions over the pairs kept by the sweep-and-prune broadphase,
+            then calls the contact handlers for contacts that began or ended in this step """
+
+        if self.sweep is None:
+            self.sweep = SweepAndPrune()
+        pairs = self.sweep.update(self.particles)
+
+        if self.contact_functions:
+            index = dict((id(p), i) for i, p in enumerate(self.particles))
+            ordered = sorted((index[id(p1)], index[id(p2)]) if index[id(p1)] < index[id(p2)] else
+                             (index[id(p2)], index[id(p1)]) for p1, p2 in pairs)
+            self.runContacts(ordered)
+
+        (begun, ended) = self.sweep.contacts()
+        for p1, p2 in begun:
+            for handler in self.contact_begin_handlers:
+                handler(p1, p2)
+        for p1, p2 in ended:
+            for handler in self.contact_end_handlers:
+                handler(p1, p2)
+
+    def addContactBeginHandler(self, handler):
+        """ Calls handler(p1, p2) whenever two particles start to overlap (sweep broadphase only) """
+        self.contact_begin_handlers.append(handler)
+        return self
+
+    def addContactEndHandler(self, handler):
+        """ Calls handler(p1, p2) whenever two overlapping particles separate, or one of them is removed
+            (sweep broadphase only) """
+        self.contact_end_handlers.append(handler)
+        return self
+
+    def attractBarnesHut(self, particles=None):
+        """ Accelerates every particle towards the others using a quadtree built for this step """
+
+        if particles is None:
+            particles = self.particles
+        tree = QuadTree(particles)
+        accelerations = [tree.acceleration(p, self.opening_angle) for p in particles]
+        for particle, (ax, ay) in zip(particles, accelerations):
+            if ax or ay:
+                particle.accelerateXY(ax, ay)
+        self.tree_stats = {'nodes': tree.nodes, 'visits': tree.visits}
+
+    def gridCellSize(self, particles=None):
+        """ Returns the cell size of the broadphase grid, by default the largest particle diameter """
+
+        if self.grid_cell_size:
+            return self.grid_cell_size
+        if particles is None:
+            particles = self.particles
+        max_size = max([p.size for p in particles] or [0])
+        return 2 * max_size or 1
+
+    def gridPairs(self, particles=None):
+        """ Returns the index pairs (i, j), i < j, of particles in the same or adjacent grid cells """
+
+        if particles is None:
+            particles = self.particles
+        cell_size = self.gridCellSize(particles)
+        cells = {}
+        for i, p in enumerate(particles):
+            key = (int(math.floor(p.x / cell_size)), int(math.floor(p.y / cell_size)))
+            cell = cells.get(key)
+            if cell is None:
+                cells[key] = [i]
+            else:
+                cell.append(i)
+
+        pairs = []
+        for (cx, cy), cell in cells.items():
+            for a, i in enumerate(cell):
+                for j in cell[a+1:]:
+                    pairs.append((i, j))
+            for ox, oy in GRID_NEIGHBOURS:
+                other = cells.get((cx + ox, cy + oy))
+                if other is None:
+                    continue
+                for i in cell:
+                    for j in other:
+                        pairs.append((i, j) if i < j else (j, i))
+
+        pairs.sort()
+        return pairs
+
+    def integrate(self, particle):
+        """ Takes the place of move, accelerate and drag: advances a particle by dt under the
+            acceleration of the environment and the particle's drag, with the chosen integrator """
+
+        (angle, length) = self.acceleration
+        ax = math.sin(angle) * length
+        ay = -math.cos(angle) * length
+        k = Integrators.dragRate(particle.drag)
+        if k is None:
+            particle.setVelocity(0, 0)
+            return
+        (particle.x, particle.y, vx, vy) = Integrators.getIntegrator(self.integrator)(
+            particle.x, particle.y, particle.vx, particle.vy, lambda x, y, vx, vy: (ax + k*vx, ay + k*vy), self.dt)
+        particle.setVelocity(vx, vy)
+
     def bounce(self, particle):
         """ Tests whether a particle has hit the boundary of the environment """
         
+        if particle.cartesian:
+            return self.bounceCartesian(particle)
+
         if particle.x > self.width - particle.size:
             particle.x = 2*(self.width - particle.size) - particle.x
             particle.angle = - particle.angle
@@ -183,10 +2452,411 @@ class Environment:
             particle.angle = math.pi - particle.angle
             particle.speed *= self.elasticity
 
+    def bounceCartesian(self, particle):
+        """ bounce for a particle with a (vx, vy) velocity """
+
+        if particle.x > self.width - particle.size:
+            particle.x = 2*(self.width - particle.size) - particle.x
+            particle.vx *= -self.elasticity
+            particle.vy *= self.elasticity
+
+        elif particle.x < particle.size:
+            particle.x = 2*particle.size - particle.x
+            particle.vx *= -self.elasticity
+            particle.vy *= self.elasticity
+
+        if particle.y > self.height - particle.size:
+            particle.y = 2*(self.height - particle.size) - particle.y
+            particle.vx *= self.elasticity
+            particle.vy *= -self.elasticity
+
+        elif particle.y < particle.size:
+            particle.y = 2*particle.size - particle.y
+            particle.vx *= self.elasticity
+            particle.vy *= -self.elasticity
+
+    def checkpointHeader(self):
+        """ Returns the settings and registered functions of the environment, for a checkpoint """
+
+        return {'layout': self.CHECKPOINT_LAYOUT, 'count': len(self.particles),
+                'settings': {name: getattr(self, name) for name in self.CHECKPOINT_SETTINGS},
+                'functions': list(self.function_names)}
+
+    def applyCheckpointHeader(self, header):
+        for (name, value) in header['settings'].items():
+            setattr(self, name, tuple(value) if isinstance(value, list) else value)
+        self.addFunctions(header['functions'])
+
+    def save(self, path):
+        """ Writes the particles, settings, registered functions and the state of the random
+            module to a checkpoint file at path. Particles are stored as columns of numbers. """
+
+        self.compact()
+        self.assignHandles()
+        particles = self.particles
+        n = len(particles)
+        header = self.checkpointHeader()
+        (version, state, gauss) = random.getstate()
+        header['random'] = [version, list(state), gauss]
+
+        # Cartesian particles store (vx, vy) in the velocity column, the others (speed, angle)
+        velocity = array.array('d')
+        for p in particles:
+            velocity.extend((p.vx, p.vy) if p.cartesian else (p.speed, p.angle))
+        colour = array.array('B')
+        for p in particles:
+            colour.extend(p.colour)
+        def column(name, typecode, values):
+            return (name, checkpointType(typecode), (n,), array.array(typecode, values))
+
+        writeCheckpoint(path, header, [
+            column('handle', 'q', [p.handle for p in particles]),
+            column('x', 'd', [p.x for p in particles]),
+            column('y', 'd', [p.y for p in particles]),
+            column('size', 'd', [p.size for p in particles]),
+            column('mass', 'd', [p.mass for p in particles]),
+            column('drag', 'd', [p.drag for p in particles]),
+            column('elasticity', 'd', [p.elasticity for p in particles]),
+            ('velocity', checkpointType('d'), (n, 2), velocity),
+            column('cartesian', 'B', [p.cartesian for p in particles]),
+            ('colour', checkpointType('B'), (n, 3), colour),
+            column('thickness', 'i', [p.thickness for p in particles])])
+
+    @classmethod
+    def load(cls, path):
+        """ Returns an environment restored from a checkpoint file written by save,
+            and restores the state of the random module """
+
+        with open(path, 'rb') as f:
+            (header, start) = readCheckpointHeader(f)
+            if header['layout'] != cls.CHECKPOINT_LAYOUT:
+                raise ValueError("Checkpoint of %s, not %s" % (header['layout'], cls.CHECKPOINT_LAYOUT))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        columns = {}
+        for entry in header['columns']:
+            typecode = CHECKPOINT_TYPES[entry['type'][1:]]
+            size = array.array(typecode).itemsize
+            count = 1
+            for length in entry['shape']:
+                count *= length
+            view = memoryview(data)[start + entry['offset']:start + entry['offset'] + count*size]
+            if entry['type'] == checkpointType(typecode):
+                columns[entry['name']] = view.cast(typecode).tolist()
+            else:
+                # Written on a machine of the other byte order
+                values = array.array(typecode, view.tobytes())
+                values.byteswap()
+                columns[entry['name']] = values.tolist()
+            view.release()
+        data.close()
+
+        env = cls((header['settings']['width'], header['settings']['height']))
+        env.applyCheckpointHeader(header)
+        velocity = columns['velocity']
+        colour = columns['colour']
+        for i in range(header['count']):
+            pos = (columns['x'][i], columns['y'][i])
+            if columns['cartesian'][i]:
+                particle = CartesianParticle(pos, columns['size'][i], columns['mass'][i])
+                (particle.vx, particle.vy) = velocity[2*i:2*i + 2]
+            else:
+                particle = Particle(pos, columns['size'][i], columns['mass'][i])
+                (particle.speed, particle.angle) = velocity[2*i:2*i + 2]
+            particle.drag = columns['drag'][i]
+            particle.elasticity = columns['elasticity'][i]
+            particle.colour = tuple(colour[3*i:3*i + 3])
+            particle.thickness = columns['thickness'][i]
+            env.next_handle = columns['handle'][i]
+            env.addParticle(particle)
+        env.next_handle = header['settings']['next_handle']
+
+        (version, state, gauss) = header['random']
+        random.setstate((version, tuple(state), gauss))
+        return env
+
+    def bytesPerParticle(self):
+        """ Returns the average memory used by each particle object, see objectSize """
+        if not self.particles:
+            return 0
+        return sum(objectSize(p) for p in self.particles) / len(self.particles)
+
+    def getIndex(self):
+        """ Returns the spatial index, building it on the first call and after invalidateIndex """
+
+        if self.index is None:
+            self.index = SpatialIndex(self.index_cell_size or self.gridCellSize())
+        if self.index.stale:
+            self.index.refresh(self.particles)
+        return self.index
+
+    def invalidateIndex(self):
+        """ Makes the next query place every particle again, for particles moved, grown, added
+            or taken out by hand between updates """
+        if self.index is not None:
+            self.index.stale = True
+
+    def moveParticle(self, particle, x, y):
+        """ Moves a particle to x, y between updates, keeping the spatial index up to date """
+
+        particle.x = x
+        particle.y = y
+        if self.index is not None and not self.index.stale:
+            self.index.move(particle)
+
     def findParticle(self, x, y):
-        """ Returns any particle that occupies position x, y """
-        
-        for particle in self.particles:
-            if math.hypot(particle.x - x, particle.y - y) <= particle.size:
-                return particle
-        return None
+        """ Returns the particle that occupies position x, y, or None.
+            Where particles overlap, the one with the nearest centre is returned. """
+        return self.getIndex().at(x, y)
+
+    def findParticlesInRadius(self, x, y, radius):
+        """ Returns the particles whose centre is within radius of x, y """
+        return self.getIndex().inRadius(x, y, radius)
+
+    def findParticlesInRect(self, x0, y0, x1, y1):
+        """ Returns the particles whose centre lies in the rectangle from x0, y0 to x1, y1 """
+        return self.getIndex().inRect(x0, y0, x1, y1)
+
+    def findNearestParticles(self, x, y, k=1):
+        """ Returns the k particles with centres nearest to x, y, nearest first """
+        return self.getIndex().nearest(x, y, k)
+
+# The numbers a frozen chunk keeps for each particle. Velocity is (speed, angle) or, for
+# cartesian particles, (vx, vy); the colour is packed into one number.
+CHUNK_FIELDS = ('handle', 'x', 'y', 'size', 'mass', 'u', 'v', 'drag', 'elasticity', 'cartesian', 'colour', 'thickness')
+
+class Chunk:
+    """ The particles of one chunk of a ChunkedEnvironment. While the chunk is frozen they are packed
+        into an array of CHUNK_FIELDS numbers each, except those carrying attributes of their own,
+        such as collide_with, which are kept as they are. """
+
+    __slots__ = ('key', 'particles', 'packed', 'kept', 'state')
+
+    def __init__(self, key):
+        self.key = key
+        # Particles by handle while the chunk is thawed
+        self.particles = {}
+        self.packed = None
+        self.kept = None
+        # 'active', 'drifting' or 'frozen'
+        self.state = 'frozen'
+
+    def __len__(self):
+        if self.packed is None:
+            return len(self.particles)
+        return len(self.packed) // len(CHUNK_FIELDS) + len(self.kept)
+
+class ChunkedEnvironment(Environment):
+    """ An Environment without walls whose world is split into chunks the size of its bounds.
+        Only chunks near the view given by setView are simulated: chunks within active_radius
+        chunks of it fully, chunks within drift_radius by the particle functions alone, leaving
+        out the pair functions. Further chunks are frozen and their particles packed into arrays
+        until the view comes near again, so memory and time follow the area around the view
+        rather than the size of the world.
+
+        Queries and the particles list only see particles of thawed chunks. A frozen chunk's
+        particles are recreated when it thaws, so keep handles rather than particles. """
+
+    CHECKPOINT_SETTINGS = Environment.CHECKPOINT_SETTINGS + ('active_radius', 'drift_radius', 'view')
+
+    def __init__(self, bounds):
+        Environment.__init__(self, bounds)
+        del self.function_dict['bounce']
+        self.broadphase = 'grid'
+        self.active_radius = 1
+        self.drift_radius = 3
+        # The part of the world on screen, as (x0, y0, x1, y1)
+        self.view = (0, 0, self.width, self.height)
+
+        self.chunks = {}
+        # Chunks whose particles are objects, and the chunk of every particle by handle
+        self.thawed = {}
+        self.chunk_of = {}
+        self.chunk_stats = {'active': 0, 'drifting': 0, 'frozen': 0, 'packed': 0}
+
+    def chunkKey(self, x, y):
+        return (int(math.floor(x / self.width)), int(math.floor(y / self.height)))
+
+    def setView(self, x0, y0, x1, y1):
+        """ Sets the part of the world on screen, thawing and freezing chunks to match """
+        self.view = (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+        self.updateChunks()
+
+    def addParticle(self, particle):
+        handle = Environment.addParticle(self, particle)
+        self.placeParticle(particle, self.chunkKey(particle.x, particle.y))
+        return handle
+
+    def getParticle(self, handle):
+        """ Returns the particle with the given handle, thawing its chunk if it is frozen """
+
+        key = self.chunk_of.get(handle)
+        if handle not in self.handles and key is not None:
+            self.thaw(self.chunks[key])
+        return self.handles.get(handle)
+
+    def swapRemove(self, particle):
+        Environment.swapRemove(self, particle)
+        key = self.chunk_of.pop(particle.handle, None)
+        if key is not None:
+            chunk = self.chunks[key]
+            del chunk.particles[particle.handle]
+            self.dropIfEmpty(chunk)
+
+    def placeParticle(self, particle, key):
+        """ Adds a particle of the environment to the chunk at key """
+
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self.chunks[key] = Chunk(key)
+        self.chunk_of[particle.handle] = key
+        if chunk.packed is None:
+            chunk.particles[particle.handle] = particle
+            self.thawed[key] = chunk
+        else:
+            # A particle that wanders into a frozen chunk freezes with it
+            self.pack(chunk, particle)
+
+    def dropIfEmpty(self, chunk):
+        if not len(chunk):
+            del self.chunks[chunk.key]
+            self.thawed.pop(chunk.key, None)
+
+    def pack(self, chunk, particle):
+        """ Takes a particle out of the environment into the packed rows of a frozen chunk """
+
+        if getattr(particle, '__dict__', None):
+            chunk.kept.append(particle)
+        elif particle.cartesian:
+            chunk.packed.extend((particle.handle, particle.x, particle.y, particle.size, particle.mass,
+                                 particle.vx, particle.vy, particle.drag, particle.elasticity, 1,
+                                 self.packColour(particle.colour), particle.thickness))
+        else:
+            chunk.packed.extend((particle.handle, particle.x, particle.y, particle.size, particle.mass,
+                                 particle.speed, particle.angle, particle.drag, particle.elasticity, 0,
+                                 self.packColour(particle.colour), particle.thickness))
+        del self.handles[particle.handle]
+        Environment.swapRemove(self, particle)
+
+    def packColour(self, colour):
+        (r, g, b) = colour[:3]
+        return (r << 16) | (g << 8) | b
+
+    def freeze(self, chunk):
+        chunk.state = 'frozen'
+        if chunk.packed is not None:
+            return
+        chunk.packed = array.array('d')
+        chunk.kept = []
+        for particle in chunk.particles.values():
+            self.pack(chunk, particle)
+        chunk.particles = {}
+        del self.thawed[chunk.key]
+
+    def thaw(self, chunk):
+        """ Recreates the particles of a frozen chunk """
+
+        if chunk.packed is None:
+            return
+        packed = chunk.packed
+        width = len(CHUNK_FIELDS)
+        for row in range(0, len(packed), width):
+            (handle, x, y, size, mass, u, v, drag, elasticity, cartesian, colour, thickness) = packed[row:row + width]
+            if cartesian:
+                particle = CartesianParticle((x, y), size, mass)
+                particle.setVelocity(u, v)
+            else:
+                particle = Particle((x, y), size, mass)
+                (particle.speed, particle.angle) = (u, v)
+            particle.drag = drag
+            particle.elasticity = elasticity
+            colour = int(colour)
+            particle.colour = (colour >> 16, (colour >> 8) & 255, colour & 255)
+            particle.thickness = int(thickness)
+            particle.handle = int(handle)
+            chunk.particles[particle.handle] = particle
+            self.insertParticle(particle)
+        for particle in chunk.kept:
+            chunk.particles[particle.handle] = particle
+            self.insertParticle(particle)
+        chunk.packed = None
+        chunk.kept = None
+        self.thawed[chunk.key] = chunk
+
+    def updateChunks(self):
+        """ Sets the state of each chunk from its distance to the view, in chunks """
+
+        (x0, y0, x1, y1) = self.view
+        (cx0, cy0) = self.chunkKey(x0, y0)
+        (cx1, cy1) = self.chunkKey(x1, y1)
+        def distance(key):
+            return max(cx0 - key[0], key[0] - cx1, cy0 - key[1], key[1] - cy1, 0)
+
+        for chunk in list(self.thawed.values()):
+            if distance(chunk.key) > self.drift_radius:
+                self.freeze(chunk)
+
+        # Look up the chunks around the view, or go through all chunks when there are fewer of them
+        r = self.drift_radius
+        area = (cx1 - cx0 + 2*r + 1) * (cy1 - cy0 + 2*r + 1)
+        if area < len(self.chunks):
+            near = [self.chunks[key] for key in
+                    ((kx, ky) for kx in range(cx0 - r, cx1 + r + 1) for ky in range(cy0 - r, cy1 + r + 1))
+                    if key in self.chunks]
+        else:
+            near = [chunk for chunk in self.chunks.values() if distance(chunk.key) <= r]
+        for chunk in near:
+            self.thaw(chunk)
+            chunk.state = 'active' if distance(chunk.key) <= self.active_radius else 'drifting'
+
+        stats = self.chunk_stats
+        stats['active'] = sum(1 for chunk in near if chunk.state == 'active')
+        stats['drifting'] = len(near) - stats['active']
+        stats['frozen'] = len(self.chunks) - len(near)
+        stats['packed'] = len(self.chunk_of) - len(self.particles)
+
+    def updateStep(self):
+        if self.stepping != 'fixed' or self.sleeping or self.broadphase == 'sweep':
+            raise ValueError("A ChunkedEnvironment only supports fixed steps with the 'pairs' or 'grid' broadphase")
+
+        self.updateChunks()
+        active = []
+        drifting = []
+        for key in sorted(self.thawed):
+            chunk = self.thawed[key]
+            if chunk.state == 'active':
+                active.extend(chunk.particles.values())
+            elif chunk.state == 'drifting':
+                drifting.extend(chunk.particles.values())
+
+        if drifting:
+            if self.compiled:
+                self.getPlan().singles(self, drifting)
+            else:
+                for particle in drifting:
+                    for f in self.particle_functions1:
+                        f(particle)
+        if active:
+            if self.gravity_mode == 'pairs':
+                self.updateInOrder(active)
+            else:
+                self.updatePhased(active)
+
+        # Move particles that left their chunk, except those about to be removed
+        removed = set(id(p) for p in self.removals)
+        for particle in active + drifting:
+            key = self.chunkKey(particle.x, particle.y)
+            old = self.chunk_of[particle.handle]
+            if key != old and id(particle) not in removed:
+                chunk = self.chunks[old]
+                del chunk.particles[particle.handle]
+                self.placeParticle(particle, key)
+                self.dropIfEmpty(chunk)
+
+    def save(self, path):
+        """ Writes a checkpoint of all particles, frozen ones included """
+
+        for chunk in list(self.chunks.values()):
+            self.thaw(chunk)
+        Environment.save(self, path)
+        self.updateChunks()
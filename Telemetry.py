@@ -0,0 +1,74 @@
+""" Counters of what each physics step did, kept for the last steps in a fixed-size ring buffer.
+
+    PyParticles.Environment.update and flipper.Game.ballBounce add to the counters of the current
+    step and record it when telemetry is enabled on them, see their enableTelemetry. While it is
+    disabled they run the same code they would without it. """
+
+import array
+
+# The values recorded for each step. pairs counts the pairs of particles or objects looked at,
+# broadphase those passed on to the contact tests, hits those found touching, bounces the bounces
+# off the walls and merges the particles combined.
+TELEMETRY_FIELDS = ('pairs', 'broadphase', 'hits', 'bounces', 'merges', 'kinetic_energy', 'momentum_x', 'momentum_y')
+COUNTERS = TELEMETRY_FIELDS[:5]
+
+class TelemetryBuffer:
+    """ The values of the last capacity steps, oldest first, in one preallocated array """
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self.rows = array.array('d', bytes(8 * capacity * len(TELEMETRY_FIELDS)))
+        self.steps = 0
+        self.current = [0] * len(COUNTERS)
+
+    def __len__(self):
+        return min(self.steps, self.capacity)
+
+    def count(self, pairs=0, broadphase=0, hits=0, bounces=0, merges=0):
+        """ Adds to the counters of the current step """
+
+        current = self.current
+        current[0] += pairs
+        current[1] += broadphase
+        current[2] += hits
+        current[3] += bounces
+        current[4] += merges
+
+    def endStep(self, kinetic_energy, momentum):
+        """ Records the current step with the total kinetic energy and momentum (px, py) after it,
+            in place of the oldest step once the buffer is full """
+
+        width = len(TELEMETRY_FIELDS)
+        start = (self.steps % self.capacity) * width
+        self.rows[start:start + width] = array.array('d', self.current + [kinetic_energy, momentum[0], momentum[1]])
+        self.current = [0] * len(COUNTERS)
+        self.steps += 1
+
+    def clear(self):
+        self.steps = 0
+        self.current = [0] * len(COUNTERS)
+
+    def step(self, k):
+        """ Returns the k-th oldest recorded step as a dict, counting from -1 for the latest """
+
+        n = len(self)
+        if not -n <= k < n:
+            raise IndexError("No step %d in %d recorded steps" % (k, n))
+        width = len(TELEMETRY_FIELDS)
+        start = ((self.steps - n + k % n) % self.capacity) * width
+        return dict(zip(TELEMETRY_FIELDS, self.rows[start:start + width]))
+
+    def latest(self):
+        """ Returns the last recorded step, or None before the first """
+        return self.step(-1) if self.steps else None
+
+    def history(self, name):
+        """ Returns the recorded values of one field, oldest first """
+
+        field = TELEMETRY_FIELDS.index(name)
+        width = len(TELEMETRY_FIELDS)
+        values = self.rows[field::width].tolist()
+        if self.steps <= self.capacity:
+            return values[:self.steps]
+        oldest = self.steps % self.capacity
+        return values[oldest:] + values[:oldest]
@@ -1,6 +1,7 @@
 # Template for 2d-graph library.
 
-import pygame, random, math, time, threading
+import pygame, random, math, time, threading, gc, sys
+import DistanceField, Integrators, Telemetry
 pygame.display.init()
 pygame.font.init()
 ######################################################################
@@ -22,7 +23,12 @@ class Object2D:
     
     """
     " Parent class for 2D objects.
+    " Fields are kept in slots, and the handler and animation lists stay an
+    " empty tuple until something is added to them.
     """
+    __slots__ = ('_position', '_color', '_click_handlers', '_mouse_drag_handlers',
+                 '_draw_handlers', '_animations', '_rotation', '__dict__')
+
     def __init__(self, corners, color = 'White'):
         '''
         ' (x,y) is the position of the object.
@@ -33,10 +39,10 @@ class Object2D:
             listOfCorners.append(list(corner))
         self._position = listOfCorners
         self._color = color
-        self._click_handlers = []
-        self._mouse_drag_handlers = []
-        self._draw_handlers = []
-        self._animations = []
+        self._click_handlers = ()
+        self._mouse_drag_handlers = ()
+        self._draw_handlers = ()
+        self._animations = ()
         self._rotation = 0
         
         
@@ -48,11 +54,15 @@ class Object2D:
         return self._click_handlers
     
     def addClickHandler(self, handler, index = -1):
+        if not self._click_handlers:
+            self._click_handlers = []
         index = max(index, min(len(self._click_handlers), 0) )
         self._click_handlers.insert(index, handler)
         return self
         
     def removeClickHandler(self, handler):
+        if not self._click_handlers:
+            self._click_handlers = []
         self._click_handlers.remove(handler)
         return self
     
@@ -69,11 +79,15 @@ class Object2D:
         return self._mouse_drag_handlers
     
     def addMouseDragHandler(self, handler, index = -1):
+        if not self._mouse_drag_handlers:
+            self._mouse_drag_handlers = []
         index = max(index, min(len(self._mouse_drag_handlers), 0) )
         self._mouse_drag_handlers.insert(index, handler)
         return self
         
     def removeMouseDragHandler(self, handler):
+        if not self._mouse_drag_handlers:
+            self._mouse_drag_handlers = []
         self._mouse_drag_handlers.remove(handler)
         return self
 
@@ -87,11 +101,15 @@ class Object2D:
     #####           DRAW HANDLERS             #####
     ##################################################
     def addDrawHandler(self, handler, zindex = -1):
+        if not self._draw_handlers:
+            self._draw_handlers = []
         zindex = max(zindex, min(len(self._draw_handlers), 0) )
         self._draw_handlers.insert(zindex, handler)
         return self
         
     def removeDrawHandler(self, handler):
+        if not self._draw_handlers:
+            self._draw_handlers = []
         self._draw_handlers.remove(handler)
         return self
     
@@ -118,6 +136,25 @@ class Object2D:
     
     def getRotation(self):
         return self._rotation
+
+    def getMemorySize(self):
+        '''
+        ' Bytes used by the object, its attribute dictionary, its corner and
+        ' handler lists and the numbers they hold. Images are not counted.
+        '''
+        size = sys.getsizeof(self)
+        pending = gc.get_referents(self)
+        while pending:
+            ref = pending.pop()
+            if type(ref) is dict:
+                size += sys.getsizeof(ref)
+                pending.extend(ref.values())
+            elif type(ref) is list:
+                size += sys.getsizeof(ref)
+                pending.extend(ref)
+            elif type(ref) is float:
+                size += sys.getsizeof(ref)
+        return size
             
             
     
@@ -129,17 +166,20 @@ class Object2D:
         return self._animations
     
     def addAnimation(self, animation):
+        if not self._animations:
+            self._animations = []
         self._animations.append(animation)
         return self
     
     def stopAnimation(self, anim):
+        if not self._animations:
+            self._animations = []
         self._animations.remove(anim)
     
     def stopAnimations(self):
         for animation in self.getAnimations():
             animation.stop()
-        del self._animations[:]
-        self._animations = []
+        self._animations = ()
         return self
     
     
@@ -248,6 +288,8 @@ class Object2D:
                 ani.last = time.time()
     
 class Point( Object2D ):
+    __slots__ = ()
+
     def __init__(self, x, y, color = 'White'):
         Object2D.__init__(self, [[x, y]], color = color)
         
@@ -262,6 +304,7 @@ class Point( Object2D ):
         return [x, y] == self.getPosition()[0]
 
 class Text( Object2D ):
+    __slots__ = ('message',)
 
     def __init__(self, pos, message, color = "white"):
         Object2D.__init__(self, [pos], color)
@@ -273,6 +316,8 @@ class Text( Object2D ):
         display.blit(FONT.render(self.message, False, (0, 0, 0)), self.getPosition()[0])
 
 class Line( Object2D ):
+    __slots__ = ()
+
     def __init__(self, points, color = 'White'):
         Object2D.__init__(self, points, color)
         
@@ -293,7 +338,11 @@ class Line( Object2D ):
 class Circle( Object2D ):
     """
     " Class for a circle.
+    " The radius has no slot, so that CircleWithImage can also inherit the
+    " slots of Image.
     """
+    __slots__ = ()
+
     def __init__(self, x, y, r, fillColor = "transparent"):
         Object2D.__init__(self, [[x, y]], color = fillColor)
         assert r > 0, "Radius must be greater than 0"
@@ -339,6 +388,8 @@ class Polygon( Object2D ):
     """
     " Class for a polygon.
     """
+    __slots__ = ()
+
     def __init__(self, corners, fillColor = "transparent"):
         
         assert len(corners) >= 2, "Corners must be a list of at least 2 elements"
@@ -380,7 +431,8 @@ class Polygon( Object2D ):
         self.setPosition(p)
     
 class Image(Object2D):
-    
+    __slots__ = ('_path', '_img', '_width', '_height')
+
     def __init__(self, imagePath, x, y):
         Object2D.__init__(self, [[x, y]])
         self.load(imagePath)
@@ -496,6 +548,10 @@ class Frame:
         self._key_up = []
         self._draw_handlers = []
         self._objects = []
+        # Changed whenever objects are added or removed
+        self._version = 0
+        # getBytesPerObject as of a version
+        self._bytes_per_object = (None, 0)
         self._click_handlers = []
         self._clock = pygame.time.Clock()
         self._event_handlers = {
@@ -522,19 +578,35 @@ class Frame:
     def getObjects(self):
         return self._objects
 
+    def getVersion(self):
+        return self._version
+
     def addObject(self, obj, zindex = -1):
         zindex = max(zindex, min(len(self._objects), 0) )
         self._objects.insert(zindex, obj)
+        self._version += 1
         return self
     
     def addObjects(self, objects):
         for obj in objects:
             self._objects.append(obj)
+        self._version += 1
         return self
     
     def removeObject(self, obj):
         self._objects.remove(obj)
+        self._version += 1
         return self
+
+    def getBytesPerObject(self):
+        '''
+        ' Average getMemorySize of the objects, measured again only once objects were added or removed.
+        '''
+        (version, size) = self._bytes_per_object
+        if version != self._version:
+            size = sum(obj.getMemorySize() for obj in self._objects) / len(self._objects) if self._objects else 0
+            self._bytes_per_object = (self._version, size)
+        return size
     
     
     def getWidth(self):
@@ -598,7 +670,8 @@ class Frame:
         return self._fps
                 
 class CircleWithImage(Image, Circle):
-    
+    __slots__ = ('_radius', 'origBounds')
+
     def __init__(self, x, y, r, uri):
         Circle.__init__(self, x, y, r, "transparent")
         Image.__init__(self, uri, x, y)
@@ -619,7 +692,8 @@ class CircleWithImage(Image, Circle):
     
                 
 class Ball(CircleWithImage):
-    
+    __slots__ = ('_angle', '_speed')
+
     def __init__(self, x, y, r, uri):
         CircleWithImage.__init__(self, x, y, r, uri)
         self._angle = self._speed = 0
@@ -636,7 +710,38 @@ class Ball(CircleWithImage):
     def setSpeed(self, speed):
         self._speed = speed
         
-   
+class CartesianBall(Ball):
+    """
+    " Ball that stores its velocity as (vx, vy), with angle and speed computed on demand.
+    """
+    __slots__ = ('_vx', '_vy')
+
+    def __init__(self, x, y, r, uri):
+        Ball.__init__(self, x, y, r, uri)
+        self._vx = self._vy = 0
+        
+    def getVelocity(self):
+        return (self._vx, self._vy)
+    
+    def setVelocity(self, vx, vy):
+        self._vx = vx
+        self._vy = vy
+        
+    def getAngle(self):
+        return math.atan2(self._vx, -self._vy)
+    
+    def setAngle(self, angle):
+        speed = self.getSpeed()
+        self._vx = math.sin(angle) * speed
+        self._vy = -math.cos(angle) * speed
+        
+    def getSpeed(self):
+        return math.hypot(self._vx, self._vy)
+    
+    def setSpeed(self, speed):
+        angle = self.getAngle()
+        self._vx = math.sin(angle) * speed
+        self._vy = -math.cos(angle) * speed
         
 class FlipperFrame(Frame):
     
@@ -662,7 +767,8 @@ class FlipperFrame(Frame):
         Frame.draw(self, display)
             
 class BackgroundImage(Image):
-    
+    __slots__ = ('_frame',)
+
     def __init__(self, frame, image_uri, x, y):
         Image.__init__(self, image_uri, x, y)
         self._frame = frame
@@ -670,7 +776,13 @@ class BackgroundImage(Image):
         self.scale(bounds)
         
 class GameObject():
-    
+    """
+    " Mixin for the objects of the table. It has no storage of its own, since
+    " it is always combined with an Object2D: subclasses add FIELDS to their slots.
+    """
+    __slots__ = ()
+    FIELDS = ('_points', '_passive', 'last_rollover', 'delay')
+
     def __init__(self, points, passive, delay):
         self._points = points
         self._passive = passive
@@ -700,7 +812,8 @@ class GameObject():
         return 1
         
 class Paddle(GameObject, Polygon):
-    
+    __slots__ = GameObject.FIELDS + ('direction', 'angle', 'max_angle', 'isLeft', 'animation')
+
     def __init__(self, corners, isLeft, fillColor = "transparent"):
         Polygon.__init__(self, corners, fillColor)
         self.direction = -1
@@ -749,7 +862,8 @@ class Paddle(GameObject, Polygon):
         return self.goesUp() and self.animation is not None
     
 class RolloverPoint(GameObject, CircleWithImage):
-    
+    __slots__ = GameObject.FIELDS + ('imgs',)
+
     def __init__(self, x, y, r, im1, im2, val):
         CircleWithImage.__init__(self, x, y, r, im1)
         GameObject.__init__(self, val, True, 0.5)
@@ -767,7 +881,8 @@ class RolloverPoint(GameObject, CircleWithImage):
         self.addAnimation(Animation(self, 500, self.switchImage, 1))
         
 class Boundary(GameObject, Polygon):
-    
+    __slots__ = GameObject.FIELDS + ('_bounds',)
+
     def __init__(self, corners):
         Polygon.__init__(self, corners, pygame.Color("red"))
         GameObject.__init__(self, 0, False, 0)
@@ -780,7 +895,8 @@ class Boundary(GameObject, Polygon):
         return
     
 class Bouncer(GameObject, CircleWithImage):
-    
+    __slots__ = GameObject.FIELDS + ('imgs',)
+
     def __init__(self, x, y, r, im1, im2):
         CircleWithImage.__init__(self, x, y, r, im1)
         GameObject.__init__(self, 1000, False, 0.2)
@@ -932,11 +1048,202 @@ class Physics():
 
         return (angle, length)
 
+    def sweepCircle(start, end, centre, radius):
+        """
+        " Returns the first t in [0, 1] at which a point moving from start to end comes within
+        " radius of centre, or None if it does not or already is.
+        """
+        (sx, sy) = start
+        dx = end[0] - sx
+        dy = end[1] - sy
+        fx = sx - centre[0]
+        fy = sy - centre[1]
+        c = fx*fx + fy*fy - radius*radius
+        b = fx*dx + fy*dy
+        a = dx*dx + dy*dy
+        if c <= 0 or b >= 0 or a == 0:
+            return None
+        disc = b*b - a*c
+        if disc < 0:
+            return None
+        t = (-b - math.sqrt(disc)) / a
+        return t if t <= 1 else None
+
+    def sweepSegment(start, end, line, radius):
+        """
+        " Returns the first t in [0, 1] at which a circle of radius moving from start to end
+        " touches the segment line, or None if it does not or already does.
+        """
+        (ax, ay), (bx, by) = line
+        ex = bx - ax
+        ey = by - ay
+        length2 = ex*ex + ey*ey
+        first = None
+        if length2 > 0:
+            length = math.sqrt(length2)
+            nx = -ey / length
+            ny = ex / length
+            ds = (start[0] - ax)*nx + (start[1] - ay)*ny
+            de = (end[0] - ax)*nx + (end[1] - ay)*ny
+            # Crossing the side of the segment, offset by radius towards start
+            side = radius if ds > 0 else -radius
+            if abs(ds) > radius and (de - side) * (ds - side) <= 0:
+                t = (ds - side) / (ds - de)
+                px = start[0] + t*(end[0] - start[0])
+                py = start[1] + t*(end[1] - start[1])
+                if 0 <= (px - ax)*ex + (py - ay)*ey <= length2:
+                    first = t
+        # or hitting one of its ends
+        for corner in line:
+            t = Physics.sweepCircle(start, end, corner, radius)
+            if t is not None and (first is None or t < first):
+                first = t
+        return first
+
     def getNewSpeedFromDistance(line, point):
         dist = math.hypot(line[0][0] - point[0], line[0][1] - point[1])
         lineLen = math.hypot(line[0][0] - line[1][0], line[0][1] - line[1][1])
         return 1 + (dist * 0.9 / lineLen) + (random.random() / 2.0)
 
+# How far inside the touching distance a swept ball is stopped, see Game.touchDistance
+CONTACT_OVERLAP = 0.01
+
+class StaticGeometry():
+    """
+    " The edges of the Boundary polygons and the other static circles of the table, such as the
+    " Bouncers, compiled into a flat soup of primitives under a bounding volume hierarchy, so that
+    " Game.ballBounce only tests the primitives near the ball. The paddles move, and are left to
+    " ballBounce to test every tick along with any other GameObject.
+    "
+    " Given a DistanceField of the Boundary polygons, they are left out and the field stands in
+    " for all of them, as the object at the frame index of the first, walls.
+    """
+    LEAF_SIZE = 4
+
+    def __init__(self, objects, version, field=None, walls=None):
+        # The Frame version the objects are from
+        self.version = version
+        self.field = field
+        self.walls = walls
+        self.fieldIndex = None
+        # Frame indices of the compiled Boundary polygons and of the GameObjects tested every tick
+        self.polygons = set()
+        self.dynamic = []
+        # Per primitive: its bounding box (x0, y0, x1, y1), the frame index of its object, and
+        # for an edge the line [p1, p2] and the place getNearestPointOnLine visits it in
+        self.boxes = []
+        self.owners = []
+        self.edges = []
+        self.ranks = []
+        for index, obj in enumerate(objects):
+            if not isinstance(obj, GameObject):
+                continue
+            if isinstance(obj, Boundary) and field is not None:
+                if self.fieldIndex is None:
+                    self.fieldIndex = index
+                    self.dynamic.append(index)
+            elif isinstance(obj, Boundary):
+                self.polygons.add(index)
+                corners = obj.getPosition()
+                n = len(corners)
+                for j in range(n):
+                    (p1, p2) = (corners[j], corners[(j + 1) % n])
+                    self.boxes.append((min(p1[0], p2[0]), min(p1[1], p2[1]), max(p1[0], p2[0]), max(p1[1], p2[1])))
+                    self.owners.append(index)
+                    self.edges.append([p1, p2])
+                    self.ranks.append((j + 1) % n)
+            elif isinstance(obj, Circle):
+                rect = obj.getBoundingRectangle()
+                self.boxes.append((rect[0][0], rect[0][1], rect[2][0], rect[2][1]))
+                self.owners.append(index)
+                self.edges.append(None)
+                self.ranks.append(0)
+            else:
+                self.dynamic.append(index)
+
+        # Each node is (box, (left, right), None) or, for a leaf, (box, None, primitives)
+        self.nodes = []
+        if self.boxes:
+            self.build(list(range(len(self.boxes))))
+
+    def build(self, items):
+        boxes = self.boxes
+        box = (min(boxes[i][0] for i in items), min(boxes[i][1] for i in items),
+               max(boxes[i][2] for i in items), max(boxes[i][3] for i in items))
+        node = len(self.nodes)
+        self.nodes.append(None)
+        if len(items) <= self.LEAF_SIZE:
+            self.nodes[node] = (box, None, items)
+            return node
+        # Split at the median along the longer side
+        axis = 0 if box[2] - box[0] >= box[3] - box[1] else 1
+        items.sort(key=lambda i: boxes[i][axis] + boxes[i][axis + 2])
+        half = len(items) // 2
+        children = (self.build(items[:half]), self.build(items[half:]))
+        self.nodes[node] = (box, children, None)
+        return node
+
+    def query(self, x0, y0, x1, y1):
+        """ Returns the primitives whose bounding boxes overlap the box from (x0, y0) to (x1, y1) """
+        found = []
+        if not self.nodes:
+            return found
+        nodes = self.nodes
+        boxes = self.boxes
+        stack = [0]
+        while stack:
+            (box, children, items) = nodes[stack.pop()]
+            if box[0] > x1 or box[2] < x0 or box[1] > y1 or box[3] < y0:
+                continue
+            if children is not None:
+                stack.extend(children)
+                continue
+            for i in items:
+                b = boxes[i]
+                if not (b[0] > x1 or b[2] < x0 or b[1] > y1 or b[3] < y0):
+                    found.append(i)
+        return found
+
+    def near(self, pos, reach):
+        """
+        " Returns the frame indices of the objects that a ball at pos could touch within reach or
+        " lies inside, with the dynamic ones, in frame order. Also returns the edges within reach
+        " by polygon and the set of polygons pos lies inside.
+        """
+        (x, y) = pos
+        candidates = set(self.dynamic)
+        edges = {}
+        for i in self.query(x - reach, y - reach, x + reach, y + reach):
+            owner = self.owners[i]
+            candidates.add(owner)
+            if self.edges[i] is not None:
+                edges.setdefault(owner, []).append(i)
+
+        # Count the edges crossed by a ray to the right, as Polygon.isPointInside does
+        inside = set()
+        for i in self.query(x, y, float('inf'), y):
+            edge = self.edges[i]
+            if edge is None:
+                continue
+            ((p1x, p1y), (p2x, p2y)) = edge
+            if y > min(p1y, p2y) and y <= max(p1y, p2y) and x <= max(p1x, p2x):
+                if p1x == p2x or x <= (y-p1y)*(p2x-p1x)/(p2y-p1y)+p1x:
+                    inside ^= {self.owners[i]}
+        candidates |= inside
+        return sorted(candidates), edges, inside
+
+    def nearestPoint(self, pos, edges):
+        """ Returns what Physics.getNearestPointOnLine would if the polygon only had the given edges """
+        dist = 10000000
+        ret = []
+        for i in sorted(edges, key=self.ranks.__getitem__):
+            line = self.edges[i]
+            sect = Physics.lineDistanceToPoint(pos, line)
+            if sect[2] < dist:
+                dist = sect[2]
+                ret = [sect, line]
+        return ret
+
 class Game():
     
     def __init__(self, title, width, height, startPoints, debug = True):
@@ -965,6 +1272,31 @@ class Game():
         self.max_speed = 20
         self.gravity = 0.34
         self.bounce_elasticity = 0.75
+        # 'polar' balls store (angle, speed), 'cartesian' balls store (vx, vy)
+        self.velocity_mode = 'polar'
+        # 'analytic' tests the ball against the edges of the Boundary polygons, 'sdf' looks the distance
+        # and normal up in a DistanceField of them, baked with sdf_resolution pixels between samples and
+        # cached in sdf_cache. Paddles, bouncers and rollover points are always tested analytically.
+        self.collision = 'analytic'
+        self.sdf_resolution = 4
+        self.sdf_cache = 'cache'
+        self.field = None
+        # Whether each tick sweeps the ball from where it was to where it moved, stopping it at the
+        # first wall, bouncer or paddle in its way and carrying on with the rest of the move, for up
+        # to max_substeps bounces. Without it a fast ball can pass through a thin wall between ticks,
+        # and it bounces as soon as it is within 2/3 of a tick's move of something.
+        self.continuous = False
+        self.max_substeps = 4
+        # The name of an integrator from Integrators that ballTick advances the ball with,
+        # or None for the original unit step. With an integrator the ball ticks every 5*dt
+        # milliseconds and each tick moves it dt steps' worth, so a larger dt means fewer
+        # physics updates; without one dt is ignored, see tickSteps.
+        self.integrator = None
+        self.dt = 1
+        # Telemetry.TelemetryBuffer each ballBounce is counted into, see enableTelemetry
+        self.telemetry = None
+        # StaticGeometry of the table, compiled by the first ballBounce
+        self.table = None
         self.running = False
 
     def initializeTexts(self):
@@ -978,8 +1310,9 @@ class Game():
         # TODO: add points text
         
     def addBall(self):
-        ball = Ball(self.startX, self.startY, self.ball_radius, Game.getUrl("ball.png"))
-        ball.addAnimation(Animation(ball, 5, self.ballTick))
+        ballClass = CartesianBall if self.velocity_mode == 'cartesian' else Ball
+        ball = ballClass(self.startX, self.startY, self.ball_radius, Game.getUrl("ball.png"))
+        ball.addAnimation(Animation(ball, 5 * self.tickSteps(), self.ballTick))
         ball.setSpeed(40)
         ball.setAngle(math.pi)
         self.balls.append(ball)
@@ -1002,36 +1335,294 @@ class Game():
     def drawFPS(self, display):
         #display.draw_polygon([[0,0], [300,0], [300,190], [0,190]], 1, "transparent", "rgba(,0.8)")
         #canvas.draw_text( str(self.fps), (20, 50), 40, 'Black', "sans-serif")
-        self.spriteText.message = str(len(self.frame.getObjects())) + " sprites"
+        self.spriteText.message = str(len(self.frame.getObjects())) + " sprites, %d B each" % self.frame.getBytesPerObject()
         self.speedText.message = "%.1f" % round(self.balls[0].getSpeed(),2) + " ball speed"
         self.fpsText.message = "%.1f" % round(self.frame.fpsval,2)
         
-    def ballBounce(self, ball):
-        pos = ball.getPosition()[0]
-        radius = ball.getDisplayedDiameter() / 2
-        angle = ball.getAngle()
-        speed = ball.getSpeed()
-        for obj in self.frame.getObjects():
-            if obj == ball:
+    def enableTelemetry(self, capacity=256):
+        """ Counts what each ballBounce does, keeping the last capacity calls: the objects looked at,
+            those whose bounding rectangle the ball's overlaps, those it hit and the wall bounces.
+            Returns the Telemetry.TelemetryBuffer. """
+
+        self.telemetry = Telemetry.TelemetryBuffer(capacity)
+        return self.telemetry
+
+    def disableTelemetry(self):
+        self.telemetry = None
+
+    def countBounce(self, objects, broadphase, hits, bounces):
+        energy = 0.0
+        px = py = 0.0
+        for ball in self.balls:
+            if isinstance(ball, CartesianBall):
+                (vx, vy) = ball.getVelocity()
+                energy += 0.5 * (vx*vx + vy*vy)
+                px += vx
+                py += vy
                 continue
-            if not isinstance(obj, GameObject):
+            speed = ball.getSpeed()
+            energy += 0.5 * speed**2
+            px += math.sin(ball.getAngle()) * speed
+            py -= math.cos(ball.getAngle()) * speed
+        self.telemetry.count(objects, broadphase, hits, bounces)
+        self.telemetry.endStep(energy, (px, py))
+
+    def compileTable(self):
+        """
+        " Compiles the static objects of the frame for ballBounce, which compiles them again
+        " whenever objects were added to or removed from the frame. Objects that move without
+        " being removed and added again must not be Boundaries or circles.
+        """
+        objects = self.frame.getObjects()
+        if self.collision == 'sdf':
+            polygons = [obj.getPosition() for obj in objects if isinstance(obj, Boundary)]
+            key = DistanceField.polygonKey(polygons, self.width, self.height, self.sdf_resolution)
+            if self.field is None or self.field.key != key:
+                self.field = DistanceField.forPolygons(polygons, self.width, self.height,
+                                                       self.sdf_resolution, self.sdf_cache)
+            walls = Boundary([[0, 0], [self.width, 0], [self.width, self.height], [0, self.height]])
+            self.table = StaticGeometry(objects, self.frame.getVersion(), self.field, walls)
+        elif self.collision == 'analytic':
+            self.table = StaticGeometry(objects, self.frame.getVersion())
+        else:
+            raise ValueError("No such collision mode: %s, expected 'analytic' or 'sdf'" % self.collision)
+        return self.table
+
+    def getTable(self):
+        """
+        " Returns the StaticGeometry of the frame, compiled again if objects were added or removed
+        " or the collision mode changed.
+        """
+        table = self.table
+        if (table is None or table.version != self.frame.getVersion()
+                or (table.field is not None) != (self.collision == 'sdf')):
+            table = self.compileTable()
+        return table
+
+    def touchDistance(self, ball, speed):
+        """
+        " How close the ball must be to an object to bounce off it. A swept ball is stopped just
+        " inside this distance; otherwise it may have moved 2/3 of a tick past it.
+        """
+        if self.continuous:
+            return ball.getRadius() - CONTACT_OVERLAP
+        return ball.getRadius() + speed * self.tickSteps() * 2.0 / 3.0
+
+    def tickSteps(self):
+        """
+        " How many unit steps the ball moves for each tick: dt with an integrator, otherwise 1.
+        """
+        return self.dt if self.integrator is not None else 1
+
+    def paddleTurn(self, paddle):
+        """
+        " Returns the degrees paddle turns by, in the sense Paddle.rotate takes, while the ball
+        " moves for a tick, as changeRotation turns it on its next tick.
+        """
+        ani = paddle.animation
+        if ani is None or not paddle.isInMotion():
+            return 0.0
+        turn = paddle.max_angle * paddle.direction * float(ani.getTicks()) / float(ani.getMaxTicks())
+        turn = min(paddle.max_angle, max(0, paddle.angle + turn)) - paddle.angle
+        turn *= min(1.0, 5.0 * self.tickSteps() / ani.getInterval())
+        return -turn if paddle.isLeft else turn
+
+    def timeOfImpact(self, ball, start, end):
+        """
+        " Returns the first t in [0, 1] at which the ball moving from start to end touches a wall,
+        " bouncer or paddle, with where it then is relative to that object, or None if it touches
+        " nothing it did not already touch at start. A turning paddle is swept in its own frame.
+        """
+        table = self.getTable()
+        objects = self.frame.getObjects()
+        # Swept a little smaller, so that ballBounce finds the ball touching where it stops
+        radius = ball.getRadius() - 2 * CONTACT_OVERLAP
+        (sx, sy) = start
+        (ex, ey) = end
+        first = None
+        # A centre stopped on a wall is left just short of it, so the next sweep still sees it cross
+        move = math.hypot(ex - sx, ey - sy)
+        short = CONTACT_OVERLAP / move if move > 0 else 0.0
+
+        reach = ball.getRadius()
+        for i in table.query(min(sx, ex) - reach, min(sy, ey) - reach, max(sx, ex) + reach, max(sy, ey) + reach):
+            obj = objects[table.owners[i]]
+            if obj.isPassive():
                 continue
-            if not Physics.rectangleCollision(ball.getBoundingRectangle(), obj.getBoundingRectangle()):
+            line = table.edges[i]
+            if line is None:
+                t = Physics.sweepCircle(start, end, obj.getPosition()[0], radius + obj.getRadius())
+            else:
+                # A ball already touching a wall, as in a lane narrower than it, is still not
+                # let through: its centre stops on the wall
+                t = Physics.sweepSegment(start, end, line, radius)
+                if t is None:
+                    t = Physics.sweepSegment(start, end, line, 0.0)
+                    if t is not None:
+                        t = max(0.0, t - short)
+            if t is not None and (first is None or t < first[0]):
+                first = (t, sx + t*(ex - sx), sy + t*(ey - sy))
+
+        if table.field is not None:
+            t = table.field.march(start, end, radius)
+            if t is not None and (first is None or t < first[0]):
+                first = (t, sx + t*(ex - sx), sy + t*(ey - sy))
+
+        for index in table.dynamic:
+            if index == table.fieldIndex or objects[index].isPassive():
                 continue
-                
+            obj = objects[index]
             if isinstance(obj, Polygon):
-                sect = Physics.getNearestPointOnLine(pos, obj)
-                # 2 for the Linewidth
-                touches = sect[0][2] <= ball.getRadius() + speed * 2.0 / 3.0
+                target = end
+                if isinstance(obj, Paddle):
+                    # The paddle turns about its first corner, so in its frame the end point turns back
+                    turn = self.paddleTurn(obj)
+                    if turn:
+                        target = Object2D.rotatePoint(obj.getPosition()[0], end, -math.radians(turn))
+                corners = obj.getPosition()
+                for k in range(-1, len(corners) - 1):
+                    line = [corners[k], corners[k + 1]]
+                    t = Physics.sweepSegment(start, target, line, radius)
+                    if t is None:
+                        t = Physics.sweepSegment(start, target, line, 0.0)
+                        if t is not None:
+                            t = max(0.0, t - short)
+                    if t is not None and (first is None or t < first[0]):
+                        first = (t, sx + t*(target[0] - sx), sy + t*(target[1] - sy))
             elif isinstance(obj, Circle):
-                sect = Physics.getNearestPointBetweenCircles(pos, obj.getPosition()[0], radius, obj.getRadius())
-                if sect is None:
+                t = Physics.sweepCircle(start, end, obj.getPosition()[0], radius + obj.getRadius())
+                if t is not None and (first is None or t < first[0]):
+                    first = (t, sx + t*(ex - sx), sy + t*(ey - sy))
+        return first
+
+    def ballSweep(self, ball, start):
+        """
+        " Moves the ball from start to where its tick moved it, stopping at the first object in its
+        " way to bounce off it with ballBounce and carrying on with what is left of the move, at the
+        " velocity it bounced off with, up to max_substeps times. Then runs ballBounce where it ends up.
+        """
+        pos = ball.getPosition()[0]
+        end = (pos[0], pos[1])
+        # How far the ball moves in a tick, in units of its speed
+        scale = self.tickSteps()
+        for substep in range(self.max_substeps):
+            hit = self.timeOfImpact(ball, start, end)
+            if hit is None:
+                break
+            (t, pos[0], pos[1]) = hit
+            if not self.ballBounceSwept(ball):
+                # The ball was lost and a new one served
+                return
+            pos = ball.getPosition()[0]
+            start = (pos[0], pos[1])
+            # A bounce may speed the ball up past max_speed, which the next tick takes back
+            if isinstance(ball, CartesianBall):
+                (vx, vy) = ball.getVelocity()
+                speed = math.hypot(vx, vy)
+                rest = (1.0 - t) * scale * (self.max_speed / speed if speed > self.max_speed else 1.0)
+                end = (pos[0] + vx * rest, pos[1] + vy * rest)
+            else:
+                rest = (1.0 - t) * scale * min(ball.getSpeed(), self.max_speed)
+                end = (pos[0] + math.sin(ball.getAngle()) * rest, pos[1] - math.cos(ball.getAngle()) * rest)
+            pos[0] = end[0]
+            pos[1] = end[1]
+        else:
+            # Out of bounces, the ball stops at whatever is in its way rather than pass through it
+            hit = self.timeOfImpact(ball, start, end)
+            if hit is not None:
+                (t, pos[0], pos[1]) = hit
+        self.ballBounceSwept(ball)
+
+    def ballBounceSwept(self, ball):
+        """
+        " Runs ballBounce, sweeping the ball from where it was to where that pushed it off what it
+        " hit, such as a bouncer, so that the push does not carry it into a wall either.
+        " Returns False if the ball was lost.
+        """
+        pos = ball.getPosition()[0]
+        contact = (pos[0], pos[1])
+        self.ballBounce(ball)
+        if ball not in self.balls:
+            return False
+        pos = ball.getPosition()[0]
+        hit = self.timeOfImpact(ball, contact, (pos[0], pos[1]))
+        if hit is not None:
+            (t, pos[0], pos[1]) = hit
+        return True
+
+    def ballMoved(self, ball, start):
+        """
+        " Bounces the ball after a tick moved it from start, swept there when continuous is set.
+        """
+        if self.continuous:
+            self.ballSweep(ball, start)
+        else:
+            self.ballBounce(ball)
+
+    def ballBounce(self, ball):
+        pos = ball.getPosition()[0]
+        radius = ball.getDisplayedDiameter() / 2
+        # A CartesianBall's velocity is reflected as a vector, without going through its angle
+        cartesian = isinstance(ball, CartesianBall)
+        if cartesian:
+            (vx, vy) = ball.getVelocity()
+            speed = math.hypot(vx, vy)
+        else:
+            angle = ball.getAngle()
+            speed = ball.getSpeed()
+        objects = self.frame.getObjects()
+        table = self.getTable()
+        # Only the objects near the ball, taken in frame order. They are looked up again
+        # after the ball bounced off one, from where it then is.
+        (candidates, edges, insideOf) = table.near(pos, max(radius, self.touchDistance(ball, speed)))
+        # Counted only for the telemetry: the objects whose bounding rectangle the ball's
+        # overlaps, those it hit and the wall bounces
+        counting = self.telemetry is not None
+        broadphase = hits = bounces = 0
+        k = 0
+        while k < len(candidates):
+            index = candidates[k]
+            k += 1
+            if index == table.fieldIndex:
+                # The field covers the whole table, so it needs no bounding rectangle test.
+                # The nearest point of the walls lies the distance back along the normal.
+                obj = table.walls
+                if counting:
+                    broadphase += 1
+                (dist, nx, ny) = table.field.sample(pos[0], pos[1])
+                sect = [[pos[0] - nx * dist, pos[1] - ny * dist, abs(dist)], None]
+                # A centre inside the walls is pushed out along the normal, see below
+                inside = dist < 0
+                touches = not inside and dist <= self.touchDistance(ball, speed)
+            else:
+                obj = objects[index]
+                if not Physics.rectangleCollision(ball.getBoundingRectangle(), obj.getBoundingRectangle()):
                     continue
-                touches = sect[0][2] - obj.getRadius() <= ball.getRadius() + speed * 2.0 / 3.0
-                
-            inside = obj.isPointInside(pos[0], pos[1])
+                if counting:
+                    broadphase += 1
+
+                if index in table.polygons:
+                    sect = table.nearestPoint(pos, edges.get(index, ()))
+                    touches = bool(sect) and sect[0][2] <= self.touchDistance(ball, speed)
+                    inside = index in insideOf
+                    if inside and not touches:
+                        # Pushed out through the nearest edge, however far that is
+                        sect = Physics.getNearestPointOnLine(pos, obj)
+                elif isinstance(obj, Polygon):
+                    sect = Physics.getNearestPointOnLine(pos, obj)
+                    # 2 for the Linewidth
+                    touches = sect[0][2] <= self.touchDistance(ball, speed)
+                    inside = obj.isPointInside(pos[0], pos[1])
+                elif isinstance(obj, Circle):
+                    sect = Physics.getNearestPointBetweenCircles(pos, obj.getPosition()[0], radius, obj.getRadius())
+                    if sect is None:
+                        continue
+                    touches = sect[0][2] - obj.getRadius() <= self.touchDistance(ball, speed)
+                    inside = obj.isPointInside(pos[0], pos[1])
 
             if inside or touches:
+                if counting:
+                    hits += 1
                 points = obj.getPoints()
                 if obj.isActionApplicable():
                     obj.rollOver([sect[0][0], sect[0][1]], ball)
@@ -1048,14 +1639,45 @@ class Game():
                 else:
                     val = obj.getNewSpeedFactor(sect, pos)
                 speed *= val
+                if cartesian:
+                    vx *= val
+                    vy *= val
                 
-                if touches:
+                if touches and cartesian:
+                    # Reflected about the surface, whose normal points from the ball to sect
+                    dist = sect[0][2]
+                    ux = sect[0][0] - pos[0]
+                    uy = sect[0][1] - pos[1]
+                    length = math.hypot(ux, uy)
+                    (ux, uy) = (ux / length, uy / length) if length > 0 else (1.0, 0.0)
+                    dot = vx * ux + vy * uy
+                    vx -= 2 * dot * ux
+                    vy -= 2 * dot * uy
+                    pos[0] -= ux * abs(ball.getRadius() - dist)
+                    pos[1] -= uy * abs(ball.getRadius() - dist)
+                elif touches:
                     tangent = math.atan2(sect[0][1] - pos[1], sect[0][0] - pos[0])
                     angle = 2 * tangent - angle
                     dist = sect[0][2]
                     hitAngle = 0.5 * math.pi + tangent
                     pos[0] -= math.sin(hitAngle) * abs(ball.getRadius() - dist)
                     pos[1] += math.cos(hitAngle) * abs(ball.getRadius() - dist)
+                elif obj is table.walls:
+                    # Out along the normal to touch the walls from outside, bouncing off them
+                    # if still moving in
+                    pos[0] += nx * (ball.getRadius() - dist)
+                    pos[1] += ny * (ball.getRadius() - dist)
+                    if cartesian:
+                        dot = vx * nx + vy * ny
+                        if dot < 0:
+                            vx -= 2 * dot * nx
+                            vy -= 2 * dot * ny
+                    else:
+                        dx = math.sin(angle)
+                        dy = -math.cos(angle)
+                        dot = dx * nx + dy * ny
+                        if dot < 0:
+                            angle = math.atan2(dx - 2 * dot * nx, -(dy - 2 * dot * ny))
                 elif inside:
                     oldPos = pos
                     pos = [2 * sect[0][0] - pos[0], 2 * sect[0][1] - pos[1]]
@@ -1063,34 +1685,78 @@ class Game():
                     
                 if isinstance(obj, Paddle) and obj.goesUp() and obj.angle < obj.max_angle:
                     angle = (0 - obj.direction) * ((obj.angle - 38) * math.pi / 180)
+                    if cartesian:
+                        vx = math.sin(angle) * speed
+                        vy = -math.cos(angle) * speed
+
+                (later, edges, insideOf) = table.near(pos, max(radius, self.touchDistance(ball, speed)))
+                candidates = candidates[:k] + [i for i in later if i > index]
                     
         if pos[0] > self.width - radius:
             pos[0] = 2*(self.width - radius) - pos[0]
-            angle = - angle
-            speed *= self.bounce_elasticity
+            if cartesian:
+                vx *= -self.bounce_elasticity
+                vy *= self.bounce_elasticity
+            else:
+                angle = - angle
+                speed *= self.bounce_elasticity
+            if counting:
+                bounces += 1
         elif pos[0] < radius:
             pos[0] = 2*radius - pos[0]
-            angle = - angle
-            speed *= self.bounce_elasticity
+            if cartesian:
+                vx *= -self.bounce_elasticity
+                vy *= self.bounce_elasticity
+            else:
+                angle = - angle
+                speed *= self.bounce_elasticity
+            if counting:
+                bounces += 1
         if pos[1] > self.height - radius:
             if self.checkForEnd(pos):
                 self.end()
+                if counting:
+                    self.countBounce(k, broadphase, hits, bounces)
                 return
             pos[1] = 2 * (self.height - radius) - pos[1]
-            angle = math.pi - angle
-            speed *= self.bounce_elasticity
+            if cartesian:
+                vx *= self.bounce_elasticity
+                vy *= -self.bounce_elasticity
+            else:
+                angle = math.pi - angle
+                speed *= self.bounce_elasticity
+            if counting:
+                bounces += 1
         elif pos[1] < radius:
             pos[1] = 2 * radius - pos[1]
-            angle = math.pi - angle
-            speed *= self.bounce_elasticity
-        ball.setSpeed(speed)
-        ball.setAngle(angle)
+            if cartesian:
+                vx *= self.bounce_elasticity
+                vy *= -self.bounce_elasticity
+            else:
+                angle = math.pi - angle
+                speed *= self.bounce_elasticity
+            if counting:
+                bounces += 1
+        if cartesian:
+            ball.setVelocity(vx, vy)
+        else:
+            ball.setSpeed(speed)
+            ball.setAngle(angle)
         ball.setPosition( [ pos ] )
+        if counting:
+            self.countBounce(k, broadphase, hits, bounces)
         
     def ballTick(self, ani, ball, ticks):
         if not self.running:
             return
+        if self.integrator is not None:
+            self.ballTickIntegrated(ball)
+            return
+        if isinstance(ball, CartesianBall):
+            self.ballTickCartesian(ball)
+            return
         pos = ball.getPosition()[0]
+        start = (pos[0], pos[1])
         angle = ball.getAngle()
         speed = ball.getSpeed()
 
@@ -1101,7 +1767,56 @@ class Game():
 
         ball.setAngle(angle)
         ball.setSpeed(min(self.max_speed, speed * self.ball_drag))
-        self.ballBounce(ball)
+        self.ballMoved(ball, start)
+        
+    def ballTickCartesian(self, ball):
+        pos = ball.getPosition()[0]
+        start = (pos[0], pos[1])
+        vx, vy = ball.getVelocity()
+
+        # gravity points down the table, i.e. angle pi
+        vy += self.gravity
+
+        pos[0] += vx
+        pos[1] += vy
+
+        vx *= self.ball_drag
+        vy *= self.ball_drag
+        speed = math.hypot(vx, vy)
+        if speed > self.max_speed:
+            vx *= self.max_speed / speed
+            vy *= self.max_speed / speed
+        ball.setVelocity(vx, vy)
+        self.ballMoved(ball, start)
+
+    def ballTickIntegrated(self, ball):
+        pos = ball.getPosition()[0]
+        start = (pos[0], pos[1])
+        if isinstance(ball, CartesianBall):
+            vx, vy = ball.getVelocity()
+        else:
+            vx = math.sin(ball.getAngle()) * ball.getSpeed()
+            vy = -math.cos(ball.getAngle()) * ball.getSpeed()
+
+        # gravity points down the table, and drag takes ball_drag off the speed per unit step
+        gravity = self.gravity
+        k = Integrators.dragRate(self.ball_drag)
+        if k is None:
+            (vx, vy) = (0, 0)
+        else:
+            (pos[0], pos[1], vx, vy) = Integrators.getIntegrator(self.integrator)(
+                pos[0], pos[1], vx, vy, lambda x, y, vx, vy: (k*vx, gravity + k*vy), self.dt)
+
+        speed = math.hypot(vx, vy)
+        if speed > self.max_speed:
+            vx *= self.max_speed / speed
+            vy *= self.max_speed / speed
+        if isinstance(ball, CartesianBall):
+            ball.setVelocity(vx, vy)
+        else:
+            ball.setAngle(math.atan2(vx, -vy))
+            ball.setSpeed(math.hypot(vx, vy))
+        self.ballMoved(ball, start)
 
     def getUrl(name):
         return "assets/" + name
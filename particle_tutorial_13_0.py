@@ -1,6 +1,7 @@
 import random
 import pygame
 import PyParticles
+import ParticleRenderer
 
 class UniverseScreen:
     def __init__ (self, width, height):
@@ -23,6 +24,13 @@ class UniverseScreen:
         (self.dx, self.dy) = (0, 0)
         (self.mx, self.my) = (0, 0)
         self.magnification = 1.0
+
+    def getViewRect(self):
+        """ Returns the part of the universe on screen as (x0, y0, x1, y1) """
+        return (-self.mx / self.magnification - self.dx,
+                -self.my / self.magnification - self.dy,
+                (self.width - self.mx) / self.magnification - self.dx,
+                (self.height - self.my) / self.magnification - self.dy)
         
 def calculateRadius(mass):
     return 0.5 * mass ** (0.5)
@@ -31,15 +39,28 @@ def calculateRadius(mass):
 screen = pygame.display.set_mode((width, height))
 pygame.display.set_caption('Star formation')
 
-universe = PyParticles.Environment((width, height))
+# Set to spread many more stars over a universe larger than the screen, where the
+# chunks far from the screen are frozen until it scrolls near them
+chunked = False
+
+if chunked:
+    universe = PyParticles.ChunkedEnvironment((width // 2, height // 2))
+else:
+    universe = PyParticles.Environment((width, height))
 universe.colour = (0,0,0)
 universe.addFunctions(['move', 'attract', 'combine'])
+universe.remove_merged = True
 universe_screen = UniverseScreen(width, height)
+renderer = ParticleRenderer.ParticleRenderer()
 
-for p in range(100):
+for p in range(1000 if chunked else 100):
     particle_mass = random.randint(1,4)
     particle_size = calculateRadius(particle_mass)
-    universe.addParticles(mass=particle_mass, size=particle_size, speed=0, colour=(255,255,255))
+    if chunked:
+        position = dict(x=random.uniform(-2*width, 3*width), y=random.uniform(-2*height, 3*height))
+    else:
+        position = {}
+    universe.addParticles(mass=particle_mass, size=particle_size, speed=0, colour=(255,255,255), **position)
 
 key_to_function = {
     pygame.K_LEFT:   (lambda x: x.scroll(dx = 1)),
@@ -63,30 +84,20 @@ while running:
             elif event.key == pygame.K_SPACE:
                 paused = (True, False)[paused]
 
+    if chunked:
+        universe.setView(*universe_screen.getViewRect())
     if not paused:
         universe.update()
         
     screen.fill(universe.colour)
     
-    particles_to_remove = []
     for p in universe.particles:
-        if 'collide_with' in p.__dict__:
-            particles_to_remove.append(p.collide_with)
+        if getattr(p, 'collide_with', None) is not None:
             p.size = calculateRadius(p.mass)
-            del p.__dict__['collide_with']
+            del p.collide_with
 
-        x = int(universe_screen.mx + (universe_screen.dx + p.x) * universe_screen.magnification)
-        y = int(universe_screen.my + (universe_screen.dy + p.y) * universe_screen.magnification)
-        size = int(p.size * universe_screen.magnification)
-        
-        if size < 2:
-            pygame.draw.rect(screen, p.colour, (x, y, 2, 2))
-        else:
-            pygame.draw.circle(screen, p.colour, (x, y), size, 0)
-    
-    for p in particles_to_remove:
-        if p in universe.particles:
-            universe.particles.remove(p)
+    renderer.draw(screen, universe, universe_screen.magnification,
+                  (universe_screen.dx, universe_screen.dy), (universe_screen.mx, universe_screen.my))
 
     pygame.display.flip()
     clock.tick(80)
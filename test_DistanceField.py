@@ -0,0 +1,67 @@
+import math
+import os
+
+import pytest
+
+import DistanceField
+
+SQUARE = [[100, 100], [200, 100], [200, 200], [100, 200]]
+
+
+def squareDistance(x, y):
+    """ Returns the signed distance from x, y to the edges of SQUARE, negative inside it """
+
+    dx = max(100 - x, 0, x - 200)
+    dy = max(100 - y, 0, y - 200)
+    if dx or dy:
+        return math.hypot(dx, dy)
+    return -min(x - 100, 200 - x, y - 100, 200 - y)
+
+def makeField():
+    return DistanceField.forPolygons([SQUARE], 300, 300, resolution=2, cache_dir=None)
+
+
+def test_samples_match_the_distance_to_the_polygon():
+    field = makeField()
+    for x in range(0, 301, 10):
+        for y in range(0, 301, 10):
+            assert field.sample(x, y)[0] == pytest.approx(squareDistance(x, y), abs=1e-4)
+    for (x, y) in [(53.3, 141.7), (150.9, 121.1), (233.3, 266.6), (187.5, 103.3)]:
+        assert field.sample(x, y)[0] == pytest.approx(squareDistance(x, y), abs=1.0)
+
+@pytest.mark.parametrize('point, normal', [((250, 150), (1, 0)), ((150, 40), (0, -1)), ((110, 150), (-1, 0)),
+                                           ((150, 185), (0, 1)), ((250, 250), (math.sqrt(0.5), math.sqrt(0.5)))])
+def test_normals_point_out_of_the_polygon(point, normal):
+    (distance, nx, ny) = makeField().sample(*point)
+    assert (nx, ny) == pytest.approx(normal, abs=1e-6)
+
+def test_march_stops_where_the_circle_touches():
+    field = makeField()
+    assert field.march((20, 150), (120, 150), 10) == pytest.approx(0.7, abs=1e-3)
+    assert field.march((20, 20), (280, 20), 10) is None
+    assert field.march((20, 150), (50, 150), 10) is None
+    assert field.march((95, 150), (120, 150), 10) is None
+
+def test_fields_are_cached_by_their_corners(tmp_path):
+    cache = str(tmp_path)
+    field = DistanceField.forPolygons([SQUARE], 300, 300, resolution=2, cache_dir=cache)
+    assert os.listdir(cache) == [field.key + '.npz']
+    loaded = DistanceField.forPolygons([[tuple(corner) for corner in SQUARE]], 300, 300, resolution=2,
+                                       cache_dir=cache)
+    assert loaded.key == field.key
+    assert (loaded.distance, loaded.nx, loaded.ny) == (field.distance, field.nx, field.ny)
+
+    moved = [[100, 100], [200, 100], [200, 210], [100, 200]]
+    other = DistanceField.forPolygons([moved], 300, 300, resolution=2, cache_dir=cache)
+    assert other.key != field.key
+    assert len(os.listdir(cache)) == 2
+    assert DistanceField.polygonKey([SQUARE], 300, 300, 4) != field.key
+
+def test_damaged_caches_are_baked_again(tmp_path):
+    cache = str(tmp_path)
+    field = DistanceField.forPolygons([SQUARE], 300, 300, resolution=2, cache_dir=cache)
+    with open(os.path.join(cache, field.key + '.npz'), 'wb') as f:
+        f.write(b'not a field')
+    baked = DistanceField.forPolygons([SQUARE], 300, 300, resolution=2, cache_dir=cache)
+    assert baked.distance == field.distance
+    assert DistanceField.DistanceField.load(os.path.join(cache, field.key + '.npz')).distance == field.distance
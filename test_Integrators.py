@@ -0,0 +1,103 @@
+import math
+
+import numpy
+import pytest
+
+import Integrators
+import ParticleArrays
+import PyParticles
+
+
+def spring(x, y, vx, vy):
+    return (-x, -y)
+
+def dragging(x, y, vx, vy):
+    return (-0.5*vx, 0.1 - 0.5*vy)
+
+def integrateError(integrator, acceleration, exact, dt, time=4.0):
+    """ Returns the distance from the exact position after integrating from (1, 0) at rest for the given time """
+
+    (x, y, vx, vy) = (1.0, 0.0, 0.0, 0.0)
+    for step in range(round(time / dt)):
+        (x, y, vx, vy) = integrator(x, y, vx, vy, acceleration, dt)
+    return math.hypot(x - exact[0], y - exact[1])
+
+
+@pytest.mark.parametrize('name, order', [('euler', 1), ('semi_implicit', 1), ('verlet', 2), ('rk2', 2)])
+@pytest.mark.parametrize('acceleration, exact', [
+    (spring, (math.cos(4.0), 0.0)),
+    (dragging, (1.0, 0.2*(4.0 - 2*(1 - math.exp(-2.0)))))])
+def test_integrators_converge_at_their_order(name, order, acceleration, exact):
+    integrator = Integrators.getIntegrator(name)
+    coarse = integrateError(integrator, acceleration, exact, 0.02)
+    fine = integrateError(integrator, acceleration, exact, 0.01)
+    assert math.log2(coarse / fine) == pytest.approx(order, abs=0.2)
+
+@pytest.mark.parametrize('name', ['verlet', 'rk2'])
+def test_second_order_integrators_follow_constant_acceleration_exactly(name):
+    integrator = Integrators.getIntegrator(name)
+    falling = lambda x, y, vx, vy: (0.0, 0.5)
+    (x, y, vx, vy) = (0.0, 0.0, 2.0, -3.0)
+    for step in range(10):
+        (x, y, vx, vy) = integrator(x, y, vx, vy, falling, 0.5)
+    assert (x, y, vx, vy) == pytest.approx((10.0, -15.0 + 0.25*25, 2.0, -3.0 + 2.5))
+
+def test_semi_implicit_euler_keeps_an_orbit_bounded():
+    energy = {}
+    for name in ('euler', 'semi_implicit'):
+        integrator = Integrators.getIntegrator(name)
+        (x, y, vx, vy) = (1.0, 0.0, 0.0, 1.0)
+        for step in range(2000):
+            (x, y, vx, vy) = integrator(x, y, vx, vy, spring, 0.05)
+        energy[name] = 0.5*(x*x + y*y + vx*vx + vy*vy)
+    assert energy['semi_implicit'] == pytest.approx(1.0, abs=0.05)
+    assert energy['euler'] > 10
+
+def test_integrators_take_arrays():
+    x = numpy.array([1.0, 2.0])
+    for integrator in Integrators.INTEGRATORS.values():
+        (x1, y1, vx1, vy1) = integrator(x, -x, x, x, spring, 0.1)
+        for i in range(2):
+            assert (x1[i], y1[i], vx1[i], vy1[i]) == integrator(x[i], -x[i], x[i], x[i], spring, 0.1)
+
+def test_unknown_integrators_are_refused():
+    with pytest.raises(ValueError):
+        Integrators.getIntegrator('leapfrog')
+
+def test_drag_rate():
+    assert Integrators.dragRate(1) == 0
+    assert math.exp(Integrators.dragRate(0.9)) == pytest.approx(0.9)
+    assert Integrators.dragRate(0) is None
+    assert Integrators.dragRate(-0.5) is None
+
+
+@pytest.mark.parametrize('name', list(Integrators.INTEGRATORS))
+def test_array_environments_integrate_as_environments(name):
+    env = ParticleArrays.ArrayEnvironment((400, 400), seed=1)
+    env.acceleration = (math.pi, 0.2)
+    env.integrator = name
+    env.dt = 0.5
+    env.addFunctions(['integrate', 'bounce'])
+    env.addParticles(50, size=5, speed=2)
+    env.drag[:] = numpy.linspace(0.8, 1.0, 50)
+    env.drag[:3] = (0, -1, 0)
+
+    reference = PyParticles.Environment((400, 400))
+    reference.velocity_mode = 'cartesian'
+    for setting in ('acceleration', 'integrator', 'dt'):
+        setattr(reference, setting, getattr(env, setting))
+    reference.addFunctions(['integrate', 'bounce'])
+    for view in env.particles:
+        particle = PyParticles.CartesianParticle((view.x, view.y), view.size, view.mass)
+        particle.setVelocity(view.vx, view.vy)
+        particle.drag = view.drag
+        reference.addParticle(particle)
+    (x, y) = (env.x[:3].copy(), env.y[:3].copy())
+
+    for step in range(40):
+        env.update()
+        reference.update()
+    for (view, particle) in zip(env.particles, reference.particles):
+        assert (view.x, view.y, view.vx, view.vy) == pytest.approx((particle.x, particle.y, particle.vx, particle.vy))
+    assert numpy.array_equal(env.x[:3], x) and numpy.array_equal(env.y[:3], y)
+    assert not env.vx[:3].any() and not env.vy[:3].any()
@@ -0,0 +1,233 @@
+import math
+
+import numpy
+import pytest
+
+import ParticleArrays
+import PyParticles
+
+
+def makeArrays(functions, n=200, seed=4, bounds=(300, 300), **settings):
+    """ Returns an ArrayEnvironment of n random particles with the given functions and settings """
+
+    env = ParticleArrays.ArrayEnvironment(bounds, seed=seed)
+    for (name, value) in settings.items():
+        setattr(env, name, value)
+    env.addFunctions(functions)
+    env.addParticles(n, size=6, speed=1.5)
+    return env
+
+def copyParticles(env):
+    """ Returns a cartesian Environment holding the particles of an ArrayEnvironment """
+
+    copy = PyParticles.Environment((env.width, env.height))
+    copy.velocity_mode = 'cartesian'
+    copy.acceleration = env.acceleration
+    for view in env.particles:
+        particle = PyParticles.CartesianParticle((view.x, view.y), view.size, view.mass)
+        particle.setVelocity(view.vx, view.vy)
+        particle.drag = view.drag
+        particle.elasticity = view.elasticity
+        copy.addParticle(particle)
+    return copy
+
+def bruteForcePairs(x, y, size):
+    n = len(x)
+    return [(i, j) for i in range(n) for j in range(i + 1, n)
+            if math.hypot(x[i] - x[j], y[i] - y[j]) < size[i] + size[j]]
+
+
+def test_particle_functions_match_environment():
+    functions = ['move', 'accelerate', 'drag', 'bounce']
+    env = makeArrays(functions, acceleration=(math.pi, 0.1))
+    reference = copyParticles(env)
+    reference.addFunctions(functions)
+    for step in range(50):
+        env.update()
+        reference.update()
+    for (view, particle) in zip(env.particles, reference.particles):
+        assert view.x == pytest.approx(particle.x, abs=1e-9)
+        assert view.y == pytest.approx(particle.y, abs=1e-9)
+        assert view.vx == pytest.approx(particle.vx, abs=1e-9)
+        assert view.vy == pytest.approx(particle.vy, abs=1e-9)
+
+@pytest.mark.parametrize('broadphase', ['grid', 'pairs'])
+def test_overlapping_pairs_match_brute_force(broadphase):
+    env = ParticleArrays.ArrayEnvironment((300, 300), seed=2)
+    env.broadphase = broadphase
+    env.tile_size = 64
+    env.addParticles(300)
+    (i, j) = env.overlappingPairs()
+    assert list(zip(i.tolist(), j.tolist())) == bruteForcePairs(env.x, env.y, env.size)
+
+def test_collide_matches_a_particle_pair():
+    env = ParticleArrays.ArrayEnvironment((300, 300))
+    env.addFunctions(['collide'])
+    env.addParticles(1, x=100, y=100, size=10, mass=3, speed=2, angle=1)
+    env.addParticles(1, x=112, y=105, size=8, mass=5, speed=1, angle=4)
+    (p1, p2) = copyParticles(env).particles
+    env.update()
+    PyParticles.collide(p1, p2)
+    for (view, particle) in zip(env.particles, (p1, p2)):
+        assert (view.x, view.y) == pytest.approx((particle.x, particle.y))
+        assert (view.vx, view.vy) == pytest.approx((particle.vx, particle.vy))
+
+def test_combine_conserves_mass():
+    env = makeArrays(['move', 'bounce', 'combine'], remove_merged=True)
+    mass = env.mass.sum()
+    for step in range(30):
+        env.update()
+    env.compact()
+    assert len(env.particles) < 200
+    assert env.mass.sum() == pytest.approx(mass)
+
+def test_views_act_like_particles():
+    env = makeArrays(['move'], n=10)
+    view = env.particles[3]
+    view.angle = 0.5
+    view.speed = 2
+    assert (env.vx[3], env.vy[3]) == pytest.approx((2 * math.sin(0.5), -2 * math.cos(0.5)))
+    view.collide_with = env.particles[4]
+    assert view.collide_with is env.particles[4]
+
+    handle = env.handleOf(view)
+    assert env.getParticle(handle) is view
+    assert env.removeParticle(view)
+    env.update()
+    assert len(env.particles) == 9
+    assert env.getParticle(handle) is None
+    assert handle not in env.ids
+
+def test_queries_match_environment():
+    env = makeArrays(['move', 'bounce'], n=200)
+    for step in range(5):
+        env.update()
+    reference = copyParticles(env)
+    views = {id(particle): view for (particle, view) in zip(reference.particles, env.particles)}
+    points = numpy.random.default_rng(3)
+    for (x, y) in points.uniform(-20, 320, (40, 2)):
+        found = reference.findParticle(x, y)
+        assert env.findParticle(x, y) is (found and views[id(found)])
+        assert ({id(view) for view in env.findParticlesInRadius(x, y, 30)} ==
+                {id(views[id(p)]) for p in reference.findParticlesInRadius(x, y, 30)})
+        assert ({id(view) for view in env.findParticlesInRect(x + 40, y + 25, x - 20, y - 10)} ==
+                {id(views[id(p)]) for p in reference.findParticlesInRect(x - 20, y - 10, x + 40, y + 25)})
+        assert ([id(view) for view in env.findNearestParticles(x, y, 5)] ==
+                [id(views[id(p)]) for p in reference.findNearestParticles(x, y, 5)])
+
+@pytest.mark.parametrize('dtype', [numpy.float32, numpy.float64])
+def test_columns_keep_their_dtype(dtype):
+    env = ParticleArrays.ArrayEnvironment((300, 300), seed=4, dtype=dtype)
+    env.addFunctions(['move', 'accelerate', 'drag', 'bounce', 'collide', 'attract'])
+    env.addParticles(100, size=6, speed=1.5)
+    env.addParticles(1, x=10, y=10, mass=3)
+    for step in range(10):
+        env.update()
+    for name in ParticleArrays.FIELDS:
+        assert getattr(env, name).dtype == dtype
+    assert env.copy(numpy.float64).x.dtype == numpy.float64
+    if dtype == numpy.float32:
+        assert env.bytesPerParticle() < env.copy(numpy.float64).bytesPerParticle()
+
+def test_drift_report_compares_with_float64():
+    env = makeArrays(['move', 'bounce', 'collide'], n=100)
+    x = env.x.copy()
+    report = env.driftReport(steps=20)
+    assert numpy.array_equal(env.x, x)
+    assert report['dtype'] == 'float64'
+    assert report['position_error'] == 0
+    assert report['energy'] == report['reference_energy']
+
+    single = env.copy(numpy.float32)
+    report = single.driftReport(steps=20)
+    assert report['dtype'] == 'float32'
+    assert report['particles'] == report['reference_particles'] == 100
+    assert 0 < report['energy_error'] < 1e-3
+    assert report['momentum_error'] < 1e-3
+    assert report['energy'] == pytest.approx(report['reference_energy'], rel=1e-3)
+
+@pytest.mark.parametrize('dtype', [numpy.float32, numpy.float64])
+def test_checkpoints_continue_where_they_were_saved(tmp_path, dtype):
+    path = str(tmp_path / 'arrays.checkpoint')
+    env = makeArrays(['move', 'accelerate', 'bounce', 'collide', 'combine'], acceleration=(math.pi, 0.05),
+                     remove_merged=True).copy(dtype)
+    for step in range(10):
+        env.update()
+    env.save(path)
+    loaded = ParticleArrays.ArrayEnvironment.load(path)
+    assert loaded.dtype == dtype
+    assert loaded.function_names == env.function_names
+    for step in range(20):
+        env.update()
+        loaded.update()
+    env.addParticles(5)
+    loaded.addParticles(5)
+    for name in ParticleArrays.FIELDS + ('ids', 'colour_array', 'thickness'):
+        assert numpy.array_equal(getattr(loaded, name), getattr(env, name)), name
+
+def test_checkpoints_leave_the_file_unchanged(tmp_path):
+    path = tmp_path / 'arrays.checkpoint'
+    makeArrays(['move', 'bounce']).save(str(path))
+    data = path.read_bytes()
+    loaded = ParticleArrays.ArrayEnvironment.load(str(path))
+    loaded.update()
+    loaded.x[:] = 0
+    assert path.read_bytes() == data
+
+def test_checkpoints_of_no_particles_load(tmp_path):
+    path = str(tmp_path / 'arrays.checkpoint')
+    ParticleArrays.ArrayEnvironment((100, 100)).save(path)
+    loaded = ParticleArrays.ArrayEnvironment.load(path)
+    assert len(loaded.x) == 0
+    loaded.addParticles(3)
+    assert len(loaded.particles) == 3
+
+def test_recordings_match_the_columns(tmp_path):
+    path = str(tmp_path / 'arrays.trajectory')
+    env = makeArrays(['move', 'bounce', 'combine'], remove_merged=True)
+    expected = []
+    with env.startRecording(path, fields=('id', 'x', 'angle'), chunk_steps=8):
+        for step in range(20):
+            env.update()
+            expected.append((env.ids.tolist(), env.x.tolist(), numpy.arctan2(env.vx, -env.vy).tolist()))
+    env.stopRecording()
+    recorded = [(columns['id'].tolist(), columns['x'].tolist(), columns['angle'].tolist())
+                for (step, columns) in PyParticles.readTrajectory(path)]
+    assert recorded == expected
+
+def directAttraction(env):
+    """ Returns the accelerations of attract from the full matrix of distances between particles """
+
+    dx = env.x[None, :] - env.x[:, None]
+    dy = env.y[None, :] - env.y[:, None]
+    dist = numpy.hypot(dx, dy)
+    apart = dist >= env.size[None, :] + env.size[:, None]
+    numpy.fill_diagonal(apart, False)
+    strength = numpy.zeros_like(dist)
+    strength[apart] = PyParticles.GRAVITATIONAL_CONSTANT / dist[apart]**3
+    towards = strength * env.mass[None, :]
+    return (towards * dx).sum(axis=1), (towards * dy).sum(axis=1)
+
+@pytest.mark.parametrize('tile_size', [7, 64, 256, 1000])
+def test_tiled_attraction_matches_the_full_matrix(tile_size):
+    env = ParticleArrays.ArrayEnvironment((300, 300), seed=4)
+    env.tile_size = tile_size
+    env.addParticles(300, size=3)
+    env.vx[:] = 0
+    env.vy[:] = 0
+    env.attractKernel()
+    (ax, ay) = directAttraction(env)
+    assert env.vx == pytest.approx(ax, rel=1e-9, abs=1e-12)
+    assert env.vy == pytest.approx(ay, rel=1e-9, abs=1e-12)
+    assert numpy.array_equal((env.vx, env.vy), env.attraction(env.x, env.y, env.size, numpy.arange(300)))
+
+@pytest.mark.parametrize('tile_size', [7, 64, 1000])
+def test_tiled_pairs_match_the_grid(tile_size):
+    env = makeArrays(['move', 'bounce', 'collide'], n=300)
+    env.addParticles(1, x=150, y=150, size=100)
+    env.tile_size = tile_size
+    env.broadphase = 'pairs'
+    pairs = env.overlappingPairs()
+    env.broadphase = 'grid'
+    assert numpy.array_equal(pairs, env.overlappingPairs())
+    assert len(pairs[0]) > 50
@@ -0,0 +1,59 @@
+import math
+
+import numpy
+import pytest
+
+import ParticleArrays
+import ParticleParallel
+
+
+def makeEnvironments(functions, n=400, workers=3, **settings):
+    """ Returns an ArrayEnvironment and a ParallelEnvironment with the same n random particles,
+        functions and settings """
+
+    serial = ParticleArrays.ArrayEnvironment((400, 400), seed=6)
+    parallel = ParticleParallel.ParallelEnvironment((400, 400), workers=workers, seed=6)
+    for env in (serial, parallel):
+        for (name, value) in settings.items():
+            setattr(env, name, value)
+        env.addFunctions(functions)
+        env.addParticles(n, size=6, speed=1.5)
+    return (serial, parallel)
+
+def assertSameParticles(serial, parallel):
+    assert len(serial.x) == len(parallel.x)
+    for name in ParticleArrays.FIELDS:
+        assert numpy.array_equal(getattr(serial, name), getattr(parallel, name)), name
+
+
+@pytest.mark.parametrize('functions, settings', [
+    (['move', 'accelerate', 'drag', 'bounce', 'collide'], {'acceleration': (math.pi, 0.05)}),
+    (['move', 'bounce', 'collide'], {'broadphase': 'pairs'}),
+    (['move', 'bounce', 'combine'], {'remove_merged': True}),
+    (['move', 'bounce', 'attract'], {}),
+])
+def test_parallel_steps_match_serial_steps(functions, settings):
+    (serial, parallel) = makeEnvironments(functions, **settings)
+    with parallel:
+        for step in range(20):
+            serial.update()
+            parallel.update()
+            assertSameParticles(serial, parallel)
+        assert parallel.strips == 3
+
+def test_parallel_steps_match_serial_steps_with_one_worker():
+    (serial, parallel) = makeEnvironments(['move', 'bounce', 'collide'], workers=1)
+    with parallel:
+        for step in range(10):
+            serial.update()
+            parallel.update()
+        assertSameParticles(serial, parallel)
+
+def test_parallel_steps_reject_functions_they_cannot_split():
+    parallel = ParticleParallel.ParallelEnvironment((400, 400), workers=2)
+    parallel.function_names = ['move', 'spin']
+    with parallel:
+        with pytest.raises(ValueError):
+            parallel.update()
+    assert not parallel.processes
+    assert parallel.block is None
@@ -0,0 +1,116 @@
+import os
+import random
+
+import numpy
+import pygame
+import pytest
+
+import ParticleArrays
+import ParticleRenderer
+import PyParticles
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+
+def makeScene(n=400, seed=2):
+    """ Returns an environment of n particles of radius 0.3 to 12 and a few colours, on a lattice
+        that keeps them apart, reaching past the edges of a 300 by 300 surface """
+
+    rng = random.Random(seed)
+    env = PyParticles.Environment((300, 300))
+    for k in range(n):
+        particle = PyParticles.Particle((-30 + 18 * (k % 20) + rng.random(), -30 + 18 * (k // 20) + rng.random()),
+                                        rng.choice([0.3, 1, 1.5, 2, 3, 5, 8]))
+        particle.colour = rng.choice([(255, 255, 255), (255, 0, 255), (0, 255, 0), (200, 40, 10)])
+        particle.thickness = rng.choice([0, 0, 1, 2])
+        env.addParticle(particle)
+    return env
+
+def drawEach(surface, env, scale=1.0, offset=(0, 0), origin=(0, 0)):
+    """ Draws the particles one by one with pygame.draw, as the tutorials did """
+
+    for p in env.particles:
+        x = int(origin[0] + (offset[0] + p.x) * scale)
+        y = int(origin[1] + (offset[1] + p.y) * scale)
+        size = int(p.size * scale)
+        if size < 2:
+            pygame.draw.rect(surface, p.colour, (x, y, 2, 2))
+        else:
+            pygame.draw.circle(surface, p.colour, (x, y), size, p.thickness)
+
+def pixels(surface):
+    return pygame.surfarray.array3d(surface)
+
+
+@pytest.mark.parametrize('scale, offset, origin', [(1.0, (0, 0), (0, 0)), (0.5, (30, -20), (150, 150)),
+                                                   (1.7, (-3.5, 2.25), (10, 0))])
+@pytest.mark.parametrize('depth', [32, 24, 8])
+def test_renderer_draws_the_pixels_of_pygame_draw(scale, offset, origin, depth):
+    env = makeScene()
+    renderer = ParticleRenderer.ParticleRenderer()
+    renderer.density_radius = 0
+    expected = pygame.Surface((300, 300), depth=depth)
+    drawn = pygame.Surface((300, 300), depth=depth)
+    drawEach(expected, env, scale, offset, origin)
+    for frame in range(2):
+        drawn.fill((0, 0, 0))
+        renderer.draw(drawn, env, scale, offset, origin)
+        assert numpy.array_equal(pixels(drawn), pixels(expected))
+    assert renderer.stats['hits'] > 0
+    assert renderer.stats['culled'] > 0
+
+def test_renderer_draws_array_environments_as_environments():
+    env = ParticleArrays.ArrayEnvironment((300, 300), seed=3)
+    env.addParticles(300, size=4)
+    env.addParticles(100, size=1, colour=(255, 0, 255))
+    env.colour_array[::3] = (10, 200, 30)
+    reference = PyParticles.Environment((300, 300))
+    for view in env.particles:
+        particle = PyParticles.Particle((view.x, view.y), view.size)
+        particle.colour = tuple(view.colour)
+        reference.addParticle(particle)
+
+    renderer = ParticleRenderer.ParticleRenderer()
+    (drawn, expected) = (pygame.Surface((300, 300)), pygame.Surface((300, 300)))
+    renderer.draw(drawn, env)
+    renderer.draw(expected, reference)
+    assert numpy.array_equal(pixels(drawn), pixels(expected))
+
+def test_renderer_keeps_the_most_recently_used_stamps():
+    renderer = ParticleRenderer.ParticleRenderer(max_stamps=3)
+    for radius in (2, 3, 4, 2, 5):
+        renderer.getStamp(radius, (255, 255, 255), 0)
+    assert list(renderer.stamps) == [(4, (255, 255, 255), 0), (2, (255, 255, 255), 0), (5, (255, 255, 255), 0)]
+    assert (renderer.stats['hits'], renderer.stats['misses']) == (1, 4)
+
+def test_renderer_leaves_out_particles_off_the_surface():
+    env = PyParticles.Environment((300, 300))
+    for (x, y, size) in [(-20, 50, 5), (-4, 50, 5), (50, 320, 5), (50, 304, 5), (-1.5, 10, 1), (-2.5, 10, 1), (150, 150, 5)]:
+        env.addParticle(PyParticles.Particle((x, y), size))
+    renderer = ParticleRenderer.ParticleRenderer()
+    surface = pygame.Surface((300, 300))
+    renderer.draw(surface, env)
+    assert renderer.stats['culled'] == 3
+    assert (renderer.stats['blits'], renderer.stats['points']) == (3, 1)
+    expected = pygame.Surface((300, 300))
+    drawEach(expected, env)
+    assert numpy.array_equal(pixels(surface), pixels(expected))
+
+@pytest.mark.parametrize('depth', [32, 8])
+def test_renderer_sums_tiny_particles_into_their_pixel(depth):
+    env = ParticleArrays.ArrayEnvironment((300, 300))
+    env.addParticles(3, x=10.2, y=20.7, size=0.2, colour=(40, 10, 0))
+    env.addParticles(1, x=10.9, y=20.1, size=0.4, colour=(0, 0, 90))
+    env.addParticles(20, x=100, y=100, size=0.1, colour=(30, 30, 30))
+    env.addParticles(1, x=-1.5, y=5, size=0.1)
+    renderer = ParticleRenderer.ParticleRenderer()
+    renderer.density_gain = 0.5
+    surface = pygame.Surface((300, 300), depth=depth)
+    renderer.draw(surface, env)
+    assert renderer.stats['splats'] == 24
+    assert (renderer.stats['culled'], renderer.stats['points'], renderer.stats['blits']) == (0, 0, 0)
+    if depth == 32:
+        drawn = pixels(surface)
+        assert tuple(drawn[10, 20]) == (60, 15, 45)
+        assert tuple(drawn[100, 100]) == (255, 255, 255)
+        assert numpy.count_nonzero(drawn.any(axis=2)) == 2
@@ -0,0 +1,645 @@
+import gc
+import math
+import random
+
+import pytest
+
+import ParticleArrays
+import PyParticles
+
+
+def makeEnvironment(functions, n=150, seed=3, bounds=(300, 300), **settings):
+    """ Returns an environment of n random particles with the given functions and settings """
+
+    random.seed(seed)
+    env = PyParticles.Environment(bounds)
+    for (name, value) in settings.items():
+        setattr(env, name, value)
+    env.addFunctions(functions)
+    for i in range(n):
+        env.addParticles(1, size=random.randint(2, 12), mass=random.uniform(1, 20))
+    return env
+
+def run(env, steps):
+    for step in range(steps):
+        env.update()
+    return [(p.x, p.y, p.size) for p in env.particles]
+
+
+@pytest.mark.parametrize('functions', [['move', 'bounce', 'collide'],
+                                       ['move', 'accelerate', 'bounce', 'combine'],
+                                       ['move', 'bounce', 'collide', 'combine']])
+@pytest.mark.parametrize('velocity_mode', ['polar', 'cartesian'])
+@pytest.mark.parametrize('compiled', [True, False])
+@pytest.mark.parametrize('remove_merged', [False, True])
+def test_grid_matches_pairs(functions, velocity_mode, compiled, remove_merged):
+    settings = dict(velocity_mode=velocity_mode, compiled=compiled, remove_merged=remove_merged)
+    pairs = run(makeEnvironment(functions, broadphase='pairs', **settings), 30)
+    grid = run(makeEnvironment(functions, broadphase='grid', **settings), 30)
+    assert grid == pairs
+
+def test_grid_follows_particles_that_grow():
+    results = []
+    for broadphase in ('pairs', 'grid'):
+        env = makeEnvironment(['move', 'bounce', 'collide'], broadphase=broadphase)
+        run(env, 10)
+        for p in env.particles[::20]:
+            p.size *= 3
+        results.append(run(env, 30))
+    assert results[1] == results[0]
+
+
+def directAcceleration(particle, particles):
+    """ The acceleration of particle due to all the others, summed pair by pair """
+
+    ax = ay = 0
+    for other in particles:
+        dx = other.x - particle.x
+        dy = other.y - particle.y
+        dist = math.hypot(dx, dy)
+        if other is particle or dist < particle.size + other.size:
+            continue
+        ax += PyParticles.GRAVITATIONAL_CONSTANT * other.mass * dx / dist**3
+        ay += PyParticles.GRAVITATIONAL_CONSTANT * other.mass * dy / dist**3
+    return (ax, ay)
+
+def test_quadtree_is_exact_when_every_node_is_opened():
+    particles = makeEnvironment(['attract'], n=300).particles
+    tree = PyParticles.QuadTree(particles)
+    for p in particles[::10]:
+        (ax, ay) = tree.acceleration(p, opening_angle=0)
+        (ex, ey) = directAcceleration(p, particles)
+        assert ax == pytest.approx(ex, rel=1e-9, abs=1e-15)
+        assert ay == pytest.approx(ey, rel=1e-9, abs=1e-15)
+
+def test_quadtree_error_falls_with_the_opening_angle():
+    particles = makeEnvironment(['attract'], n=300).particles
+    tree = PyParticles.QuadTree(particles)
+    errors = []
+    for opening_angle in (1.0, 0.5, 0.2):
+        error = 0
+        for p in particles:
+            (ax, ay) = tree.acceleration(p, opening_angle)
+            (ex, ey) = directAcceleration(p, particles)
+            error += math.hypot(ax - ex, ay - ey) / math.hypot(ex, ey)
+        errors.append(error / len(particles))
+    assert errors[0] > errors[1] > errors[2]
+    assert errors[2] < 0.01
+
+@pytest.mark.parametrize('velocity_mode', ['polar', 'cartesian'])
+def test_barnes_hut_matches_pairs_with_zero_opening_angle(velocity_mode):
+    results = []
+    for gravity_mode in ('pairs', 'barnes_hut'):
+        env = makeEnvironment(['attract'], velocity_mode=velocity_mode, gravity_mode=gravity_mode, opening_angle=0)
+        run(env, 5)
+        results.append([(p.vx, p.vy) for p in env.particles])
+    for ((vx, vy), (ex, ey)) in zip(results[1], results[0]):
+        assert vx == pytest.approx(ex, rel=1e-9, abs=1e-12)
+        assert vy == pytest.approx(ey, rel=1e-9, abs=1e-12)
+
+def test_barnes_hut_combines_touching_particles():
+    env = makeEnvironment(['move', 'attract', 'combine'], gravity_mode='barnes_hut', remove_merged=True)
+    mass = sum(p.mass for p in env.particles)
+    run(env, 30)
+    assert len(env.particles) < 150
+    assert sum(p.mass for p in env.particles) == pytest.approx(mass)
+
+
+def test_cartesian_particles_follow_polar_particles():
+    functions = ['move', 'accelerate', 'drag', 'bounce', 'attract']
+    results = []
+    for velocity_mode in ('polar', 'cartesian'):
+        env = makeEnvironment(functions, n=50, velocity_mode=velocity_mode, acceleration=(math.pi, 0.05))
+        run(env, 50)
+        results.append([(p.x, p.y, p.vx, p.vy) for p in env.particles])
+    for (cartesian, polar) in zip(results[1], results[0]):
+        assert cartesian == pytest.approx(polar, abs=1e-6)
+
+def test_cartesian_collide_matches_polar_collide():
+    pairs = []
+    for kind in (PyParticles.Particle, PyParticles.CartesianParticle):
+        p1 = kind((100, 100), 10, 3)
+        p2 = kind((112, 105), 8, 5)
+        (p1.speed, p1.angle, p2.speed, p2.angle) = (2, 1, 1, 4)
+        PyParticles.collide(p1, p2)
+        pairs.append([(p.x, p.y, p.vx, p.vy) for p in (p1, p2)])
+    assert pairs[1][0] == pytest.approx(pairs[0][0])
+    assert pairs[1][1] == pytest.approx(pairs[0][1])
+
+def test_cartesian_particle_angle_and_speed():
+    particle = PyParticles.CartesianParticle((0, 0), 5)
+    particle.speed = 3.0
+    particle.angle = 2.0
+    assert (particle.vx, particle.vy) == pytest.approx((3 * math.sin(2.0), -3 * math.cos(2.0)))
+    assert (particle.angle, particle.speed) == pytest.approx((2.0, 3.0))
+
+
+def makeGas(n=100, elasticity=1.0, functions=('move', 'bounce', 'collide')):
+    """ Returns an environment of n particles of size 4 on a lattice, none touching, moving at random """
+
+    random.seed(5)
+    env = PyParticles.Environment((400, 400))
+    env.velocity_mode = 'cartesian'
+    env.elasticity = elasticity
+    env.addFunctions(list(functions))
+    for k in range(n):
+        env.addParticles(1, x=20 + 36 * (k % 10), y=20 + 36 * (k // 10), size=4, mass=random.uniform(1, 3),
+                         speed=random.uniform(0.5, 3))
+    for p in env.particles:
+        p.elasticity = math.sqrt(elasticity)
+    return env
+
+def engineEnergy(engine):
+    return sum(0.5 * p.mass * (vx*vx + vy*vy) for (p, vx, vy) in zip(engine.particles, engine.vx, engine.vy))
+
+def test_events_conserve_energy_and_keep_particles_apart():
+    engine = PyParticles.EventEngine(makeGas())
+    energy = engineEnergy(engine)
+    for t in range(1, 101):
+        engine.advanceTo(t)
+        for i in range(len(engine.particles)):
+            size = engine.particles[i].size
+            assert size - 1e-6 <= engine.x[i] <= 400 - size + 1e-6
+            assert size - 1e-6 <= engine.y[i] <= 400 - size + 1e-6
+            for j in range(i):
+                dist = math.hypot(engine.x[i] - engine.x[j], engine.y[i] - engine.y[j])
+                assert dist > size + engine.particles[j].size - 1e-6
+    assert engine.events > 100
+    assert engineEnergy(engine) == pytest.approx(energy)
+
+@pytest.mark.parametrize('functions', [('move', 'bounce', 'collide'), ('move', 'collide')])
+def test_events_match_predicting_every_pair(functions):
+    env = makeGas(functions=functions)
+    engine = PyParticles.EventEngine(env)
+    reference = PyParticles.EventEngine(env)
+    reference.queue = []
+    for i in range(len(reference.particles)):
+        reference.predictWalls(i)
+        reference.predictPairs(i, range(i + 1, len(reference.particles)))
+    engine.advanceTo(100)
+    reference.advanceTo(100)
+    assert engine.events == reference.events
+    assert engine.x == pytest.approx(reference.x)
+    assert engine.y == pytest.approx(reference.y)
+
+def test_state_at_leaves_the_engine_alone():
+    engine = PyParticles.EventEngine(makeGas())
+    engine.advanceTo(5)
+    before = (list(engine.x), list(engine.y), list(engine.vx), list(engine.vy), engine.time, engine.events)
+    later = engine.stateAt(40)
+    soon = engine.stateAt(5.25)
+    assert (list(engine.x), list(engine.y), list(engine.vx), list(engine.vy), engine.time, engine.events) == before
+    assert soon == [engine.positionAt(i, 5.25) for i in range(len(engine.particles))]
+    engine.advanceTo(40)
+    assert later == list(zip(engine.x, engine.y))
+
+def test_event_stepping_updates_the_particles():
+    env = makeGas()
+    env.stepping = 'events'
+    for step in range(20):
+        env.update()
+    assert env.event_engine.time == 20
+    assert [(p.x, p.y) for p in env.particles] == list(zip(env.event_engine.x, env.event_engine.y))
+
+def test_event_stepping_rejects_other_functions():
+    env = makeGas(functions=('move', 'bounce', 'collide', 'attract'))
+    env.stepping = 'events'
+    with pytest.raises(ValueError):
+        env.update()
+
+
+def overlappingBoxes(particles):
+    return set(frozenset((id(p1), id(p2))) for i, p1 in enumerate(particles) for p2 in particles[i+1:]
+               if abs(p1.x - p2.x) <= p1.size + p2.size and abs(p1.y - p2.y) <= p1.size + p2.size)
+
+def touchingPairs(particles):
+    return set(frozenset((id(p1), id(p2))) for i, p1 in enumerate(particles) for p2 in particles[i+1:]
+               if math.hypot(p1.x - p2.x, p1.y - p2.y) < p1.size + p2.size)
+
+def test_sweep_keeps_the_overlapping_boxes():
+    env = makeEnvironment(['move', 'bounce'], n=150)
+    sweep = PyParticles.SweepAndPrune()
+    for step in range(30):
+        env.update()
+        if step == 10:
+            env.addParticles(5, size=8)
+        if step == 20:
+            env.removeParticle(env.particles[3])
+        pairs = sweep.update(env.particles)
+        assert set(frozenset((id(p1), id(p2))) for (p1, p2) in pairs) == overlappingBoxes(env.particles)
+
+def trackContacts(env):
+    """ Returns the set of touching pairs kept up to date by the contact handlers of env """
+
+    touching = set()
+    def begin(p1, p2):
+        pair = frozenset((id(p1), id(p2)))
+        assert pair not in touching
+        touching.add(pair)
+    def end(p1, p2):
+        touching.remove(frozenset((id(p1), id(p2))))
+    env.addContactBeginHandler(begin).addContactEndHandler(end)
+    return touching
+
+def test_sweep_reports_contacts_as_they_begin_and_end():
+    env = makeEnvironment(['move', 'bounce'], n=150, broadphase='sweep')
+    touching = trackContacts(env)
+    for step in range(40):
+        env.update()
+        assert touching == touchingPairs(env.particles)
+    assert touching
+
+def test_sweep_ends_the_contacts_of_removed_particles():
+    env = makeEnvironment(['move', 'bounce', 'combine'], n=150, broadphase='sweep', remove_merged=True)
+    touching = trackContacts(env)
+    for step in range(40):
+        # Particles merged away are only taken out at the end of the step, so their contacts
+        # are reported as ended in the next one
+        before = set(id(p) for p in env.particles)
+        env.update()
+        assert all(pair <= before for pair in touching)
+    assert len(env.particles) < 150
+
+
+@pytest.mark.parametrize('functions', [['move', 'accelerate', 'drag', 'bounce', 'collide'],
+                                       ['move', 'attract', 'combine'],
+                                       ['move', 'bounce', 'collide', 'combine', 'attract']])
+@pytest.mark.parametrize('velocity_mode', ['polar', 'cartesian'])
+def test_compiled_plan_matches_calling_each_function(functions, velocity_mode):
+    settings = dict(velocity_mode=velocity_mode, acceleration=(math.pi, 0.05))
+    compiled = run(makeEnvironment(functions, n=80, compiled=True, **settings), 30)
+    interpreted = run(makeEnvironment(functions, n=80, compiled=False, **settings), 30)
+    if velocity_mode == 'polar':
+        assert compiled == interpreted
+    else:
+        assert len(compiled) == len(interpreted)
+        for (a, b) in zip(compiled, interpreted):
+            assert a == pytest.approx(b, rel=1e-9, abs=1e-9)
+
+def test_compiled_plan_calls_functions_added_by_hand():
+    env = makeEnvironment(['move'], n=20)
+    calls = []
+    env.function_dict['count'] = (1, calls.append)
+    env.addFunctions(['count'])
+    run(env, 3)
+    assert calls == env.particles * 3
+
+def test_compiled_plan_follows_mode_changes():
+    env = makeEnvironment(['move', 'attract'], n=20)
+    run(env, 2)
+    plan = env.plan
+    env.gravity_mode = 'barnes_hut'
+    run(env, 1)
+    assert env.plan is not plan
+
+
+def test_handles_stay_valid_until_removal():
+    env = makeEnvironment(['move'], n=10)
+    particle = env.particles[3]
+    handle = particle.handle
+    assert env.getParticle(handle) is particle
+    assert env.removeParticle(particle)
+    assert not env.removeParticle(particle)
+    assert env.getParticle(handle) is None
+    assert particle not in env.particles
+    assert len(env.particles) == 9
+    assert all(env.particles[i].index == i for i in range(9))
+    assert env.addParticle(PyParticles.Particle((50, 50), 5)) not in [p.handle for p in env.particles[:9]]
+
+def test_particles_removed_during_update_stay_until_the_end_of_the_step():
+    env = makeEnvironment(['move'], n=10)
+    doomed = env.particles[:4]
+    seen = []
+
+    def removeSome(particle):
+        seen.append(particle)
+        if particle in doomed:
+            assert env.removeParticle(particle)
+    env.function_dict['remove'] = (1, removeSome)
+    env.addFunctions(['remove'])
+    env.update()
+    assert len(seen) == 10
+    assert len(env.particles) == 6
+    assert not any(p in env.particles for p in doomed)
+    assert not any(env.contains(p) for p in doomed)
+
+def test_particles_appended_by_hand_can_be_removed():
+    env = makeEnvironment(['move'], n=5)
+    particle = PyParticles.Particle((50, 50), 5)
+    env.particles.append(particle)
+    assert env.removeParticle(particle)
+    assert particle not in env.particles
+
+@pytest.mark.parametrize('velocity_mode', ['polar', 'cartesian'])
+def test_removing_merged_particles_conserves_mass(velocity_mode):
+    env = makeEnvironment(['move', 'bounce', 'combine'], n=150, velocity_mode=velocity_mode, remove_merged=True)
+    mass = sum(p.mass for p in env.particles)
+    run(env, 40)
+    assert len(env.particles) < 150
+    assert sum(p.mass for p in env.particles) == pytest.approx(mass)
+    assert all(env.getParticle(p.handle) is p for p in env.particles)
+
+
+@pytest.mark.parametrize('cls', [PyParticles.Particle, PyParticles.CartesianParticle])
+def test_particles_only_allocate_a_dictionary_for_extra_attributes(cls):
+    particle = cls((10, 20), 5, 3)
+    other = cls((30, 20), 5, 3)
+    size = PyParticles.objectSize(particle)
+    assert not any(isinstance(ref, dict) for ref in gc.get_referents(particle))
+    particle.collide_with = other
+    particle.charge = 0.5
+    assert (particle.collide_with, particle.charge) == (other, 0.5)
+    assert PyParticles.objectSize(particle) > size
+    assert 'x' not in particle.__dict__
+
+def test_bytes_per_particle_is_the_average_object_size():
+    env = makeEnvironment(['move'], n=10)
+    sizes = [PyParticles.objectSize(p) for p in env.particles]
+    assert env.bytesPerParticle() == pytest.approx(sum(sizes) / 10)
+
+
+def bruteForceQueries(particles, x, y):
+    """ Returns what findParticle, findParticlesInRadius, findParticlesInRect and findNearestParticles
+        should return for a query around (x, y), by testing every particle """
+
+    dist = [math.hypot(p.x - x, p.y - y) for p in particles]
+    covering = [i for i in range(len(particles)) if dist[i] <= particles[i].size]
+    found = particles[min(covering, key=dist.__getitem__)] if covering else None
+    radius = {id(p) for (p, d) in zip(particles, dist) if d <= 30}
+    rect = {id(p) for p in particles if x - 20 <= p.x <= x + 40 and y - 10 <= p.y <= y + 25}
+    nearest = sorted(dist)[:5]
+    return (found, radius, rect, nearest)
+
+def queryParticles(env, x, y):
+    """ Runs the queries that bruteForceQueries answers """
+
+    return (env.findParticle(x, y),
+            {id(p) for p in env.findParticlesInRadius(x, y, 30)},
+            {id(p) for p in env.findParticlesInRect(x - 20, y - 10, x + 40, y + 25)},
+            [math.hypot(p.x - x, p.y - y) for p in env.findNearestParticles(x, y, 5)])
+
+def test_queries_match_testing_every_particle():
+    env = makeEnvironment(['move', 'bounce', 'collide'], n=300)
+    points = random.Random(1)
+    for step in range(5):
+        run(env, 3)
+        for query in range(40):
+            (x, y) = (points.uniform(-20, 320), points.uniform(-20, 320))
+            assert queryParticles(env, x, y) == bruteForceQueries(env.particles, x, y)
+
+def test_queries_follow_particles_changed_between_updates():
+    env = makeEnvironment(['move', 'bounce'], n=100)
+    env.findParticle(0, 0)
+    (moved, grown) = env.particles[:2]
+    env.moveParticle(moved, 150.5, 150.5)
+    assert env.findParticle(150.5, 150.5) is moved
+
+    grown.size = 200
+    env.invalidateIndex()
+    assert env.findParticle(grown.x + 150, grown.y) is grown
+
+    added = PyParticles.Particle((-50, -50), 5)
+    env.particles.append(added)
+    env.invalidateIndex()
+    assert env.findParticle(-50, -50) is added
+    env.removeParticle(added)
+    assert env.findParticle(-50, -50) is None
+    assert env.findNearestParticles(-50, -50)[0] is not added
+
+
+def makeFloor(n=12):
+    """ Returns a sleeping environment with a row of n balls dropped onto the floor under gravity """
+
+    random.seed(0)
+    env = PyParticles.Environment((300, 300))
+    env.acceleration = (math.pi, 0.2)
+    env.addFunctions(['move', 'accelerate', 'drag', 'bounce', 'collide'])
+    for i in range(n):
+        env.addParticles(1, x=15 + 24 * i, y=290, size=10, mass=100, speed=0)
+    env.sleeping = True
+    return env
+
+def test_balls_resting_on_the_floor_fall_asleep():
+    env = makeFloor()
+    run(env, 300)
+    assert all(p.asleep for p in env.particles)
+    assert env.sleep_stats == {'awake': 0, 'asleep': 12, 'islands': 12}
+    assert run(env, 20) == run(env, 20)
+
+def test_sleeping_balls_wake_when_touched():
+    env = makeFloor()
+    run(env, 300)
+    falling = PyParticles.Particle((15, 200), 10, 100)
+    env.addParticle(falling)
+    for step in range(100):
+        env.update()
+        if not env.particles[0].asleep:
+            break
+    assert not env.particles[0].asleep
+    assert sum(p.asleep for p in env.particles) == 11
+    assert env.sleep_stats['islands'] == 11
+
+    env.wakeParticle(env.particles[5])
+    assert not env.particles[5].asleep
+    assert env.sleep_stats['islands'] == 10
+    run(env, 300)
+    assert all(p.asleep for p in env.particles)
+
+def test_moving_particles_stay_awake():
+    env = makeGas(elasticity=1.0)
+    env.sleeping = True
+    run(env, 300)
+    assert not any(p.asleep for p in env.particles)
+    assert env.sleep_stats['awake'] == 100
+
+
+def makeLattice(stepping, fast=False):
+    """ Returns a 10 by 10 lattice of slow particles, none touching, and optionally one fast particle
+        heading into them """
+
+    random.seed(3)
+    env = PyParticles.Environment((400, 400))
+    env.addFunctions(['move', 'bounce', 'collide'])
+    for k in range(100):
+        env.addParticles(1, x=20 + 36 * (k % 10), y=20 + 36 * (k // 10), size=4, mass=2, speed=random.uniform(0, 0.02))
+    if fast:
+        env.addParticles(1, x=38, y=390, size=4, mass=2, speed=2, angle=0.05)
+    env.stepping = stepping
+    return env
+
+def test_multirate_follows_fixed_steps_for_slow_particles():
+    fixed = makeLattice('fixed')
+    multirate = makeLattice('multirate')
+    run(fixed, 200)
+    run(multirate, 200)
+    assert multirate.multirate_stats['bins'] == [0, 0, 0, 100]
+    multirate.scheduler.synchronize()
+    for (p, q) in zip(fixed.particles, multirate.particles):
+        assert (q.x, q.y) == pytest.approx((p.x, p.y), abs=1e-6)
+
+def test_multirate_keeps_fast_particles_at_the_full_rate():
+    env = makeLattice('multirate', fast=True)
+    fast = env.particles[-1]
+    for step in range(300):
+        env.update()
+        if fast.speed > 1:
+            assert env.scheduler.entries[id(fast)][1] == 0
+        env.scheduler.synchronize()
+        assert all(time == env.scheduler.time for (p, level, time) in env.scheduler.entries.values())
+        particles = env.particles
+        assert all(math.hypot(p1.x - p2.x, p1.y - p2.y) > p1.size + p2.size - 1
+                   for i, p1 in enumerate(particles) for p2 in particles[i+1:])
+    assert fast.speed < 1
+
+def test_multirate_rejects_functions_it_cannot_simulate():
+    env = makeEnvironment(['move', 'bounce', 'collide'], n=10, stepping='multirate')
+    env.update()
+    env.function_dict['spin'] = (1, lambda p: None)
+    env.addFunctions(['spin'])
+    with pytest.raises(ValueError):
+        env.update()
+
+
+@pytest.mark.parametrize('velocity_mode', ['polar', 'cartesian'])
+def test_checkpoints_continue_where_they_were_saved(tmp_path, velocity_mode):
+    path = str(tmp_path / 'particles.checkpoint')
+    env = makeEnvironment(['move', 'accelerate', 'drag', 'bounce', 'collide', 'combine'], n=100,
+                          velocity_mode=velocity_mode, acceleration=(math.pi, 0.05), remove_merged=True)
+    env.particles[4].colour = (10, 20, 30)
+    run(env, 10)
+    env.save(path)
+    loaded = PyParticles.Environment.load(path)
+    assert loaded.function_names == env.function_names
+    assert (loaded.acceleration, loaded.remove_merged, loaded.velocity_mode) == (env.acceleration, True, velocity_mode)
+    assert [(p.handle, p.colour, p.drag, p.cartesian) for p in loaded.particles] == \
+           [(p.handle, p.colour, p.drag, p.cartesian) for p in env.particles]
+    assert run(loaded, 20) == run(env, 20)
+    assert loaded.addParticle(PyParticles.Particle((5, 5), 5)) == env.addParticle(PyParticles.Particle((5, 5), 5))
+
+def test_checkpoints_restore_the_random_module(tmp_path):
+    path = str(tmp_path / 'particles.checkpoint')
+    env = makeEnvironment(['move'], n=10)
+    env.save(path)
+    expected = random.random()
+    PyParticles.Environment.load(path)
+    assert random.random() == expected
+
+def test_checkpoints_of_another_layout_are_refused(tmp_path):
+    path = str(tmp_path / 'arrays.checkpoint')
+    ParticleArrays.ArrayEnvironment((100, 100)).save(path)
+    with pytest.raises(ValueError):
+        PyParticles.Environment.load(path)
+
+
+def test_recordings_read_back_every_recorded_step(tmp_path):
+    path = str(tmp_path / 'particles.trajectory')
+    env = makeEnvironment(['move', 'bounce', 'combine'], remove_merged=True)
+    recorder = env.startRecording(path, fields=('id', 'x', 'y', 'speed', 'vx', 'mass'), every=2, chunk_steps=3)
+    expected = []
+    for step in range(25):
+        env.update()
+        if step % 2 == 0:
+            expected.append((step, [(p.handle, p.x, p.y, p.speed, p.vx, p.mass) for p in env.particles]))
+    env.stopRecording()
+    assert env.recorder is None
+    assert recorder.stats['steps'] == 13
+    assert recorder.stats['chunks'] == 5
+
+    recorded = [(step, list(zip(*(columns[name] for name in ('id', 'x', 'y', 'speed', 'vx', 'mass')))))
+                for (step, columns) in PyParticles.readTrajectory(path)]
+    assert recorded == expected
+    assert len(recorded[-1][1]) < 150
+
+def test_recordings_cut_short_read_back_whole_chunks(tmp_path):
+    path = tmp_path / 'particles.trajectory'
+    env = makeEnvironment(['move', 'bounce'], n=20)
+    env.startRecording(str(path), chunk_steps=4)
+    run(env, 8)
+    env.stopRecording()
+    data = path.read_bytes()
+    path.write_bytes(data[:-10])
+    assert [step for (step, columns) in PyParticles.readTrajectory(str(path))] == [0, 1, 2, 3]
+
+def test_recordings_refuse_unknown_fields(tmp_path):
+    env = makeEnvironment(['move'], n=5)
+    with pytest.raises(ValueError):
+        env.startRecording(str(tmp_path / 'particles.trajectory'), fields=('x', 'colour'))
+    with pytest.raises(ValueError):
+        list(PyParticles.readTrajectory(__file__))
+
+
+def makeWorld():
+    """ Returns a ChunkedEnvironment with chunks of 100 by 100 and 400 particles spread over 10 by 10 chunks """
+
+    random.seed(8)
+    env = PyParticles.ChunkedEnvironment((100, 100))
+    env.addFunctions(['move', 'drag', 'collide'])
+    for k in range(400):
+        velocity_mode = 'cartesian' if k % 3 == 0 else 'polar'
+        env.velocity_mode = velocity_mode
+        env.addParticles(1, x=random.uniform(0, 1000), y=random.uniform(0, 1000), size=random.randint(2, 6),
+                         colour=(k % 256, 7, 200))
+    env.setView(0, 0, 100, 100)
+    return env
+
+def particleStates(env, handles):
+    states = {}
+    for handle in handles:
+        p = env.getParticle(handle)
+        states[handle] = (type(p), p.x, p.y, p.size, p.mass, p.speed, p.angle, p.drag, p.elasticity, p.colour, p.thickness)
+    return states
+
+def test_chunks_far_from_the_view_freeze_and_thaw_unchanged():
+    env = makeWorld()
+    assert env.chunk_stats['frozen'] > 0
+    assert len(env.particles) < 400
+    env.setView(0, 0, 1000, 1000)
+    assert len(env.particles) == 400
+    marked = env.particles[0]
+    marked.collide_with = env.particles[1]
+    handles = [p.handle for p in env.particles]
+    states = particleStates(env, handles)
+
+    env.setView(5000, 5000, 5100, 5100)
+    assert env.particles == []
+    assert env.chunk_stats['packed'] == 400
+    env.setView(0, 0, 1000, 1000)
+    assert len(env.particles) == 400
+    assert particleStates(env, handles) == states
+    assert env.getParticle(marked.handle) is marked
+
+def test_only_chunks_near_the_view_move():
+    env = makeWorld()
+    env.active_radius = 0
+    env.drift_radius = 1
+    env.setView(450, 450, 550, 550)
+    before = {p.handle: (p.x, p.y) for p in env.particles}
+    frozen = set(env.chunk_of) - set(before)
+    states = particleStates(env, frozen)
+    run(env, 5)
+    assert all((p.x, p.y) != before[p.handle] for p in env.particles if p.speed)
+    assert particleStates(env, frozen) == states
+
+def test_frozen_particles_are_found_by_handle():
+    env = makeWorld()
+    handle = next(handle for handle in env.chunk_of if handle not in env.handles)
+    particle = env.getParticle(handle)
+    assert particle is not None and particle in env.particles
+    assert env.chunkKey(particle.x, particle.y) == env.chunk_of[handle]
+
+def test_checkpoints_of_chunked_environments_include_frozen_particles(tmp_path):
+    path = str(tmp_path / 'world.checkpoint')
+    env = makeWorld()
+    handles = list(env.chunk_of)
+    env.save(path)
+    assert env.chunk_stats['frozen'] > 0
+    loaded = PyParticles.ChunkedEnvironment.load(path)
+    assert loaded.view == env.view
+    assert sorted(loaded.chunk_of) == sorted(handles)
+    assert particleStates(loaded, handles) == particleStates(env, handles)
+
+def test_chunked_environments_refuse_other_stepping():
+    env = makeWorld()
+    env.broadphase = 'sweep'
+    with pytest.raises(ValueError):
+        env.update()
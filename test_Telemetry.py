@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+import ParticleArrays
+import PyParticles
+import Telemetry
+
+
+def recordSteps(buffer, steps):
+    """ Records steps whose counters and energy are the step's number """
+
+    for k in range(steps):
+        buffer.count(pairs=k, hits=1)
+        buffer.count(hits=1, merges=k)
+        buffer.endStep(float(k), (k, -k))
+
+
+def test_buffers_keep_the_last_steps():
+    buffer = Telemetry.TelemetryBuffer(capacity=4)
+    assert buffer.latest() is None
+    recordSteps(buffer, 3)
+    assert len(buffer) == 3
+    assert buffer.history('pairs') == [0, 1, 2]
+    recordSteps(buffer, 7)
+    assert len(buffer) == 4
+    assert buffer.history('kinetic_energy') == [3, 4, 5, 6]
+    assert buffer.history('momentum_y') == [-3, -4, -5, -6]
+    assert buffer.step(0)['pairs'] == 3
+    assert buffer.latest() == {'pairs': 6, 'broadphase': 0, 'hits': 2, 'bounces': 0, 'merges': 6,
+                               'kinetic_energy': 6, 'momentum_x': 6, 'momentum_y': -6}
+    with pytest.raises(IndexError):
+        buffer.step(4)
+    with pytest.raises(IndexError):
+        buffer.step(-5)
+    buffer.clear()
+    assert len(buffer) == 0 and buffer.history('hits') == []
+
+
+@pytest.mark.parametrize('broadphase', ['pairs', 'grid'])
+def test_environments_count_each_update(broadphase):
+    random.seed(4)
+    env = PyParticles.Environment((300, 300))
+    env.broadphase = broadphase
+    env.remove_merged = True
+    env.addFunctions(['move', 'bounce', 'combine'])
+    env.addParticles(120, size=6, speed=2)
+    telemetry = env.enableTelemetry(capacity=8)
+    for step in range(20):
+        n = len(env.particles)
+        env.update()
+        counts = telemetry.latest()
+        assert counts['merges'] == n - len(env.particles)
+        assert counts['hits'] >= counts['merges']
+        assert counts['broadphase'] <= counts['pairs']
+        if broadphase == 'pairs':
+            assert counts['pairs'] == n*(n - 1)//2
+        assert counts['kinetic_energy'] == pytest.approx(env.kineticEnergy())
+        assert (counts['momentum_x'], counts['momentum_y']) == pytest.approx(env.momentum())
+    assert len(telemetry) == 8
+    assert sum(telemetry.history('bounces')) > 0
+    assert sum(telemetry.history('merges')) > 0
+
+def test_telemetry_leaves_the_simulation_alone():
+    runs = []
+    for enabled in (False, True):
+        random.seed(4)
+        env = PyParticles.Environment((300, 300))
+        env.addFunctions(['move', 'bounce', 'collide', 'attract'])
+        env.addParticles(80, size=5, speed=1)
+        if enabled:
+            env.enableTelemetry()
+        for step in range(20):
+            env.update()
+        runs.append([(p.x, p.y, p.speed, p.angle) for p in env.particles])
+    assert runs[0] == runs[1]
+
+def test_array_environments_count_each_update():
+    env = ParticleArrays.ArrayEnvironment((300, 300), seed=2)
+    env.remove_merged = True
+    env.addFunctions(['move', 'bounce', 'combine'])
+    env.addParticles(200, size=6, speed=2)
+    telemetry = env.enableTelemetry()
+    for step in range(10):
+        n = len(env.x)
+        env.update()
+        counts = telemetry.latest()
+        assert counts['merges'] == n - len(env.x)
+        assert counts['kinetic_energy'] == pytest.approx(env.kineticEnergy())
+    assert sum(telemetry.history('bounces')) > 0
+    env.disableTelemetry()
+    env.update()
+    assert len(telemetry) == 10
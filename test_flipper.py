@@ -0,0 +1,236 @@
+import math
+import os
+import random
+import types
+
+import pytest
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+FLIPPER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flipper.py')
+
+
+@pytest.fixture
+def loadGame(monkeypatch):
+    """ Returns a function that runs flipper.py without its main loop and returns the module and
+        its game, serving a new ball once the given game settings are applied """
+
+    monkeypatch.chdir(os.path.dirname(FLIPPER))
+    def load(**settings):
+        with open(FLIPPER) as f:
+            source = f.read().replace('game.start()', '')
+        module = types.ModuleType('flipper')
+        module.__file__ = FLIPPER
+        exec(compile(source, FLIPPER, 'exec'), module.__dict__)
+        game = module.game
+        for (name, value) in settings.items():
+            setattr(game, name, value)
+        random.seed(0)
+        game.end()
+        return (module, game)
+    return load
+
+def tick(game, ticks):
+    """ Ticks the ball in play and returns its positions after each tick """
+
+    positions = []
+    for t in range(ticks):
+        game.ballTick(None, game.balls[0], t)
+        positions.append(tuple(game.balls[0].getPosition()[0]))
+    return positions
+
+
+@pytest.mark.parametrize('settings', [{}, {'collision': 'sdf'}, {'continuous': True}])
+def test_cartesian_ball_follows_polar_ball(loadGame, settings):
+    (flipper, polar) = loadGame(**settings)
+    (flipper, cartesian) = loadGame(velocity_mode='cartesian', **settings)
+    assert isinstance(cartesian.balls[0], flipper.CartesianBall)
+    for (p, c) in zip(tick(polar, 400), tick(cartesian, 400)):
+        assert math.hypot(p[0] - c[0], p[1] - c[1]) < 1e-6
+
+def test_cartesian_ball_bounces_as_the_polar_ball(loadGame):
+    (flipper, polar) = loadGame()
+    (flipper, cartesian) = loadGame(velocity_mode='cartesian')
+    states = random.Random(1)
+    bounced = 0
+    for k in range(300):
+        (x, y) = (states.uniform(0, polar.width), states.uniform(0, polar.height - 100))
+        (vx, vy) = (states.uniform(-15, 15), states.uniform(-15, 15))
+        results = []
+        for game in (polar, cartesian):
+            ball = game.balls[0]
+            ball.setPosition([[x, y]])
+            ball.setSpeed(math.hypot(vx, vy))
+            ball.setAngle(math.atan2(vx, -vy))
+            game.ballBounce(ball)
+            speed = ball.getSpeed()
+            results.append(tuple(ball.getPosition()[0]) +
+                           (math.sin(ball.getAngle()) * speed, -math.cos(ball.getAngle()) * speed))
+        assert results[1] == pytest.approx(results[0], abs=1e-9)
+        bounced += results[0][2:] != pytest.approx((vx, vy))
+    assert bounced > 30
+
+def test_objects_only_make_handler_lists_when_needed(loadGame):
+    (flipper, game) = loadGame()
+    line = flipper.Line([(0, 0), (10, 10)])
+    assert line.getClickHandlers() == ()
+    size = line.getMemorySize()
+    handler = lambda obj, pos: None
+    line.addClickHandler(handler)
+    assert line.getClickHandlers() == [handler]
+    assert line.getMemorySize() > size
+    line.removeClickHandler(handler)
+    assert line.getClickHandlers() == []
+    with pytest.raises(ValueError):
+        line.removeClickHandler(handler)
+    with pytest.raises(ValueError):
+        flipper.Line([(0, 0), (10, 10)]).removeMouseDragHandler(handler)
+
+def test_frame_measures_objects_again_once_they_change(loadGame):
+    (flipper, game) = loadGame()
+    frame = flipper.Frame('test', 100, 100)
+    assert frame.getBytesPerObject() == 0
+    line = flipper.Line([(0, 0), (10, 10)])
+    frame.addObject(line)
+    assert frame.getBytesPerObject() == line.getMemorySize()
+    frame.addObject(flipper.Line([(0, 0), (10, 10), (20, 20)]))
+    assert frame.getBytesPerObject() > line.getMemorySize()
+    frame.removeObject(line)
+    assert frame.getBytesPerObject() > line.getMemorySize()
+
+def test_telemetry_counts_each_bounce_and_leaves_the_ball_alone(loadGame):
+    (flipper, game) = loadGame()
+    (flipper, counted) = loadGame()
+    telemetry = counted.enableTelemetry(capacity=50)
+    assert tick(counted, 300) == tick(game, 300)
+    assert len(telemetry) == 50 and telemetry.steps >= 300
+    objects = len(counted.frame.getObjects())
+    for k in range(50):
+        step = telemetry.step(k)
+        assert step['hits'] <= step['broadphase'] <= step['pairs'] <= objects
+    assert sum(telemetry.history('broadphase')) > 0
+    steps = telemetry.steps
+    counted.disableTelemetry()
+    tick(counted, 10)
+    assert telemetry.steps == steps
+
+def walkEveryObject(game):
+    """ Makes the compiled table of a game hand ballBounce every object and every edge """
+
+    table = game.getTable()
+    objects = game.frame.getObjects()
+    edges = {}
+    for (i, owner) in enumerate(table.owners):
+        if table.edges[i] is not None:
+            edges.setdefault(owner, []).append(i)
+    def near(pos, reach):
+        inside = set(i for i in table.polygons if objects[i].isPointInside(*pos))
+        return list(range(len(objects))), edges, inside
+    table.near = near
+
+@pytest.mark.parametrize('settings', [{}, {'continuous': True}, {'velocity_mode': 'cartesian'}])
+def test_table_lookups_give_the_path_of_walking_every_object(loadGame, settings):
+    (flipper, game) = loadGame(**settings)
+    (flipper, walking) = loadGame(**settings)
+    walkEveryObject(walking)
+    assert tick(game, 1500) == tick(walking, 1500)
+
+def test_table_finds_the_objects_near_the_ball(loadGame):
+    (flipper, game) = loadGame()
+    table = game.getTable()
+    objects = game.frame.getObjects()
+    points = random.Random(2)
+    for k in range(300):
+        (x, y) = (points.uniform(0, game.width), points.uniform(0, game.height))
+        reach = points.uniform(5, 40)
+        (candidates, edges, inside) = table.near((x, y), reach)
+        assert candidates == sorted(set(candidates))
+        assert set(table.dynamic) <= set(candidates)
+        for (i, box) in enumerate(table.boxes):
+            if box[0] <= x + reach and box[2] >= x - reach and box[1] <= y + reach and box[3] >= y - reach:
+                assert table.owners[i] in candidates
+        assert inside == set(i for i in table.polygons if objects[i].isPointInside(x, y))
+
+def test_table_is_compiled_again_when_objects_change(loadGame):
+    (flipper, game) = loadGame()
+    table = game.getTable()
+    assert game.getTable() is table
+    bouncer = [obj for obj in game.frame.getObjects() if isinstance(obj, flipper.Circle)][0]
+    game.frame.removeObject(bouncer)
+    assert game.getTable() is not table
+    assert len(game.getTable().owners) == len(table.owners) - 1
+
+def ticksInWalls(game, speed, ticks, seed=1):
+    """ Kicks the ball at speed in a random direction every 100 ticks and returns the number of
+        ticks it ended with its centre inside a Boundary """
+
+    walls = [obj for obj in game.frame.getObjects() if type(obj).__name__ == 'Boundary']
+    angles = random.Random(seed)
+    inside = 0
+    for t in range(ticks):
+        ball = game.balls[0]
+        if t % 100 == 0:
+            ball.setSpeed(speed)
+            ball.setAngle(angles.uniform(0, 2 * math.pi))
+        game.ballTick(None, ball, t)
+        (x, y) = game.balls[0].getPosition()[0]
+        inside += any(wall.isPointInside(x, y) for wall in walls)
+    return inside
+
+def test_distance_field_keeps_the_ball_out_of_the_walls(loadGame):
+    (flipper, game) = loadGame(collision='sdf')
+    assert game.getTable().field is not None
+    assert ticksInWalls(game, game.max_speed, 2000) == 0
+
+def test_distance_field_pushes_a_ball_out_of_the_walls(loadGame):
+    (flipper, game) = loadGame(collision='sdf')
+    field = game.getTable().field
+    walls = [obj for obj in game.frame.getObjects() if isinstance(obj, flipper.Boundary)]
+    ball = game.balls[0]
+    points = random.Random(3)
+    pushed = 0
+    while pushed < 20:
+        # Away from the edges of the screen, past which the field is clamped
+        (x, y) = (points.uniform(100, game.width - 100), points.uniform(100, game.height - 100))
+        (dist, nx, ny) = field.sample(x, y)
+        if not -8 < dist < -2:
+            continue
+        ball.setPosition([[x, y]])
+        ball.setSpeed(10)
+        ball.setAngle(math.atan2(-nx, ny))
+        game.ballBounce(ball)
+        (x, y) = ball.getPosition()[0]
+        assert not any(wall.isPointInside(x, y) for wall in walls)
+        assert math.sin(ball.getAngle()) * nx - math.cos(ball.getAngle()) * ny >= 0
+        pushed += 1
+
+@pytest.mark.parametrize('settings', [{}, {'velocity_mode': 'cartesian'}])
+def test_continuous_collision_keeps_a_fast_ball_out_of_the_walls(loadGame, settings):
+    (flipper, game) = loadGame(continuous=True, max_speed=60, **settings)
+    assert ticksInWalls(game, 60, 3000) == 0
+
+def test_fast_ball_tunnels_into_the_walls_without_continuous_collision(loadGame):
+    (flipper, game) = loadGame(max_speed=60)
+    assert ticksInWalls(game, 60, 3000) > 0
+
+def test_ball_stopped_on_a_wall_is_still_stopped_by_it(loadGame):
+    (flipper, game) = loadGame(continuous=True)
+    ball = game.balls[0]
+    stopped = 0
+    for wall in [obj for obj in game.frame.getObjects() if isinstance(obj, flipper.Boundary)]:
+        corners = wall.getPosition()
+        for k in range(-1, len(corners) - 1):
+            ((ax, ay), (bx, by)) = (corners[k], corners[k + 1])
+            length = math.hypot(bx - ax, by - ay)
+            (mx, my) = ((ax + bx) / 2.0, (ay + by) / 2.0)
+            (nx, ny) = (-(by - ay) / length, (bx - ax) / length)
+            if length < 40 or not wall.isPointInside(mx + nx, my + ny):
+                continue
+            # Touching the wall from outside already, the centre is swept into it and then on
+            end = (mx + 5 * nx, my + 5 * ny)
+            hit = game.timeOfImpact(ball, (mx - 10 * nx, my - 10 * ny), end)
+            assert hit is not None
+            assert not wall.isPointInside(hit[1], hit[2])
+            assert game.timeOfImpact(ball, (hit[1], hit[2]), end) is not None
+            stopped += 1
+    assert stopped > 10